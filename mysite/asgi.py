@@ -13,4 +13,14 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Live scoreboard event streams are served ahead of Django, and everything
+# else runs on a bounded thread pool with writers queued in coroutines.
+# Exports stream from that pool too.
+from trivia import export, jobs, live, offload  # noqa: E402
+
+application = live.router(offload.router(export.router(django_application)))
+
+# Background jobs left queued or running by the last process get picked up
+jobs.start()
@@ -42,6 +42,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'trivia.metrics.MetricsMiddleware',
+    'trivia.sqlite.WriteLockMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -83,6 +85,99 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/3.0/topics/cache/
+# Scoreboards are cached per game. Every server process has to see the same
+# cache, so use a file or shared cache when running more than one process.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': '/var/tmp/trivia_cache',
+    }
+}
+
+
+# Answer checking
+# Fuzzy grading needs numpy. Responses that score at least TRIVIA_FUZZY_ACCEPT
+# are marked correct if their numbers match and they're a few typos away at
+# most, ones down to TRIVIA_FUZZY_REVIEW are flagged so they get checked
+# first, and the rest are left alone.
+
+TRIVIA_FUZZY_GRADING = False
+TRIVIA_FUZZY_ACCEPT = 0.85
+TRIVIA_FUZZY_REVIEW = 0.5
+
+
+# Metrics
+# Per-view request counts, latency and queries are served to staff at
+# /manage/metrics/ for Prometheus. Lower the sample rate if the overhead
+# ever shows; 0 turns recording off.
+
+TRIVIA_METRICS_SAMPLE_RATE = 1.0
+
+
+# SQLite concurrency
+# Pragmas run on every new SQLite connection: WAL so reads and the writer
+# don't block each other, and a busy timeout in ms so writers wait their turn
+# instead of failing with "database is locked". The write lock, off by
+# default, also runs writing requests one at a time inside each process,
+# logins and signups included. Try `python manage.py stress_sqlite` before
+# changing these.
+
+TRIVIA_SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'busy_timeout': 20000,
+    'cache_size': -20000,
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'memory',
+}
+TRIVIA_SQLITE_WRITE_LOCK = False
+
+
+# Submission queue
+# Queue answers and wagers in process and write them in batches every few
+# milliseconds, so a burst right before a round closes costs a handful of
+# write transactions. Queued answers are written before a round is checked.
+# Only for a single server process.
+
+TRIVIA_SUBMISSION_QUEUE = False
+TRIVIA_SUBMISSION_FLUSH_MS = 10
+
+
+# ASGI threads
+# Under ASGI every Django request runs on a thread from this pool. With
+# TRIVIA_SQLITE_WRITE_LOCK on, writing requests wait for their turn before
+# they take one; it's off by default, so they just take one. Try
+# `python manage.py stress_asgi` before changing it.
+
+TRIVIA_ASGI_THREADS = 32
+
+
+# Background jobs
+# Auto checking a round and refreshing scores run on a worker thread in each
+# server process, queued in the Job table, so the trivia master's click
+# returns straight away. The game page shows how they're going. Turn this off
+# to do the work in the request instead. The worker also looks for jobs every
+# TRIVIA_JOBS_POLL seconds, so ones queued by another process or left behind
+# by a restart still get run.
+
+TRIVIA_BACKGROUND_JOBS = True
+TRIVIA_JOBS_POLL = 30
+
+
+# Verdict memo
+# Answers checked by hand, or accepted by the fuzzy check, are remembered
+# across games. The auto check accepts a response that was accepted before
+# for a question with the same answers. The cache size is how many verdicts
+# each process keeps in memory in front of the table. They're dropped whenever
+# any process saves a verdict.
+
+TRIVIA_VERDICT_MEMO = True
+TRIVIA_VERDICT_CACHE_SIZE = 10000
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 
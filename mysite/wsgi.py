@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
 
 application = get_wsgi_application()
+
+# Background jobs left queued or running by the last process get picked up
+from trivia import jobs  # noqa: E402
+
+jobs.start()
@@ -0,0 +1,52 @@
+'''
+Answer normalization.
+
+Answers and responses are stored alongside a normalized form so matching is
+a plain equality check the database can do with an index. Two answers match
+when they only differ by case, whitespace, punctuation, accents or a leading
+"the", "a" or "an". Points, commas and slashes between digits are kept, so
+3.14 doesn't match 314 and 1/2 doesn't match 12.
+'''
+import unicodedata
+
+ARTICLES = ('the', 'a', 'an')
+
+# Kept between two digits: decimals, thousands and fractions
+NUMBER_PUNCTUATION = '.,/'
+
+
+def _fold(text, i):
+    char = text[i]
+    if char in NUMBER_PUNCTUATION and 0 < i < len(text) - 1 and text[i - 1].isdigit() and text[i + 1].isdigit():
+        return char
+    category = unicodedata.category(char)
+    if category == 'Pd':
+        # dashes separate words
+        return ' '
+    if category.startswith('P') or unicodedata.combining(char):
+        return ''
+    return char
+
+
+def normalize(text, max_length=None):
+    if not text:
+        return ''
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(_fold(text, i) for i in range(len(text)))
+    words = text.casefold().split()
+    if len(words) > 1 and words[0] in ARTICLES:
+        words = words[1:]
+    return ' '.join(words)[:max_length]
+
+
+def split_alternatives(alt_answers):
+    '''The comma separated alt_answers field as a list.'''
+    if not alt_answers:
+        return []
+    return [answer.strip() for answer in alt_answers.split(',') if answer.strip()]
+
+
+def answer_keys(answer, alt_answers, max_length=None):
+    '''Distinct normalized forms of an answer and its alternatives.'''
+    keys = (normalize(text, max_length) for text in [answer] + split_alternatives(alt_answers))
+    return sorted({key for key in keys if key})
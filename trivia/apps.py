@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class TriviaConfig(AppConfig):
     name = 'trivia'
+
+    def ready(self):
+        # tunes every SQLite connection as it opens
+        from . import sqlite  # noqa: F401
@@ -0,0 +1,317 @@
+'''
+Benchmarks for scoring, grading and the pages that get slow as games get big.
+
+Everything runs against a throwaway test database filled by make_game(), so
+it's safe to run anywhere with:
+
+    python manage.py benchmark
+
+Each measurement records the median wall time, the number of queries and the
+peak memory allocated while it ran. Results can be written out as JSON and
+compared against a stored baseline; see the benchmark command.
+'''
+import random
+import statistics
+import time
+import tracemalloc
+from collections import namedtuple
+from datetime import timedelta
+from urllib.parse import urlencode
+
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import memo, scoreboard, state
+from .answers import normalize
+from .models import (
+    AcceptedAnswer, DoubleRound, FinalAnswer, FinalRound, Game, Question, QuestionResponse, Round,
+)
+from .scoring import rebuild_scores
+from .views import check_answers_func, encode_cursor
+
+Result = namedtuple('Result', ['name', 'seconds', 'queries', 'peak_kb'])
+
+# What players write when they know it, and when they don't
+RIGHT = ['{answer}', '{lower}', 'the {answer}', '{answer}!', '{answer}s']
+WRONG = ['no idea', 'pass', 'something else', 'guess {n}', '{answer} jr', 'not {answer}']
+
+
+def _with_ids(model, objs, **owner):
+    model.objects.bulk_create(objs, batch_size=500)
+    if objs and objs[0].pk is None:
+        for obj, pk in zip(objs, model.objects.filter(**owner).order_by('pk').values_list('pk', flat=True)):
+            obj.pk = pk
+    return objs
+
+
+def make_game(players=50, rounds=6, questions=10, open_round=True, seed=0):
+    '''
+    A game built with bulk inserts and scored like a real one. Each player has
+    a skill and each question an ease, and the chance of a right answer is
+    their product. Right answers come in the spellings people actually use,
+    so only some match exactly. Every round is graded and closed except the
+    last, which is left in Check Answers when open_round is set. Most players
+    double a round, usually a later one, and wagers in the closed final round
+    range from nothing to everything.
+    '''
+    rnd = random.Random(seed)
+    game = Game.objects.create(game_title=f'Benchmark {players}x{rounds}x{questions}', pub_date=timezone.now())
+    prefix = f'bench{game.id}_'
+    User.objects.bulk_create([User(username=f'{prefix}{i}') for i in range(players)])
+    users = list(User.objects.filter(username__startswith=prefix).order_by('id'))
+    game.player.set(users)
+    round_objs = _with_ids(Round, [
+        Round(category=f'Round {i}', game=game, status='2' if open_round and i == rounds - 1 else '3')
+        for i in range(rounds)
+    ], game=game)
+    question_objs = _with_ids(Question, [
+        Question(
+            round=round_obj, question=f'{round_obj} question {i}', answer=f'Answer {round_obj.id}-{i}',
+            alt_answers=f'Alt {round_obj.id}-{i}' if rnd.random() < 0.3 else None,
+            points=rnd.choice([1, 2, 2, 2, 3]),
+        )
+        for round_obj in round_objs for i in range(questions)
+    ], round__game=game)
+    AcceptedAnswer.objects.bulk_create(
+        [answer for question in question_objs for answer in AcceptedAnswer.build(question=question)],
+        batch_size=500,
+    )
+    skill = {user.id: rnd.betavariate(5, 3) for user in users}
+    responses = []
+    for question in question_objs:
+        ease = rnd.betavariate(4, 2)
+        graded = question.round.status == '3'
+        for user in users:
+            if rnd.random() > 0.95:
+                continue
+            right = rnd.random() < skill[user.id] * ease
+            text = rnd.choice(RIGHT if right else WRONG).format(
+                answer=question.answer, lower=question.answer.lower(), n=rnd.randint(0, 99)
+            )
+            responses.append(QuestionResponse(
+                question=question, player=user, response=text, normalized_response=normalize(text, 150),
+                correct=graded and right,
+            ))
+    QuestionResponse.objects.bulk_create(responses, batch_size=500)
+    DoubleRound.objects.bulk_create([
+        DoubleRound(player=user, game=game, round=rnd.choices(round_objs, range(1, rounds + 1))[0])
+        for user in users if rnd.random() < 0.85
+    ])
+    final_round = FinalRound.objects.create(
+        game=game, category='Final', question='Final question', answer='Final answer', status='4',
+    )
+    FinalAnswer.objects.bulk_create([
+        FinalAnswer(
+            finalround=final_round, player=user, answer='final answer', correct=rnd.random() < 0.45,
+            wager=rnd.choice([0, questions * rounds, rnd.randint(0, questions * rounds)]),
+        )
+        for user in users if rnd.random() < 0.9
+    ])
+    rebuild_scores(game)
+    return game
+
+
+def make_history(games, players=50, played=0.1, seed=0):
+    '''Bare games a day apart, each with a random share of the players in it.'''
+    rnd = random.Random(seed)
+    start = timezone.now() - timedelta(days=games)
+    first = Game.objects.count()
+    Game.objects.bulk_create([
+        Game(game_title=f'History {i}', pub_date=start + timedelta(days=i), completed=rnd.random() < 0.9)
+        for i in range(games)
+    ], batch_size=500)
+    game_ids = list(Game.objects.order_by('id').values_list('id', flat=True)[first:])
+    prefix = f'history{first}_'
+    User.objects.bulk_create([User(username=f'{prefix}{i}') for i in range(players)])
+    user_ids = list(User.objects.filter(username__startswith=prefix).values_list('id', flat=True))
+    Game.player.through.objects.bulk_create([
+        Game.player.through(game_id=game_id, user_id=user_id)
+        for game_id in game_ids for user_id in user_ids
+        if rnd.random() < played
+    ], batch_size=500)
+    return User.objects.get(id=user_ids[0])
+
+
+def forget():
+    '''Drop everything cached between requests, so the next call starts cold.'''
+    caches[scoreboard.CACHE_ALIAS].clear()
+    with state._lock:
+        state._states.clear()
+    memo.memo.clear()
+
+
+def measure(name, func, repeat=5, setup=None):
+    '''
+    Median time over repeat calls of func, each inside a transaction that is
+    rolled back so anything it writes is undone. Queries and peak memory come
+    from one more call with tracemalloc on, kept out of the timings.
+    '''
+    def call():
+        if setup:
+            setup()
+        with transaction.atomic():
+            func()
+            transaction.set_rollback(True)
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call()
+        timings.append(time.perf_counter() - start)
+    with CaptureQueriesContext(connection) as queries:
+        tracemalloc.start()
+        try:
+            call()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return Result(name, statistics.median(timings), len(queries), round(peak / 1024))
+
+
+def get(client, url):
+    '''A page load for measure() that fails if the page does.'''
+    def func():
+        response = client.get(url)
+        assert response.status_code == 200, f'{url} returned {response.status_code}'
+    return func
+
+
+def wager_check(final_answer_id):
+    '''Validating a wager the way a wager form does, with the final round's max wager off.'''
+    def func():
+        final_answer = FinalAnswer.objects.select_related('finalround').get(id=final_answer_id)
+        final_answer.finalround.max_wager = 0
+        final_answer.wager = 0
+        final_answer.clean()
+    return func
+
+
+def login(user):
+    client = Client()
+    client.force_login(user)
+    return client
+
+
+def staff_client():
+    staff, _ = User.objects.get_or_create(username='bench_staff', defaults={'is_staff': True})
+    return login(staff)
+
+
+# The benchmarks ##########################################
+# Each takes the (players, rounds, questions) to generate and the number of
+# repeats, and returns a list of Results.
+
+def whole_game(size=(50, 6, 10), repeat=5):
+    '''Scoring, grading and every game page for one generated game.'''
+    players, rounds, questions = size
+    game = make_game(players, rounds, questions)
+    label = f'{players}x{rounds}x{questions}'
+    round_ids = list(game.round_set.order_by('id').values_list('id', flat=True))
+    closed_round, open_round = round_ids[0], round_ids[-1]
+    final_answer = FinalAnswer.objects.filter(finalround__game=game).order_by('id').first()
+    staff = staff_client()
+    game_detail = get(staff, reverse('trivia:game_detail', args=[game.id]))
+
+    return [
+        measure(f'score_game {label}', lambda: Game.objects.get(id=game.id).score_game(), repeat),
+        measure(f'score_table {label}', lambda: Game.objects.get(id=game.id).score_table(), repeat),
+        measure(f'check_answers_func {label}', lambda: check_answers_func(open_round), repeat),
+        measure(f'game_detail cold {label}', game_detail, repeat, setup=forget),
+        measure(f'game_detail warm {label}', game_detail, repeat),
+        measure(
+            f'round_review {label}', get(staff, reverse('trivia:round_review', args=[closed_round])), repeat,
+            setup=forget,
+        ),
+        measure(f'check_answers {label}', get(staff, reverse('trivia:check_answers', kwargs={
+            'game': game.id, 'round': open_round, 'player': final_answer.player_id,
+        })), repeat, setup=forget),
+    ]
+
+
+def round_review(size=(50, 1, 15), repeat=5):
+    '''The round review page as the round grows, to show it stays linear.'''
+    players, _, questions = size
+    staff = staff_client()
+    results = []
+    for scale in (1, 2, 4):
+        round_id = make_game(players * scale, 1, questions, open_round=False).round_set.get().id
+        results.append(measure(
+            f'round_review {players * scale}x{questions}',
+            get(staff, reverse('trivia:round_review', args=[round_id])), repeat, setup=forget,
+        ))
+    return results
+
+
+def wagers(size=(50, 6, 10), repeat=5):
+    '''Wager validation as the game grows, to show it doesn't.'''
+    players, rounds, questions = size
+    results = []
+    for scale in (1, 2, 4):
+        game = make_game(players * scale, rounds, questions * scale)
+        final_answer = FinalAnswer.objects.filter(finalround__game=game).order_by('id').first()
+        results.append(measure(
+            f'final_clean {players * scale}x{rounds}x{questions * scale}', wager_check(final_answer.id), repeat,
+        ))
+    return results
+
+
+def game_list(size=None, repeat=5):
+    '''The first and a deep page of the game list, filtered and not, as history grows.'''
+    results = []
+    total = 0
+    for games in (1000, 20000):
+        client = login(make_history(games - total))
+        total = games
+        deep = encode_cursor(Game.objects.all()[games * 9 // 10])
+        for label, query in [
+            ('first', {}),
+            ('deep', {'after': deep}),
+            ('completed', {'completed': '1', 'after': deep}),
+            ('mine', {'mine': '1', 'after': deep}),
+        ]:
+            results.append(measure(
+                f'game_list {games} {label}', get(client, f'{reverse("trivia:games")}?{urlencode(query)}'), repeat,
+            ))
+    return results
+
+
+BENCHMARKS = {
+    'game': whole_game,
+    'round_review': round_review,
+    'wagers': wagers,
+    'game_list': game_list,
+}
+
+
+def as_json(results):
+    return {
+        result.name: {'ms': round(result.seconds * 1000, 2), 'queries': result.queries, 'peak_kb': result.peak_kb}
+        for result in results
+    }
+
+
+def compare(results, baseline, tolerance=0.25, slack_ms=2):
+    '''
+    Regressions against a baseline from as_json(), as messages. Any extra
+    query counts, and so does time or memory more than tolerance over the
+    baseline; time also has to be slack_ms worse so the quick benchmarks
+    don't trip on noise. Benchmarks missing from either side are skipped.
+    '''
+    regressions = []
+    for result in results:
+        base = baseline.get(result.name)
+        if base is None:
+            continue
+        ms = result.seconds * 1000
+        if result.queries > base['queries']:
+            regressions.append(f'{result.name}: {result.queries} queries, baseline {base["queries"]}')
+        if ms > base['ms'] * (1 + tolerance) and ms - base['ms'] > slack_ms:
+            regressions.append(f'{result.name}: {ms:.1f} ms, baseline {base["ms"]:.1f} ms')
+        if result.peak_kb > base['peak_kb'] * (1 + tolerance):
+            regressions.append(f'{result.name}: {result.peak_kb} KB peak, baseline {base["peak_kb"]} KB')
+    return regressions
@@ -0,0 +1,268 @@
+'''
+Game results streamed out as CSV or JSON lines.
+
+There are three exports: every game's scores by player and round, every
+response to every question, and the final round wagers. Each one can be
+narrowed to some games or a range of dates. Rows are read with .iterator(),
+CHUNK_ROWS at a time, and written out a chunk at a time, so memory stays the
+same for one game or years of them.
+
+Under WSGI the export view streams with a StreamingHttpResponse. Django 3.0
+under ASGI iterates streaming responses on the event loop, where the ORM
+isn't allowed, so router() serves the export URLs before Django does, like
+the live scoreboard streams. It checks the session in a thread, then runs the
+export on a thread from the pool and sends each chunk as it comes. Only a few
+chunks wait in between, so a slow client slows the export down instead of
+piling it up in memory. If the export fails part way, the response is
+aborted rather than ended, so nobody mistakes a short file for the whole
+thing.
+'''
+import asyncio
+import csv
+import io
+import json
+import logging
+import re
+import threading
+from itertools import islice
+from concurrent.futures import TimeoutError as FutureTimeout
+from datetime import date
+from urllib.parse import parse_qs, urlencode
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce
+from django.shortcuts import resolve_url
+
+from .live import is_staff as _staff
+from .models import FinalAnswer, Game, QuestionResponse, Score
+
+CHUNK_ROWS = 2000
+# Chunks read ahead of a slow client under ASGI
+QUEUE_CHUNKS = 4
+
+FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+}
+
+# Handed over in place of the end of the export when it went wrong
+FAILED = object()
+
+EXPORT_PATH = re.compile(r'^/manage/export/(?P<kind>[\w-]+)\.(?P<fmt>[\w-]+)$')
+
+log = logging.getLogger(__name__)
+
+
+def _scores(game_id):
+    return Score.objects.filter(game_id=game_id).order_by(
+        'player_id', F('round_id').asc(nulls_last=True),
+    ).values_list(
+        'game_id', 'player_id', 'player__username', 'round_id', Coalesce('round__category', Value('Final Round')),
+        'points', 'multiplier', F('points') * F('multiplier'),
+    )
+
+
+def _responses(game_id):
+    return QuestionResponse.objects.filter(question__round__game_id=game_id).order_by(
+        'player_id', 'question__round_id', 'question_id',
+    ).values_list(
+        'question__round__game_id', 'question__round_id', 'question__round__category', 'question_id',
+        'question__question', 'question__answer', 'question__points', 'player_id', 'player__username',
+        'response', 'correct', 'confidence',
+    )
+
+
+def _wagers(game_id):
+    return FinalAnswer.objects.filter(finalround__game_id=game_id).order_by('player_id', 'finalround_id').values_list(
+        'finalround__game_id', 'finalround_id', 'finalround__category', 'player_id', 'player__username',
+        'wager', 'answer', 'correct',
+    )
+
+
+# kind: (column names, rows for one game). Rows start with the game id, and
+# the game's title and date are filled in after it. Games are exported one at
+# a time in id order, each sorted by player and round: sorting everything at
+# once would make SQLite sort every row before sending the first.
+KINDS = {
+    'scores': ([
+        'game_id', 'game', 'game_date', 'player_id', 'player', 'round_id', 'round', 'points', 'multiplier',
+        'score',
+    ], _scores),
+    'responses': ([
+        'game_id', 'game', 'game_date', 'round_id', 'round', 'question_id', 'question', 'answer', 'points',
+        'player_id', 'player', 'response', 'correct', 'confidence',
+    ], _responses),
+    'wagers': ([
+        'game_id', 'game', 'game_date', 'final_round_id', 'final_round', 'player_id', 'player', 'wager',
+        'answer', 'correct',
+    ], _wagers),
+}
+
+
+def games(game_ids=(), since=None, until=None):
+    '''
+    The games to export: the given ids, or all of them, published between
+    since and until (dates, both included) if given.
+    '''
+    games = Game.objects.all()
+    if game_ids:
+        games = games.filter(id__in=game_ids)
+    if since:
+        games = games.filter(pub_date__date__gte=since)
+    if until:
+        games = games.filter(pub_date__date__lte=until)
+    return games.values('id')
+
+
+def games_from_query(query):
+    '''games() from a query string's game, since and until; ValueError if they don't parse.'''
+    return games(
+        [int(game_id) for game_id in query.get('game', [])],
+        since=date.fromisoformat(query['since'][0]) if query.get('since') else None,
+        until=date.fromisoformat(query['until'][0]) if query.get('until') else None,
+    )
+
+
+def _batches(rows):
+    rows = iter(rows)
+    batch = list(islice(rows, CHUNK_ROWS))
+    while batch:
+        yield batch
+        batch = list(islice(rows, CHUNK_ROWS))
+
+
+def _csv_chunks(columns, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for batch in _batches(rows):
+        writer.writerows(batch)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def _jsonl_chunks(columns, rows):
+    dumps = json.JSONEncoder(default=str).encode
+    for batch in _batches(rows):
+        yield ''.join(dumps(dict(zip(columns, row))) + '\n' for row in batch)
+
+
+def _rows(query, games):
+    # joining the game into every row would parse and format its date a
+    # million times
+    titles = {
+        game.id: (game.game_title, game.pub_date.isoformat())
+        for game in Game.objects.filter(id__in=games).order_by('id')
+    }
+    for game_id, title in titles.items():
+        for row in query(game_id).iterator(chunk_size=CHUNK_ROWS):
+            yield (row[0], *title, *row[1:])
+
+
+def stream(kind, fmt, games):
+    '''The export as str chunks of CHUNK_ROWS rows; CSV starts with a header row.'''
+    columns, query = KINDS[kind]
+    rows = _rows(query, games)
+    if fmt == 'csv':
+        return _csv_chunks(columns, rows)
+    return _jsonl_chunks(columns, rows)
+
+
+def filename(kind, fmt):
+    return f'trivia-{kind}.{fmt}'
+
+
+# ASGI ####################################################
+
+async def _respond(send, status, headers=(), body=b''):
+    await send({'type': 'http.response.start', 'status': status, 'headers': list(headers)})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _disconnected(receive, stop):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+    stop.set()
+
+
+def _produce(chunks, queue, loop, stop):
+    '''Run the export in this thread, handing chunks over to the event loop.'''
+    def hand_over(item):
+        future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+        while not stop.is_set():
+            try:
+                return future.result(timeout=1)
+            except FutureTimeout:
+                pass
+        future.cancel()
+
+    end = None
+    try:
+        for chunk in chunks():
+            if stop.is_set():
+                return
+            hand_over(chunk.encode())
+    except Exception:
+        log.exception('Export failed')
+        end = FAILED
+    finally:
+        connection.close()
+        hand_over(end)
+
+
+async def serve(scope, receive, send, kind, fmt):
+    if kind not in KINDS or fmt not in FORMATS:
+        return await _respond(send, 404)
+    if not await sync_to_async(_staff)(scope):
+        login = resolve_url(settings.LOGIN_URL) + '?' + urlencode({'next': scope['path']})
+        return await _respond(send, 302, [(b'location', login.encode())])
+    try:
+        selected = games_from_query(parse_qs(scope['query_string'].decode('latin1')))
+    except ValueError as e:
+        return await _respond(send, 400, body=str(e).encode())
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(QUEUE_CHUNKS)
+    stop = threading.Event()
+    disconnect = asyncio.ensure_future(_disconnected(receive, stop))
+    producer = loop.run_in_executor(None, _produce, lambda: stream(kind, fmt, selected), queue, loop, stop)
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', FORMATS[fmt].encode()),
+                (b'content-disposition', f'attachment; filename="{filename(kind, fmt)}"'.encode()),
+            ],
+        })
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                break
+            if chunk is FAILED:
+                # never finish the body, so the client sees a broken download
+                # rather than a short file
+                raise RuntimeError('Export failed part way through')
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body'})
+    finally:
+        stop.set()
+        disconnect.cancel()
+        await producer
+
+
+def router(application):
+    '''Serve exports directly and pass every other request on.'''
+    async def export_application(scope, receive, send):
+        if scope['type'] == 'http' and scope['method'] == 'GET':
+            match = EXPORT_PATH.match(scope['path'])
+            if match:
+                return await serve(scope, receive, send, match['kind'], match['fmt'])
+        return await application(scope, receive, send)
+    return export_application
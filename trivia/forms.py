@@ -1,6 +1,7 @@
+from django import forms
 from django.forms import ModelForm
 
-from .models import FinalAnswer
+from .models import FinalAnswer, FinalRound, QuestionResponse, Round
 
 
 class FinalAnswerForm(ModelForm):
@@ -10,3 +11,106 @@ class FinalAnswerForm(ModelForm):
             'finalround',
             'player'
         ]
+
+
+class RoundAnswerForm(forms.Form):
+    '''A player's whole answer sheet for a round, one field per question.'''
+
+    def __init__(self, questions, responses=None, *args, disabled=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        responses = responses or {}
+        max_length = QuestionResponse._meta.get_field('response').max_length
+        self.questions = questions
+        for question in questions:
+            self.fields[self.field_name(question.id)] = forms.CharField(
+                label=question.question, max_length=max_length, required=False,
+                initial=responses.get(question.id), disabled=disabled,
+            )
+
+    @staticmethod
+    def field_name(question_id):
+        return f'question_{question_id}'
+
+    def rows(self):
+        '''(question, bound field) for each question, for the template.'''
+        return [(question, self[self.field_name(question.id)]) for question in self.questions]
+
+    def responses(self):
+        '''{question id: response} for every question that was answered.'''
+        return {
+            question.id: self.cleaned_data[self.field_name(question.id)]
+            for question in self.questions
+            if self.cleaned_data[self.field_name(question.id)]
+        }
+
+
+class RoundStatusForm(forms.Form):
+    '''Every round's status in a game, plus the final round's, changed together.'''
+
+    def __init__(self, rounds, final_round=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.round_list = rounds
+        for round in rounds:
+            self.fields[self.field_name(round.id)] = forms.ChoiceField(
+                label=round.category, choices=Round.STATUS_CHOICES, initial=round.status,
+            )
+        if final_round:
+            self.fields['final'] = forms.ChoiceField(
+                label=final_round.category, choices=FinalRound.STATUS_CHOICES, initial=final_round.status,
+            )
+
+    @staticmethod
+    def field_name(round_id):
+        return f'round_{round_id}'
+
+    def rows(self):
+        return [self[name] for name in self.fields]
+
+    def statuses(self):
+        '''{round id: status} for every round, changed or not.'''
+        return {round.id: self.cleaned_data[self.field_name(round.id)] for round in self.round_list}
+
+    def final_status(self):
+        return self.cleaned_data.get('final')
+
+
+class RoundCheckForm(forms.Form):
+    '''One checkbox per distinct answer in a round, covering everyone who gave it.'''
+
+    def __init__(self, groups, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.groups = groups
+        for question_groups in groups.values():
+            for group in question_groups:
+                self.fields[self.field_name(group.key)] = forms.BooleanField(
+                    label=group.response, required=False, initial=group.correct,
+                )
+
+    @staticmethod
+    def field_name(key):
+        return f'group_{key}'
+
+    def rows(self, questions):
+        '''(question, [(group, bound field)]) for each question, for the template.'''
+        return [
+            (question, [(group, self[self.field_name(group.key)]) for group in self.groups.get(question.id, [])])
+            for question in questions
+        ]
+
+    def entries(self):
+        '''(question id, normalized response, correct) for the checkboxes that changed.'''
+        changed = set(self.changed_data)
+        return [
+            (group.question_id, group.responses[0].normalized_response, self.cleaned_data[self.field_name(group.key)])
+            for question_groups in self.groups.values() for group in question_groups
+            if self.field_name(group.key) in changed
+        ]
+
+    def verdicts(self):
+        '''{group key: correct} for the checkboxes that changed.'''
+        changed = set(self.changed_data)
+        return {
+            group.key: self.cleaned_data[self.field_name(group.key)]
+            for question_groups in self.groups.values() for group in question_groups
+            if self.field_name(group.key) in changed
+        }
@@ -0,0 +1,99 @@
+'''
+Fuzzy answer matching for a whole round in one vectorized pass.
+
+Every normalized response and accepted answer is turned into a vector of
+hashed character trigram counts. A single matrix product then gives the
+cosine similarity of every response against every answer, and each response
+keeps its best score against its own question's answers. That score is the
+confidence stored on the response.
+
+Hashed trigrams can't tell 1000000 from 10000000, or Henry VII from Henry
+VIII, so a high score alone doesn't accept anything. close_enough() also
+wants the same numbers, written in digits or roman numerals, and only a few
+edits between the response and the answer.
+
+Needs numpy, which is only required when TRIVIA_FUZZY_GRADING is on.
+'''
+import re
+import zlib
+
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DIMENSIONS = 1024
+# At most this share of the answer's characters may be edited, and at least one
+MAX_EDIT_RATIO = 0.25
+
+NUMBER = re.compile(r'\d+(?:[.,/]\d+)*')
+ROMAN = re.compile(r'm{0,3}(cm|cd|d?c{0,3})(xc|xl|l?x{0,3})(ix|iv|v?i{0,3})')
+
+
+def _trigrams(text):
+    padded = f' {text} '
+    return [padded[i:i + 3] for i in range(max(1, len(padded) - 2))]
+
+
+def _vectors(texts):
+    '''Unit length trigram count vectors, one row per text.'''
+    rows, columns = [], []
+    for row, text in enumerate(texts):
+        grams = _trigrams(text)
+        rows.extend([row] * len(grams))
+        columns.extend(zlib.crc32(gram.encode()) % DIMENSIONS for gram in grams)
+    matrix = np.zeros((len(texts), DIMENSIONS), dtype=np.float32)
+    np.add.at(matrix, (rows, columns), 1)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def best_similarity(responses, response_questions, answers, answer_questions):
+    '''
+    For each response, its highest similarity (0 to 1) to any accepted answer
+    for the same question, and the index of that answer. The *_questions
+    lists give the question id of each response and answer.
+    '''
+    if np is None:
+        raise ImproperlyConfigured('Fuzzy grading needs numpy installed.')
+    if not responses or not answers:
+        return np.zeros(len(responses), dtype=np.float32), np.zeros(len(responses), dtype=np.intp)
+    scores = _vectors(responses) @ _vectors(answers).T
+    other_question = np.asarray(response_questions)[:, None] != np.asarray(answer_questions)[None, :]
+    scores[other_question] = 0
+    best = scores.argmax(axis=1)
+    return np.clip(scores[np.arange(len(responses)), best], 0, 1), best
+
+
+def numbers(text):
+    '''The numbers in a normalized text, in digits or roman numerals, in order.'''
+    return [word for word in text.split() if NUMBER.fullmatch(word) or ROMAN.fullmatch(word)]
+
+
+def edit_distance(a, b, limit):
+    '''Levenshtein distance between a and b, or limit + 1 once it's over limit.'''
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char in enumerate(a, 1):
+        current = [i]
+        for j, other in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char != other)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+def close_enough(response, answer):
+    '''
+    Whether a response that scored high against an answer can be accepted
+    without anyone looking at it: same numbers, and only a few edits apart.
+    '''
+    if numbers(response) != numbers(answer):
+        return False
+    limit = max(1, int(len(answer) * MAX_EDIT_RATIO))
+    return edit_distance(response, answer, limit) <= limit
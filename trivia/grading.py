@@ -0,0 +1,235 @@
+'''
+Automatic answer checking for a whole round at once.
+
+Responses and accepted answers are stored with their normalized forms (see
+trivia.answers), so the matching is a single indexed join done by the
+database, and the verdicts go back in one UPDATE. Anything that doesn't match
+is left for the players to check by hand.
+
+With TRIVIA_FUZZY_GRADING on, whatever is left after the exact match is
+scored against its question's answers in one vectorized pass (trivia.fuzzy).
+Close enough responses are accepted, near misses are flagged to be checked
+first, and every score is kept as the response's confidence. With
+TRIVIA_VERDICT_MEMO on, verdicts from earlier games are applied before the
+fuzzy check (trivia.memo). Only verdicts given by hand are remembered.
+
+What's left is checked by hand. response_groups() collapses a round's
+responses by question and normalized response, so the players checking it
+mark each distinct answer once, and mark_groups() saves their verdicts in one
+UPDATE.
+'''
+import logging
+from collections import Counter, namedtuple
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, Exists, F, IntegerField, OuterRef, Q, Sum, Value, When
+
+from . import fuzzy, memo
+from .models import AcceptedAnswer, Question, QuestionResponse, Round
+from .scoreboard import changed
+from .scoring import record_points
+from .sqlite import begin_writing
+
+FUZZY_GRADING = getattr(settings, 'TRIVIA_FUZZY_GRADING', False)
+FUZZY_ACCEPT = getattr(settings, 'TRIVIA_FUZZY_ACCEPT', 0.85)
+FUZZY_REVIEW = getattr(settings, 'TRIVIA_FUZZY_REVIEW', 0.5)
+
+log = logging.getLogger(__name__)
+
+# remembered is how many were accepted from earlier verdicts, out of
+# memo_hits known verdicts for memo_lookups responses looked up
+GradeReport = namedtuple(
+    'GradeReport', ['accepted', 'review', 'flagged', 'remembered', 'memo_hits', 'memo_lookups'],
+    defaults=[0, 0, 0, 0],
+)
+
+# Everyone who gave the same answer to a question. key names it in forms,
+# response is how the first of them spelled it.
+ResponseGroup = namedtuple('ResponseGroup', ['key', 'question_id', 'response', 'responses', 'correct', 'flagged'])
+
+
+def flagged():
+    '''Responses the fuzzy check thought were close but not close enough.'''
+    return Q(correct=False, confidence__gte=FUZZY_REVIEW, confidence__lt=FUZZY_ACCEPT)
+
+
+def flagged_first(queryset):
+    return queryset.annotate(
+        review_order=Case(When(flagged(), then=Value(0)), default=Value(1), output_field=IntegerField())
+    ).order_by('review_order', 'id')
+
+
+def grade_message(report):
+    message = f'Auto check accepted {report.accepted} answers and left {report.review} for review'
+    if report.flagged:
+        message += f' ({report.flagged} flagged as close)'
+    message += '.'
+    if report.memo_lookups:
+        message += (
+            f' {report.remembered} were accepted from earlier checks; {report.memo_hits} of'
+            f' {report.memo_lookups} answers looked up had been checked before'
+            f' ({report.memo_hits / report.memo_lookups:.0%}).'
+        )
+    return message
+
+
+def matching_responses(round_id):
+    '''Unchecked responses in the round that match one of their question's accepted answers.'''
+    return QuestionResponse.objects.filter(
+        Exists(AcceptedAnswer.objects.filter(
+            question_id=OuterRef('question_id'), normalized=OuterRef('normalized_response'),
+        )),
+        question__round_id=round_id, correct=False,
+    )
+
+
+def grade_round(round_id, fuzzy_grading=None):
+    '''
+    Mark every response in the round that matches an accepted answer as
+    correct. Returns how many were accepted, how many are left for review and
+    how many of those the fuzzy check flagged.
+    '''
+    if fuzzy_grading is None:
+        fuzzy_grading = FUZZY_GRADING
+    game_id = Round.objects.values_list('game_id', flat=True).get(id=round_id)
+    with transaction.atomic():
+        begin_writing()
+        unchecked = QuestionResponse.objects.filter(question__round_id=round_id, correct=False).count()
+        matches = matching_responses(round_id)
+        deltas = Counter({
+            (player_id, round_id): points
+            for player_id, points in matches.values_list('player_id').annotate(
+                points=Sum('question__points')
+            ).order_by()
+        })
+        accepted = matches.update(correct=True, confidence=1.0)
+        known = memo.Pregrade(0, set(), {}, 0, 0)
+        if memo.ENABLED:
+            known = memo.pregrade(round_id)
+            accepted += known.accepted
+            deltas.update(known.deltas)
+        flagged_count = 0
+        if fuzzy_grading:
+            fuzzy_accepted, flagged_count, fuzzy_deltas = fuzzy_grade_round(round_id, skip=known.rejected)
+            accepted += fuzzy_accepted
+            deltas.update(fuzzy_deltas)
+        changed(game_id)
+        record_points(game_id, deltas)
+    report = GradeReport(
+        accepted, unchecked - accepted, flagged_count, known.accepted, known.hits, known.lookups,
+    )
+    log.info('Auto checked round %s: %s', round_id, report)
+    return report
+
+
+def fuzzy_grade_round(round_id, skip=()):
+    '''
+    Score the round's unchecked responses, apart from the ids in skip, against
+    their question's answers and write every verdict back with one
+    executemany. Only close enough ones are accepted (see fuzzy.close_enough),
+    and they aren't remembered, so a wrong accept stays in this round.
+    '''
+    responses = list(
+        QuestionResponse.objects
+        .filter(question__round_id=round_id, correct=False)
+        .exclude(id__in=skip)
+        .values_list('id', 'player_id', 'question_id', 'normalized_response')
+    )
+    answers = list(
+        AcceptedAnswer.objects.filter(question__round_id=round_id).values_list('question_id', 'normalized')
+    )
+    points = dict(Question.objects.filter(round_id=round_id).values_list('id', 'points'))
+    scores, best = fuzzy.best_similarity(
+        [normalized for _, _, _, normalized in responses], [question_id for _, _, question_id, _ in responses],
+        [normalized for _, normalized in answers], [question_id for question_id, _ in answers],
+    )
+    deltas = Counter()
+    verdicts = []
+    accepted = flagged_count = 0
+    for (response_id, player_id, question_id, normalized), score, answer in zip(
+        responses, scores.tolist(), best.tolist(),
+    ):
+        correct = score >= FUZZY_ACCEPT and fuzzy.close_enough(normalized, answers[answer][1])
+        if correct:
+            deltas[(player_id, round_id)] += points[question_id]
+            accepted += 1
+        elif score >= FUZZY_REVIEW:
+            flagged_count += 1
+        verdicts.append((correct, round(score, 3), response_id))
+    # bulk_update() would build a CASE per row; one prepared UPDATE run for
+    # every row is a lot cheaper for a whole round
+    quote = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f'UPDATE {quote(QuestionResponse._meta.db_table)} SET {quote("correct")} = %s, '
+            f'{quote("confidence")} = %s WHERE {quote("id")} = %s',
+            verdicts,
+        )
+    return accepted, flagged_count, deltas
+
+
+def _round_responses(round_id, exclude_player=None):
+    responses = QuestionResponse.objects.filter(question__round_id=round_id).only(
+        'id', 'question_id', 'player_id', 'response', 'normalized_response', 'correct', 'confidence',
+    ).annotate(points=F('question__points')).order_by('id')
+    if exclude_player is not None:
+        responses = responses.exclude(player_id=exclude_player)
+    return responses
+
+
+def response_groups(round_id, exclude_player=None):
+    '''
+    {question id: [ResponseGroup]} for a round, leaving out exclude_player's
+    own responses. Within a question, groups the fuzzy check flagged come
+    first, then the most common answers.
+    '''
+    collapsed = {}
+    for response in _round_responses(round_id, exclude_player):
+        collapsed.setdefault((response.question_id, response.normalized_response), []).append(response)
+    groups = {}
+    for (question_id, _), responses in collapsed.items():
+        groups.setdefault(question_id, []).append(ResponseGroup(
+            key=f'{question_id}_{responses[0].id}',
+            question_id=question_id,
+            response=responses[0].response,
+            responses=responses,
+            correct=all(response.correct for response in responses),
+            flagged=any(
+                not response.correct and response.confidence is not None
+                and FUZZY_REVIEW <= response.confidence < FUZZY_ACCEPT
+                for response in responses
+            ),
+        ))
+    for question_groups in groups.values():
+        question_groups.sort(key=lambda group: (not group.flagged, -len(group.responses), group.responses[0].id))
+    return groups
+
+
+def mark_groups(round_id, verdicts, exclude_player=None):
+    '''
+    Mark every response in each group as right or wrong, given as {group key:
+    correct}, in one UPDATE, and move the scores to match. The groups are
+    read again under the write lock so the score changes can't be counted
+    twice. Returns how many responses changed.
+    '''
+    game_id = Round.objects.values_list('game_id', flat=True).get(id=round_id)
+    with transaction.atomic():
+        begin_writing()
+        changed_responses = []
+        deltas = Counter()
+        for question_groups in response_groups(round_id, exclude_player).values():
+            for group in question_groups:
+                if group.key not in verdicts:
+                    continue
+                for response in group.responses:
+                    if response.correct != verdicts[group.key]:
+                        response.correct = verdicts[group.key]
+                        changed_responses.append(response)
+                        sign = 1 if response.correct else -1
+                        deltas[(response.player_id, round_id)] += sign * response.points
+        QuestionResponse.objects.bulk_update(changed_responses, ['correct'])
+        if changed_responses:
+            changed(game_id)
+            record_points(game_id, deltas)
+    return len(changed_responses)
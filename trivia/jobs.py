@@ -0,0 +1,183 @@
+'''
+Grading and score refreshes run in the background instead of in the request.
+
+A job is a row in the Job table, so it outlives the request that asked for
+it and shows up on the game page while it's queued, running, and for a while
+after it's done. Only one job per key (one auto check per round, one score
+refresh per game) can be queued or running at a time, so a trivia master
+clicking Check Answers again gets the job that's already there.
+
+Each server process runs one worker thread, started with the process (see
+start()) or when a job is first queued. SQLite only takes one writer at a
+time, so more threads wouldn't help. The thread claims queued jobs oldest
+first with an UPDATE that only one process can win, so any number of server
+processes can share the table. It's woken when this process queues a job,
+and otherwise looks every POLL seconds, which picks up jobs queued by other
+processes or left behind by a restart. A job still Running after STALE has
+had its process die under it. The next look puts it back in the queue, and
+queueing the same work again before that marks it failed and starts over.
+
+With TRIVIA_BACKGROUND_JOBS off, the views do the work in the request as
+before.
+'''
+import logging
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+
+from . import live, scoreboard, submissions
+from .grading import grade_message, grade_round
+from .models import Game, Job
+from .scoring import rebuild_scores
+
+ENABLED = getattr(settings, 'TRIVIA_BACKGROUND_JOBS', False)
+
+STALE = timedelta(minutes=10)
+# Seconds between looks for jobs nobody woke the worker for
+POLL = getattr(settings, 'TRIVIA_JOBS_POLL', 30)
+# How long finished jobs stay on the game page
+RECENT = timedelta(minutes=10)
+
+log = logging.getLogger(__name__)
+
+
+def _grade(job):
+    # queued answers have to be in before anything is checked
+    submissions.flush()
+    return grade_message(grade_round(job.round_id))
+
+
+def _scores(job):
+    rebuild_scores(Game.objects.get(id=job.game_id))
+    scoreboard.bump(job.game_id)
+    return 'Scores rebuilt from the answers.'
+
+
+# kind: function doing the work and returning the message shown for it
+KINDS = {
+    'grade': _grade,
+    'scores': _scores,
+}
+
+
+def enqueue(kind, game_id, round_id=None):
+    '''
+    Queue a job, or return the one already queued or running for the same
+    work. The worker is woken when the transaction commits.
+    '''
+    key = f'{kind}:{round_id or game_id}'
+    with transaction.atomic():
+        job = Job.objects.filter(key=key, status__in=Job.ACTIVE).first()
+        if job and job.status == '1' and job.started < timezone.now() - STALE:
+            Job.objects.filter(id=job.id).update(status='3', message='Abandoned.', finished=timezone.now())
+            job = None
+        if job is None:
+            try:
+                with transaction.atomic():
+                    job = Job.objects.create(kind=kind, key=key, game_id=game_id, round_id=round_id)
+                scoreboard.bump(game_id)
+            except IntegrityError:
+                # someone else queued it first
+                job = Job.objects.get(key=key, status__in=Job.ACTIVE)
+    transaction.on_commit(runner.wake)
+    return job
+
+
+def start():
+    '''Start this process's worker, which first runs whatever is already queued.'''
+    if ENABLED:
+        runner.wake()
+
+
+def grade(round_id, game_id):
+    return enqueue('grade', game_id, round_id)
+
+
+def refresh_scores(game_id):
+    return enqueue('scores', game_id)
+
+
+def for_game(game_id):
+    '''The game's jobs that are queued, running or recently finished, newest first.'''
+    return list(
+        Job.objects.select_related('game', 'round')
+        .filter(game_id=game_id)
+        .exclude(finished__lt=timezone.now() - RECENT)
+        .order_by('-id')[:10]
+    )
+
+
+def _publish(job):
+    # staff see the game's jobs with its cached scoreboard
+    scoreboard.bump(job.game_id)
+    # job messages can carry error text, so only staff pages get them
+    live.publish(
+        job.game_id, 'job', staff_only=True, id=job.id, label=str(job), status=job.status,
+        status_label=job.get_status_display(), message=job.message,
+    )
+
+
+class JobRunner:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def wake(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='trivia-jobs', daemon=True)
+                    self._thread.start()
+        self._wake.set()
+
+    def claim(self):
+        '''The oldest queued job, now marked Running, or None.'''
+        # whoever was running these died under them
+        Job.objects.filter(status='1', started__lt=timezone.now() - STALE).update(status='0', started=None)
+        while True:
+            job = Job.objects.filter(status='0').order_by('id').first()
+            if job is None:
+                return None
+            now = timezone.now()
+            if Job.objects.filter(id=job.id, status='0').update(status='1', started=now):
+                job.status, job.started = '1', now
+                return job
+
+    def run(self, job):
+        _publish(job)
+        try:
+            job.message, job.status = KINDS[job.kind](job), '2'
+        except Exception as e:
+            log.exception('Job %s failed', job.id)
+            job.message, job.status = str(e)[:200], '3'
+        job.finished = timezone.now()
+        Job.objects.filter(id=job.id).update(status=job.status, message=job.message, finished=job.finished)
+        _publish(job)
+
+    def run_pending(self):
+        '''Run queued jobs in this thread until there are none; returns how many.'''
+        count = 0
+        job = self.claim()
+        while job is not None:
+            self.run(job)
+            count += 1
+            job = self.claim()
+        return count
+
+    def _run(self):
+        while True:
+            self._wake.wait(POLL)
+            self._wake.clear()
+            try:
+                self.run_pending()
+            except Exception:
+                log.exception('Running jobs failed')
+            finally:
+                connection.close()
+
+
+runner = JobRunner()
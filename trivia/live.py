@@ -0,0 +1,182 @@
+'''
+Live scoreboard updates pushed to game_detail.html as server-sent events.
+
+Changes are published once, after their transaction commits, to an
+in-process Broadcaster that fans them out to every connected page for that
+game. The event stream itself is a plain ASGI app mounted in front of Django
+in mysite/asgi.py, so each open page costs a queue and a coroutine rather
+than a worker thread. Run a single ASGI process: a change only reaches the
+pages connected to the process that made it.
+
+Every event carries the scoreboard version it moved the game to (see
+trivia.scoreboard), and every version bump is sent, with an event of its own
+if nothing else came with it. The page knows the version it was rendered
+from, so it skips events it already shows and reloads when it sees one was
+missed. Job events are only sent to staff; everyone else gets just the
+version.
+
+Under WSGI nothing is connected and publishing is a no-op; the Django view
+for the same URL answers 204 so browsers stop trying and fall back to
+reloading the page.
+'''
+import asyncio
+import json
+import re
+import threading
+from functools import partial
+from importlib import import_module
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.db import connection, transaction
+from django.http import HttpRequest
+from django.http.cookie import parse_cookie
+
+QUEUE_SIZE = getattr(settings, 'TRIVIA_LIVE_QUEUE_SIZE', 100)
+KEEPALIVE = getattr(settings, 'TRIVIA_LIVE_KEEPALIVE', 20)
+
+EVENTS_PATH = re.compile(r'^/games/(?P<game>\d+)/events/$')
+
+# Sent in place of everything a client missed when it falls too far behind
+RELOAD = b'event: reload\ndata: {}\n\n'
+
+
+def encode(event, data):
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'.encode()
+
+
+def _offer(queue, message):
+    try:
+        queue.put_nowait(message)
+    except asyncio.QueueFull:
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(RELOAD)
+
+
+class Broadcaster:
+    '''Per-game fan-out from any thread to the event loop serving the clients.'''
+
+    def __init__(self, queue_size=QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._subscribers = {}
+
+    def subscribe(self, game_id, staff=False):
+        queue = asyncio.Queue(self.queue_size)
+        with self._lock:
+            self._subscribers.setdefault(game_id, {})[queue] = (asyncio.get_running_loop(), staff)
+        return queue
+
+    def unsubscribe(self, game_id, queue):
+        with self._lock:
+            queues = self._subscribers.get(game_id, {})
+            queues.pop(queue, None)
+            if not queues:
+                self._subscribers.pop(game_id, None)
+
+    def publish(self, game_id, message, public=None):
+        '''Send message to the game's staff connections, and public (if given, else message) to the rest.'''
+        if public is None:
+            public = message
+        with self._lock:
+            queues = list(self._subscribers.get(game_id, {}).items())
+        for queue, (loop, staff) in queues:
+            loop.call_soon_threadsafe(_offer, queue, message if staff else public)
+
+    def connections(self, game_id=None):
+        with self._lock:
+            if game_id is not None:
+                return len(self._subscribers.get(game_id, ()))
+            return sum(len(queues) for queues in self._subscribers.values())
+
+
+broadcaster = Broadcaster()
+
+
+def announce(game_id, event='version', data=None, staff_only=False):
+    '''Bump the game's scoreboard version and send an event with it, right now.'''
+    from .scoreboard import next_version
+    version = next_version(game_id)
+    message = encode(event, {**(data or {}), 'version': version})
+    broadcaster.publish(game_id, message, encode('version', {'version': version}) if staff_only else None)
+
+
+def publish(game_id, event, staff_only=False, **data):
+    '''Send an event to a game's live scoreboards once the transaction commits.'''
+    transaction.on_commit(partial(announce, game_id, event, data, staff_only))
+
+
+def publish_scores(game_id, cells):
+    '''
+    Score deltas as a list of {'player', 'round', 'delta'} dicts. The final
+    round is sent as round 'final'.
+    '''
+    cells = [cell for cell in cells if cell['delta'] or 'double' in cell]
+    if cells:
+        publish(game_id, 'score', cells=cells)
+
+
+# ASGI ####################################################
+
+def is_staff(scope):
+    '''Whether the session cookie in an ASGI scope belongs to a staff user.'''
+    try:
+        request = HttpRequest()
+        cookies = b'; '.join(value for name, value in scope['headers'] if name == b'cookie')
+        request.COOKIES = parse_cookie(cookies.decode('latin1'))
+        engine = import_module(settings.SESSION_ENGINE)
+        request.session = engine.SessionStore(request.COOKIES.get(settings.SESSION_COOKIE_NAME))
+        return get_user(request).is_staff
+    finally:
+        connection.close()
+
+
+async def _disconnected(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def stream(scope, receive, send, game_id):
+    '''One event stream; lives until the client goes away.'''
+    queue = broadcaster.subscribe(game_id, staff=await sync_to_async(is_staff)(scope))
+    disconnect = asyncio.ensure_future(_disconnected(receive))
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': b'retry: 5000\n\n', 'more_body': True})
+        while not disconnect.done():
+            message = asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait(
+                {message, disconnect}, timeout=KEEPALIVE, return_when=asyncio.FIRST_COMPLETED
+            )
+            if message in done:
+                body = message.result()
+            else:
+                message.cancel()
+                if disconnect.done():
+                    break
+                body = b': keepalive\n\n'
+            await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+    finally:
+        disconnect.cancel()
+        broadcaster.unsubscribe(game_id, queue)
+
+
+def router(django_application):
+    '''Serve event streams directly and pass every other request on to Django.'''
+    async def application(scope, receive, send):
+        if scope['type'] == 'http' and scope['method'] == 'GET':
+            match = EVENTS_PATH.match(scope['path'])
+            if match:
+                return await stream(scope, receive, send, int(match['game']))
+        return await django_application(scope, receive, send)
+    return application
@@ -0,0 +1,78 @@
+import argparse
+import json
+import platform
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from trivia.benchmarks import BENCHMARKS, as_json, compare
+
+
+def game_size(value):
+    try:
+        players, rounds, questions = (int(part) for part in value.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'--size takes PLAYERSxROUNDSxQUESTIONS, e.g. 50x6x10, not {value!r}')
+    return players, rounds, questions
+
+
+class Command(BaseCommand):
+    help = 'Time scoring, grading and the game pages against generated games in a throwaway test database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help=f'Benchmarks to run (default all: {", ".join(BENCHMARKS)})')
+        parser.add_argument('--size', type=game_size, help='PLAYERSxROUNDSxQUESTIONS for the generated games.')
+        parser.add_argument('--repeat', type=int, default=5, help='Timed runs per measurement; the median is kept.')
+        parser.add_argument('--output', help='Write the results to this JSON file.')
+        parser.add_argument('--baseline', help='Fail if anything regressed against this JSON file from --output.')
+        parser.add_argument(
+            '--tolerance', type=float, default=0.25,
+            help='How much slower or bigger than the baseline is allowed (default 0.25 for 25%%).',
+        )
+
+    def handle(self, *args, **options):
+        names = options['names'] or list(BENCHMARKS)
+        unknown = set(names) - set(BENCHMARKS)
+        if unknown:
+            raise CommandError(f'Unknown benchmark(s): {", ".join(sorted(unknown))}')
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)['results']
+        kwargs = {'repeat': options['repeat']}
+        if options['size']:
+            kwargs['size'] = options['size']
+
+        results = []
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            self.stdout.write(f'{"benchmark":<36} {"ms":>9} {"queries":>8} {"peak KB":>9}')
+            for name in names:
+                for result in BENCHMARKS[name](**kwargs):
+                    results.append(result)
+                    self.stdout.write(
+                        f'{result.name:<36} {result.seconds * 1000:>9.1f} {result.queries:>8} {result.peak_kb:>9}'
+                    )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({
+                    'python': platform.python_version(),
+                    'django': django.get_version(),
+                    'database': connection.vendor,
+                    'results': as_json(results),
+                }, f, indent=2)
+                f.write('\n')
+        if baseline is not None:
+            regressions = compare(results, baseline, options['tolerance'])
+            if regressions:
+                for regression in regressions:
+                    self.stderr.write(regression)
+                raise CommandError(f'{len(regressions)} regression(s) against {options["baseline"]}')
+            self.stdout.write(self.style.SUCCESS(f'No regressions against {options["baseline"]}'))
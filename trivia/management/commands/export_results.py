@@ -0,0 +1,29 @@
+import sys
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from trivia import export
+
+
+class Command(BaseCommand):
+    help = 'Stream game scores, responses or final round wagers out as CSV or JSON lines.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=list(export.KINDS), help='What to export.')
+        parser.add_argument('--format', choices=list(export.FORMATS), default='csv', help='Default csv.')
+        parser.add_argument('--game', type=int, action='append', default=[], help='Only this game; repeatable.')
+        parser.add_argument('--since', type=date.fromisoformat, help='Only games published on or after YYYY-MM-DD.')
+        parser.add_argument('--until', type=date.fromisoformat, help='Only games published on or before YYYY-MM-DD.')
+        parser.add_argument('--output', '-o', default='-', help='File to write (default stdout).')
+
+    def handle(self, *args, **options):
+        games = export.games(options['game'], options['since'], options['until'])
+        chunks = export.stream(options['kind'], options['format'], games)
+        if options['output'] == '-':
+            for chunk in chunks:
+                sys.stdout.write(chunk)
+            return
+        with open(options['output'], 'w', newline='', encoding='utf-8') as f:
+            for chunk in chunks:
+                f.write(chunk)
@@ -0,0 +1,73 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from trivia.scripts import benchmark_parsing, csv_files, import_files, import_game
+
+
+class Command(BaseCommand):
+    help = 'Import games from CSV files, or from every .csv file in a directory.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help='CSV files or directories of them')
+        parser.add_argument('--name', help='Game title (single file only, defaults to the file name)')
+        parser.add_argument(
+            '--strict', action='store_true', help="Don't import a file if any of its rows are rejected.",
+        )
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Processes to parse files with (default 1, 0 for one per CPU).',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=20, help='Files written per transaction (default 20).',
+        )
+        parser.add_argument('--dry-run', action='store_true', help='Only parse and check the files.')
+        parser.add_argument(
+            '--benchmark', metavar='COUNTS',
+            help='Time parsing every file at each comma separated worker count, e.g. 1,2,4,8.',
+        )
+
+    def handle(self, *args, **options):
+        files = list(csv_files(options['paths']))
+        if options['name'] and len(files) > 1:
+            raise CommandError('--name only works when importing a single file.')
+        if options['benchmark']:
+            return self.benchmark(files, options['benchmark'])
+        if options['name']:
+            reports = [(files[0], import_game(
+                files[0], options['name'], strict=options['strict'], dry_run=options['dry_run'],
+            ))]
+        else:
+            reports = import_files(
+                files, workers=options['workers'] or os.cpu_count(), batch_size=options['batch_size'],
+                dry_run=options['dry_run'], strict=options['strict'],
+            )
+        skipped = 0
+        for done, (path, report) in enumerate(reports, 1):
+            progress = f'[{done}/{len(files)}] {path}'
+            for rejected in report.rejected:
+                self.stderr.write(f'{path}:{rejected.line}: {rejected.reason}')
+            summary = (
+                f'{report.rounds} rounds, {report.questions} questions'
+                f'{" and a final round" if report.final_round else ""}'
+                f'{f", {len(report.rejected)} rows rejected" if report.rejected else ""}'
+            )
+            if options['dry_run']:
+                self.stdout.write(f'{progress}: checked {summary}')
+            elif report.game is None:
+                skipped += 1
+                self.stderr.write(f'{progress}: not imported')
+            else:
+                self.stdout.write(f'{progress}: imported "{report.game}" with {summary}')
+        if skipped:
+            raise CommandError(f'{skipped} of {len(files)} file(s) were not imported.')
+
+    def benchmark(self, files, counts):
+        try:
+            worker_counts = [int(count) for count in counts.split(',')]
+        except ValueError:
+            raise CommandError('--benchmark takes comma separated worker counts, e.g. 1,2,4,8.')
+        self.stdout.write(f'Parsing {len(files)} files')
+        self.stdout.write(f'{"workers":>8} {"seconds":>9} {"files/sec":>10}')
+        for workers, seconds, rate in benchmark_parsing(files, worker_counts):
+            self.stdout.write(f'{workers:>8} {seconds:>9.2f} {rate:>10.1f}')
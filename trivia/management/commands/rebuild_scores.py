@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from trivia.models import Game
+from trivia.scoring import rebuild_scores
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the Score table from the raw responses and check it against score_game().'
+
+    def add_arguments(self, parser):
+        parser.add_argument('game_ids', nargs='*', type=int, help='Games to rebuild (default: all)')
+        parser.add_argument(
+            '--check', action='store_true',
+            help="Only compare the table with score_game(), don't rebuild it.",
+        )
+
+    def handle(self, *args, **options):
+        games = Game.objects.all()
+        if options['game_ids']:
+            games = games.filter(id__in=options['game_ids'])
+        mismatched = []
+        for game in games:
+            if not options['check']:
+                rebuild_scores(game)
+            expected = game.score_game()
+            actual = game.score_table()
+            if actual == expected:
+                self.stdout.write(f'{game}: ok')
+                continue
+            mismatched.append(game)
+            for player, row in expected.items():
+                for column, score in row.items():
+                    if actual[player][column] != score:
+                        self.stderr.write(
+                            f'{game}: {player} {column} is {actual[player][column]}, expected {score}'
+                        )
+        if mismatched:
+            raise CommandError(f'{len(mismatched)} game(s) do not match score_game().')
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from trivia.offload import THREADS
+from trivia.stress import ASGI_MODES, asgi_run, file_database
+
+
+class Command(BaseCommand):
+    help = (
+        'Have hundreds of clients load the game and round pages and submit answers at once '
+        'through the ASGI application, and compare Django as it comes with trivia.offload.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('modes', nargs='*', help=f'Ways to serve (default all: {", ".join(ASGI_MODES)})')
+        parser.add_argument(
+            '--clients', type=int, nargs='+', default=[100, 500], help='Concurrent clients in each run.',
+        )
+        parser.add_argument('--players', type=int, default=40, help='Players the clients are logged in as.')
+        parser.add_argument('--questions', type=int, default=10, help='Questions on each answer sheet.')
+        parser.add_argument(
+            '--threads', type=int, default=THREADS, help='Pool size for trivia.offload (default TRIVIA_ASGI_THREADS).',
+        )
+        parser.add_argument('--cycles', type=int, default=1, help='Page loads and submissions per client.')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('stress_asgi only makes sense on SQLite')
+        modes = options['modes'] or list(ASGI_MODES)
+        unknown = set(modes) - set(ASGI_MODES)
+        if unknown:
+            raise CommandError(f'Unknown mode(s): {", ".join(sorted(unknown))}')
+
+        with file_database():
+            self.stdout.write(
+                f'{"mode":<8} {"clients":>7} {"requests":>8} {"ok":>6} {"locked":>7} {"errors":>7} {"ok/s":>7} '
+                f'{"read p50":>9} {"read p95":>9} {"write p50":>10} {"write p95":>10}'
+            )
+            for clients in options['clients']:
+                for mode in modes:
+                    result = asgi_run(
+                        mode, clients, options['players'], options['questions'], options['cycles'], options['threads'],
+                    )
+                    self.stdout.write(
+                        f'{result.mode:<8} {result.clients:>7} {result.requests:>8} {result.ok:>6} '
+                        f'{result.locked:>7} {result.errors:>7} {result.ok / result.seconds:>7.1f} '
+                        f'{result.read_p50 * 1000:>9.0f} {result.read_p95 * 1000:>9.0f} '
+                        f'{result.write_p50 * 1000:>10.0f} {result.write_p95 * 1000:>10.0f}'
+                    )
+            self.stdout.write('Latencies in ms.')
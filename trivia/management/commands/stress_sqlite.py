@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from trivia.stress import MODES, file_database, run
+
+
+class Command(BaseCommand):
+    help = (
+        'Have many players submit answers at once against a throwaway SQLite file, '
+        'and compare throughput and "database is locked" errors across settings.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('modes', nargs='*', help=f'Settings to try (default all: {", ".join(MODES)})')
+        parser.add_argument('--players', type=int, default=40, help='Players submitting at once.')
+        parser.add_argument('--questions', type=int, default=10, help='Questions on each answer sheet.')
+        parser.add_argument('--submissions', type=int, default=5, help='Answer sheets each player submits.')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('stress_sqlite only makes sense on SQLite')
+        modes = options['modes'] or list(MODES)
+        unknown = set(modes) - set(MODES)
+        if unknown:
+            raise CommandError(f'Unknown mode(s): {", ".join(sorted(unknown))}')
+
+        with file_database():
+            self.stdout.write(
+                f'{"mode":<10} {"attempts":>8} {"ok":>6} {"locked":>7} {"errors":>7} '
+                f'{"ok/s":>7} {"p50 ms":>8} {"p95 ms":>8}'
+            )
+            for mode in modes:
+                result = run(mode, options['players'], options['questions'], options['submissions'])
+                self.stdout.write(
+                    f'{result.mode:<10} {result.attempts:>8} {result.ok:>6} {result.locked:>7} {result.errors:>7} '
+                    f'{result.ok / result.seconds:>7.1f} {result.p50 * 1000:>8.1f} {result.p95 * 1000:>8.1f}'
+                )
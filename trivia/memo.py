@@ -0,0 +1,211 @@
+'''
+Verdicts remembered across games, so an answer checked once is checked for
+good.
+
+The same questions come back over a season and players give the same
+answers to them. Every time a response is checked by hand, the verdict is
+stored in the Verdict table. Fuzzy accepts aren't, so a wrong one can't
+spread to later games. The key is a hash of the question's normalized
+accepted answers plus the normalized response. Keying on the answers rather
+than the question means a reworded question with the same answers shares its
+verdicts, and a question whose answers were edited starts afresh.
+
+With TRIVIA_VERDICT_MEMO on, the auto check looks up whatever the exact
+match left and accepts the responses that were accepted before. Ones
+rejected before are kept away from the fuzzy check. Lookups go through an
+LRU of TRIVIA_VERDICT_CACHE_SIZE verdicts in each process, and then to the
+table. Saving verdicts moves a generation count in the shared cache once the
+transaction commits, and every process empties its LRU when it sees the count
+move, so a verdict corrected in one process isn't trusted from memory in
+another. Each auto check reports how many of its lookups were known.
+'''
+import hashlib
+import threading
+import time
+from collections import Counter, OrderedDict, namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .answers import normalize
+from .models import AcceptedAnswer, QuestionResponse, Verdict
+
+ENABLED = getattr(settings, 'TRIVIA_VERDICT_MEMO', False)
+CACHE_SIZE = getattr(settings, 'TRIVIA_VERDICT_CACHE_SIZE', 10000)
+
+BATCH_SIZE = 500
+
+GENERATION_KEY = 'trivia:verdicts:generation'
+
+# What the memo knew about a round's unchecked responses
+Pregrade = namedtuple('Pregrade', ['accepted', 'rejected', 'deltas', 'hits', 'lookups'])
+
+
+def answer_key(normalized_answers):
+    return hashlib.sha256('\n'.join(sorted(set(normalized_answers))).encode()).hexdigest()
+
+
+def answer_keys_for(question_ids=(), finalround_ids=()):
+    '''{question id: answer key} and {final round id: answer key}.'''
+    answers = {}
+    for question_id, finalround_id, normalized in AcceptedAnswer.objects.filter(
+        Q(question_id__in=question_ids) | Q(finalround_id__in=finalround_ids)
+    ).values_list('question_id', 'finalround_id', 'normalized'):
+        answers.setdefault((question_id, finalround_id), []).append(normalized)
+    questions, final_rounds = {}, {}
+    for (question_id, finalround_id), normalized in answers.items():
+        if question_id is not None:
+            questions[question_id] = answer_key(normalized)
+        else:
+            final_rounds[finalround_id] = answer_key(normalized)
+    return questions, final_rounds
+
+
+def generation():
+    '''How many times verdicts have been saved, as far as the shared cache knows.'''
+    current = cache.get(GENERATION_KEY)
+    if current is None:
+        # start from the clock, so an evicted count can't come back to a
+        # value some process already saw
+        cache.add(GENERATION_KEY, int(time.time() * 1000), None)
+        current = cache.get(GENERATION_KEY)
+    return current
+
+
+def next_generation():
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        generation()
+
+
+class VerdictMemo:
+    '''The Verdict table behind a bounded LRU.'''
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._verdicts = OrderedDict()
+        self._generation = None
+
+    def _store(self, verdicts):
+        with self._lock:
+            for pair, correct in verdicts.items():
+                self._verdicts[pair] = correct
+                self._verdicts.move_to_end(pair)
+            while len(self._verdicts) > self.size:
+                self._verdicts.popitem(last=False)
+
+    def lookup(self, pairs):
+        '''{(answer key, response): correct} for the pairs with a verdict.'''
+        found, missing = {}, set()
+        current = generation()
+        with self._lock:
+            if current != self._generation:
+                # some process saved verdicts since we last looked
+                self._verdicts.clear()
+                self._generation = current
+            for pair in pairs:
+                if pair in self._verdicts:
+                    self._verdicts.move_to_end(pair)
+                    found[pair] = self._verdicts[pair]
+                else:
+                    missing.add(pair)
+        keys = {key for key, _ in missing}
+        responses = sorted({response for _, response in missing})
+        loaded = {}
+        for start in range(0, len(responses), BATCH_SIZE):
+            for key, response, correct in Verdict.objects.filter(
+                answer_key__in=keys, response__in=responses[start:start + BATCH_SIZE],
+            ).values_list('answer_key', 'response', 'correct'):
+                if (key, response) in missing:
+                    loaded[(key, response)] = correct
+        self._store(loaded)
+        found.update(loaded)
+        return found
+
+    def remember(self, verdicts):
+        '''Save {(answer key, response): correct}, replacing earlier verdicts.'''
+        verdicts = {(key, response): correct for (key, response), correct in verdicts.items() if response}
+        if not verdicts:
+            return
+        quote = connection.ops.quote_name
+        now = timezone.now()
+        rows = [(key, response, correct, now) for (key, response), correct in verdicts.items()]
+        with connection.cursor() as cursor:
+            for start in range(0, len(rows), BATCH_SIZE):
+                batch = rows[start:start + BATCH_SIZE]
+                cursor.execute(
+                    f'INSERT INTO {quote(Verdict._meta.db_table)} ({quote("answer_key")}, '
+                    f'{quote("response")}, {quote("correct")}, {quote("updated")}) '
+                    f'VALUES {", ".join(["(%s, %s, %s, %s)"] * len(batch))} '
+                    f'ON CONFLICT ({quote("answer_key")}, {quote("response")}) DO UPDATE SET '
+                    f'{quote("correct")} = excluded.{quote("correct")}, '
+                    f'{quote("updated")} = excluded.{quote("updated")}',
+                    [value for row in batch for value in row],
+                )
+        # every process's LRU, this one's included, is emptied once they're in
+        transaction.on_commit(next_generation)
+
+    def clear(self):
+        with self._lock:
+            self._verdicts.clear()
+
+
+memo = VerdictMemo()
+
+
+def remember_responses(entries):
+    '''Remember (question id, normalized response, correct) verdicts.'''
+    entries = list(entries)
+    if not ENABLED or not entries:
+        return
+    keys, _ = answer_keys_for(question_ids={question_id for question_id, _, _ in entries})
+    memo.remember({
+        (keys[question_id], response): correct
+        for question_id, response, correct in entries if question_id in keys
+    })
+
+
+def remember_final(finalround_id, entries):
+    '''Remember (answer as given, correct) verdicts for a final round.'''
+    if not ENABLED or not entries:
+        return
+    _, keys = answer_keys_for(finalround_ids=[finalround_id])
+    max_length = Verdict._meta.get_field('response').max_length
+    if finalround_id in keys:
+        memo.remember({
+            (keys[finalround_id], normalize(answer, max_length)): correct for answer, correct in entries
+        })
+
+
+def pregrade(round_id):
+    '''
+    Accept the round's unchecked responses that were accepted before, in one
+    UPDATE. Returns a Pregrade with the ids of the ones rejected before and
+    the score deltas for the accepted ones.
+    '''
+    responses = list(
+        QuestionResponse.objects.filter(question__round_id=round_id, correct=False)
+        .exclude(normalized_response='')
+        .values_list('id', 'player_id', 'question_id', 'normalized_response', 'question__points')
+    )
+    keys, _ = answer_keys_for(question_ids={question_id for _, _, question_id, _, _ in responses})
+    pairs = {
+        response_id: (keys[question_id], normalized)
+        for response_id, _, question_id, normalized, _ in responses if question_id in keys
+    }
+    known = memo.lookup(set(pairs.values()))
+    accepted, rejected, deltas = [], set(), Counter()
+    for response_id, player_id, _, _, points in responses:
+        verdict = known.get(pairs.get(response_id))
+        if verdict:
+            accepted.append(response_id)
+            deltas[(player_id, round_id)] += points
+        elif verdict is not None:
+            rejected.add(response_id)
+    QuestionResponse.objects.filter(id__in=accepted).update(correct=True, confidence=1.0)
+    return Pregrade(len(accepted), rejected, deltas, hits=len(accepted) + len(rejected), lookups=len(pairs))
@@ -0,0 +1,234 @@
+'''
+Per-view request metrics, kept in process and served as Prometheus text.
+
+MetricsMiddleware times a sample of requests (TRIVIA_METRICS_SAMPLE_RATE),
+counts their queries and database time through a connection execute
+wrapper, and files everything under the request's URL name. Latencies go
+into a fixed histogram plus a ring buffer of recent requests per view, and
+the slowest statements are kept with the line of our code that ran them.
+Everything is bounded, so it can stay on in production.
+
+Counts are of sampled requests only; divide by the sample rate (also
+exported) to estimate the real totals. Each process keeps its own numbers.
+'''
+import heapq
+import os
+import random
+import sys
+import threading
+import time
+from collections import deque, namedtuple
+
+from django.conf import settings
+from django.db import connection
+
+SAMPLE_RATE = getattr(settings, 'TRIVIA_METRICS_SAMPLE_RATE', 1.0)
+RECENT = getattr(settings, 'TRIVIA_METRICS_RECENT', 500)
+SLOW_QUERIES = getattr(settings, 'TRIVIA_METRICS_SLOW_QUERIES', 20)
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUANTILES = (0.5, 0.95, 0.99)
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+ViewSnapshot = namedtuple(
+    'ViewSnapshot', ['requests', 'errors', 'seconds', 'buckets', 'queries', 'db_seconds', 'recent']
+)
+
+
+class ViewMetrics:
+    __slots__ = ('requests', 'errors', 'seconds', 'buckets', 'queries', 'db_seconds', 'recent')
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.buckets = [0] * len(BUCKETS)
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.recent = deque(maxlen=RECENT)
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.views = {}
+        # min-heap of (seconds, sequence, view, call site, sql)
+        self.slow = []
+        self._sequence = 0
+
+    def record(self, view, seconds, status, queries, db_seconds):
+        with self._lock:
+            metrics = self.views.get(view)
+            if metrics is None:
+                metrics = self.views[view] = ViewMetrics()
+            metrics.requests += 1
+            metrics.errors += status >= 500
+            metrics.seconds += seconds
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    metrics.buckets[i] += 1
+                    break
+            metrics.queries += queries
+            metrics.db_seconds += db_seconds
+            metrics.recent.append(seconds)
+
+    def slow_enough(self, seconds):
+        '''Whether a statement this slow would make the slow list, checked before finding its call site.'''
+        return len(self.slow) < SLOW_QUERIES or seconds > self.slow[0][0]
+
+    def record_slow(self, seconds, view, site, sql):
+        with self._lock:
+            self._sequence += 1
+            entry = (seconds, self._sequence, view, site, sql)
+            if len(self.slow) < SLOW_QUERIES:
+                heapq.heappush(self.slow, entry)
+            elif seconds > self.slow[0][0]:
+                heapq.heapreplace(self.slow, entry)
+
+    def snapshot(self):
+        with self._lock:
+            views = sorted(
+                (view, ViewSnapshot(
+                    m.requests, m.errors, m.seconds, list(m.buckets), m.queries, m.db_seconds, sorted(m.recent),
+                ))
+                for view, m in self.views.items()
+            )
+            return views, sorted(self.slow, reverse=True)
+
+    def clear(self):
+        with self._lock:
+            self.views.clear()
+            self.slow.clear()
+
+
+registry = Registry()
+
+
+def call_site():
+    '''file:line in function of the innermost frame that is our code.'''
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(BASE_DIR) and filename != __file__ and 'site-packages' not in filename:
+            return f'{os.path.relpath(filename, BASE_DIR)}:{frame.f_lineno} in {frame.f_code.co_name}'
+        frame = frame.f_back
+    return 'unknown'
+
+
+class QueryTimer:
+    '''connection.execute_wrapper() that counts and times every statement of one request.'''
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+        self.slow = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            seconds = time.perf_counter() - start
+            self.queries += 1
+            self.seconds += seconds
+            if registry.slow_enough(seconds):
+                self.slow.append((seconds, call_site(), sql))
+
+
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if SAMPLE_RATE < 1 and random.random() >= SAMPLE_RATE:
+            return self.get_response(request)
+        timer = QueryTimer()
+        start = time.perf_counter()
+        status = 500
+        try:
+            with connection.execute_wrapper(timer):
+                response = self.get_response(request)
+            status = response.status_code
+            return response
+        finally:
+            seconds = time.perf_counter() - start
+            match = getattr(request, 'resolver_match', None)
+            view = match.view_name if match else 'unresolved'
+            registry.record(view, seconds, status, timer.queries, timer.seconds)
+            for query_seconds, site, sql in timer.slow:
+                registry.record_slow(query_seconds, view, site, sql)
+
+
+# Prometheus text format ###################################
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+
+def _quantile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def render(extra=None):
+    '''
+    Everything recorded so far in the Prometheus text exposition format.
+    extra is a list of (name, type, help, value) to add unlabelled.
+    '''
+    views, slow = registry.snapshot()
+    lines = []
+
+    def family(name, kind, help_text):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+
+    family('trivia_metrics_sample_rate', 'gauge', 'Share of requests that are recorded.')
+    lines.append(f'trivia_metrics_sample_rate {SAMPLE_RATE}')
+
+    family('trivia_requests_total', 'counter', 'Sampled requests by view.')
+    for view, m in views:
+        lines.append(f'trivia_requests_total{{view="{_label(view)}"}} {m.requests}')
+
+    family('trivia_request_errors_total', 'counter', 'Sampled requests that answered 5xx, by view.')
+    for view, m in views:
+        lines.append(f'trivia_request_errors_total{{view="{_label(view)}"}} {m.errors}')
+
+    family('trivia_request_seconds', 'histogram', 'Request latency by view.')
+    for view, m in views:
+        label = _label(view)
+        cumulative = 0
+        for bound, count in zip(BUCKETS, m.buckets):
+            cumulative += count
+            lines.append(f'trivia_request_seconds_bucket{{view="{label}",le="{bound}"}} {cumulative}')
+        lines.append(f'trivia_request_seconds_bucket{{view="{label}",le="+Inf"}} {m.requests}')
+        lines.append(f'trivia_request_seconds_sum{{view="{label}"}} {m.seconds:.6f}')
+        lines.append(f'trivia_request_seconds_count{{view="{label}"}} {m.requests}')
+
+    family('trivia_recent_request_seconds', 'gauge', f'Latency quantiles over the last {RECENT} requests by view.')
+    for view, m in views:
+        for q in QUANTILES:
+            lines.append(
+                f'trivia_recent_request_seconds{{view="{_label(view)}",quantile="{q}"}} '
+                f'{_quantile(m.recent, q):.6f}'
+            )
+
+    family('trivia_db_queries_total', 'counter', 'Queries run by sampled requests, by view.')
+    for view, m in views:
+        lines.append(f'trivia_db_queries_total{{view="{_label(view)}"}} {m.queries}')
+
+    family('trivia_db_seconds_total', 'counter', 'Time spent in the database by sampled requests, by view.')
+    for view, m in views:
+        lines.append(f'trivia_db_seconds_total{{view="{_label(view)}"}} {m.db_seconds:.6f}')
+
+    family('trivia_slow_query_seconds', 'gauge', f'The {SLOW_QUERIES} slowest statements seen, with where they ran.')
+    for seconds, _, view, site, sql in slow:
+        lines.append(
+            f'trivia_slow_query_seconds{{view="{_label(view)}",site="{_label(site)}",'
+            f'sql="{_label(sql[:300])}"}} {seconds:.6f}'
+        )
+
+    for name, kind, help_text, value in extra or ():
+        family(name, kind, help_text)
+        lines.append(f'{name} {value}')
+    return '\n'.join(lines) + '\n'
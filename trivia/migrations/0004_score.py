@@ -0,0 +1,71 @@
+# Generated by Django 3.0.6 on 2026-10-18 11:33
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Sum
+import django.db.models.deletion
+
+
+def backfill(apps, schema_editor):
+    # Same as trivia.scoring.rebuild_scores, for every game at once
+    Score = apps.get_model('trivia', 'Score')
+    QuestionResponse = apps.get_model('trivia', 'QuestionResponse')
+    DoubleRound = apps.get_model('trivia', 'DoubleRound')
+    FinalAnswer = apps.get_model('trivia', 'FinalAnswer')
+    points = {
+        (game_id, player_id, round_id): total
+        for game_id, player_id, round_id, total in QuestionResponse.objects.filter(correct=True)
+        .values_list('question__round__game_id', 'player_id', 'question__round_id')
+        .annotate(total=Sum('question__points')).order_by()
+    }
+    doubles = {
+        (game_id, player_id, round_id): multiplier
+        for game_id, player_id, round_id, multiplier in DoubleRound.objects.values_list(
+            'round__game_id', 'player_id', 'round_id', 'multiplier'
+        )
+    }
+    rows = [
+        Score(game_id=game_id, player_id=player_id, round_id=round_id, points=points.get(key, 0),
+              multiplier=doubles.get(key, 1))
+        for key in set(points) | set(doubles)
+        for game_id, player_id, round_id in [key]
+    ]
+    rows += [
+        Score(game_id=game_id, player_id=player_id, round_id=None, points=wager if correct else -wager,
+              multiplier=1 if status == '4' else 0)
+        for game_id, player_id, wager, correct, status in FinalAnswer.objects.values_list(
+            'finalround__game_id', 'player_id', 'wager', 'correct', 'finalround__status'
+        )
+    ]
+    Score.objects.bulk_create(rows, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('trivia', '0003_question_alt_answers'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Score',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('points', models.IntegerField(default=0)),
+                ('multiplier', models.IntegerField(default=1)),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='trivia.Game')),
+                ('player', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+                ('round', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='trivia.Round')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='score',
+            constraint=models.UniqueConstraint(fields=('game', 'player', 'round'), name='unique_score'),
+        ),
+        migrations.AddConstraint(
+            model_name='score',
+            constraint=models.UniqueConstraint(condition=models.Q(round__isnull=True), fields=('game', 'player'), name='unique_final_score'),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 3.0.6 on 2026-10-18 11:38
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trivia', '0004_score'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AcceptedAnswer',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('normalized', models.CharField(max_length=250)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='finalanswer',
+            name='normalized_answer',
+            field=models.CharField(default='', editable=False, max_length=200),
+        ),
+        migrations.AddField(
+            model_name='questionresponse',
+            name='normalized_response',
+            field=models.CharField(default='', editable=False, max_length=150),
+        ),
+        migrations.AddIndex(
+            model_name='finalanswer',
+            index=models.Index(fields=['finalround', 'normalized_answer'], name='final_normalized_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='questionresponse',
+            index=models.Index(fields=['question', 'normalized_response'], name='response_normalized_idx'),
+        ),
+        migrations.AddField(
+            model_name='acceptedanswer',
+            name='finalround',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='trivia.FinalRound'),
+        ),
+        migrations.AddField(
+            model_name='acceptedanswer',
+            name='question',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='trivia.Question'),
+        ),
+        migrations.AddIndex(
+            model_name='acceptedanswer',
+            index=models.Index(fields=['question', 'normalized'], name='accepted_question_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='acceptedanswer',
+            index=models.Index(fields=['finalround', 'normalized'], name='accepted_finalround_idx'),
+        ),
+    ]
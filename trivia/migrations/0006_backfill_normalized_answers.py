@@ -0,0 +1,88 @@
+import unicodedata
+
+from django.db import migrations, transaction
+
+CHUNK_SIZE = 2000
+
+
+# trivia.answers as it was when this migration was written, so later changes
+# to it don't change what this does
+
+ARTICLES = ('the', 'a', 'an')
+
+
+def _fold(char):
+    category = unicodedata.category(char)
+    if category == 'Pd':
+        return ' '
+    if category.startswith('P') or unicodedata.combining(char):
+        return ''
+    return char
+
+
+def normalize(text, max_length=None):
+    if not text:
+        return ''
+    text = ''.join(_fold(char) for char in unicodedata.normalize('NFKD', text))
+    words = text.casefold().split()
+    if len(words) > 1 and words[0] in ARTICLES:
+        words = words[1:]
+    return ' '.join(words)[:max_length]
+
+
+def answer_keys(answer, alt_answers, max_length=None):
+    alternatives = [text.strip() for text in (alt_answers or '').split(',') if text.strip()]
+    keys = (normalize(text, max_length) for text in [answer] + alternatives)
+    return sorted({key for key in keys if key})
+
+
+def chunks(queryset):
+    '''Walk a table in primary key order, CHUNK_SIZE rows at a time.'''
+    last = 0
+    while True:
+        chunk = list(queryset.filter(pk__gt=last).order_by('pk')[:CHUNK_SIZE])
+        if not chunk:
+            return
+        yield chunk
+        last = chunk[-1].pk
+
+
+def backfill(apps, schema_editor):
+    Question = apps.get_model('trivia', 'Question')
+    FinalRound = apps.get_model('trivia', 'FinalRound')
+    AcceptedAnswer = apps.get_model('trivia', 'AcceptedAnswer')
+    QuestionResponse = apps.get_model('trivia', 'QuestionResponse')
+    FinalAnswer = apps.get_model('trivia', 'FinalAnswer')
+
+    for owner, model in [('question', Question), ('finalround', FinalRound)]:
+        for chunk in chunks(model.objects.only('id', 'answer', 'alt_answers')):
+            with transaction.atomic():
+                AcceptedAnswer.objects.filter(**{f'{owner}__in': chunk}).delete()
+                AcceptedAnswer.objects.bulk_create([
+                    AcceptedAnswer(normalized=key, **{owner: obj})
+                    for obj in chunk
+                    for key in answer_keys(obj.answer, obj.alt_answers, 250)
+                ])
+
+    for model, source, target, max_length in [
+        (QuestionResponse, 'response', 'normalized_response', 150),
+        (FinalAnswer, 'answer', 'normalized_answer', 200),
+    ]:
+        for chunk in chunks(model.objects.only('id', source)):
+            for obj in chunk:
+                setattr(obj, target, normalize(getattr(obj, source), max_length))
+            with transaction.atomic():
+                model.objects.bulk_update(chunk, [target])
+
+
+class Migration(migrations.Migration):
+    # Each chunk commits on its own so big tables don't hold one huge transaction
+    atomic = False
+
+    dependencies = [
+        ('trivia', '0005_normalized_answers'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
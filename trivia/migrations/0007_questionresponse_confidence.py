@@ -0,0 +1,18 @@
+# Generated by Django 3.0.6 on 2026-10-18 11:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trivia', '0006_backfill_normalized_answers'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='questionresponse',
+            name='confidence',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
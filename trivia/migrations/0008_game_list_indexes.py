@@ -0,0 +1,25 @@
+# Generated by Django 3.0.6 on 2026-10-18 11:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trivia', '0007_questionresponse_confidence'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='game',
+            options={'ordering': ('-pub_date', '-id')},
+        ),
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(fields=['-pub_date', '-id'], name='game_recent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(fields=['completed', '-pub_date', '-id'], name='game_completed_idx'),
+        ),
+    ]
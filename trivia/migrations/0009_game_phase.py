@@ -0,0 +1,36 @@
+# Generated by Django 3.0.6 on 2026-10-18 12:03
+
+from django.db import migrations, models
+from django.db.models import Case, CharField, Exists, OuterRef, Value, When
+
+
+def backfill(apps, schema_editor):
+    # Same as trivia.transitions.phase_expression, for every game at once
+    Game = apps.get_model('trivia', 'Game')
+    Round = apps.get_model('trivia', 'Round')
+    FinalRound = apps.get_model('trivia', 'FinalRound')
+    rounds = Round.objects.filter(game=OuterRef('pk'))
+    final_rounds = FinalRound.objects.filter(game=OuterRef('pk'))
+    Game.objects.update(phase=Case(
+        When(Exists(final_rounds.filter(status='4')), then=Value('3')),
+        When(Exists(final_rounds.exclude(status='0')), then=Value('2')),
+        When(Exists(rounds.exclude(status='0')), then=Value('1')),
+        default=Value('0'),
+        output_field=CharField(),
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trivia', '0008_game_list_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='phase',
+            field=models.CharField(choices=[('0', 'Not Started'), ('1', 'Rounds'), ('2', 'Final Round'), ('3', 'Finished')], default='0', editable=False, max_length=1),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
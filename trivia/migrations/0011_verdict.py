@@ -0,0 +1,27 @@
+# Generated by Django 3.0.6 on 2026-10-18 12:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trivia', '0010_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Verdict',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('answer_key', models.CharField(max_length=64)),
+                ('response', models.CharField(max_length=150)),
+                ('correct', models.BooleanField()),
+                ('updated', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='verdict',
+            constraint=models.UniqueConstraint(fields=('answer_key', 'response'), name='unique_verdict'),
+        ),
+    ]
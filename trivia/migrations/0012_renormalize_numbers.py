@@ -0,0 +1,95 @@
+import unicodedata
+
+from django.db import migrations, transaction
+
+CHUNK_SIZE = 2000
+
+# Only text with punctuation between digits normalizes differently now
+NUMBER = r'[0-9][.,/][0-9]'
+
+
+# trivia.answers as of this migration, frozen like the copy in 0006
+
+ARTICLES = ('the', 'a', 'an')
+NUMBER_PUNCTUATION = '.,/'
+
+
+def _fold(text, i):
+    char = text[i]
+    if char in NUMBER_PUNCTUATION and 0 < i < len(text) - 1 and text[i - 1].isdigit() and text[i + 1].isdigit():
+        return char
+    category = unicodedata.category(char)
+    if category == 'Pd':
+        return ' '
+    if category.startswith('P') or unicodedata.combining(char):
+        return ''
+    return char
+
+
+def normalize(text, max_length=None):
+    if not text:
+        return ''
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(_fold(text, i) for i in range(len(text)))
+    words = text.casefold().split()
+    if len(words) > 1 and words[0] in ARTICLES:
+        words = words[1:]
+    return ' '.join(words)[:max_length]
+
+
+def answer_keys(answer, alt_answers, max_length=None):
+    alternatives = [text.strip() for text in (alt_answers or '').split(',') if text.strip()]
+    keys = (normalize(text, max_length) for text in [answer] + alternatives)
+    return sorted({key for key in keys if key})
+
+
+def chunks(queryset):
+    last = 0
+    while True:
+        chunk = list(queryset.filter(pk__gt=last).order_by('pk')[:CHUNK_SIZE])
+        if not chunk:
+            return
+        yield chunk
+        last = chunk[-1].pk
+
+
+def renormalize(apps, schema_editor):
+    Question = apps.get_model('trivia', 'Question')
+    FinalRound = apps.get_model('trivia', 'FinalRound')
+    AcceptedAnswer = apps.get_model('trivia', 'AcceptedAnswer')
+    QuestionResponse = apps.get_model('trivia', 'QuestionResponse')
+    FinalAnswer = apps.get_model('trivia', 'FinalAnswer')
+
+    for owner, model in [('question', Question), ('finalround', FinalRound)]:
+        owners = model.objects.filter(answer__regex=NUMBER) | model.objects.filter(alt_answers__regex=NUMBER)
+        for chunk in chunks(owners.only('id', 'answer', 'alt_answers')):
+            with transaction.atomic():
+                AcceptedAnswer.objects.filter(**{f'{owner}__in': chunk}).delete()
+                AcceptedAnswer.objects.bulk_create([
+                    AcceptedAnswer(normalized=key, **{owner: obj})
+                    for obj in chunk
+                    for key in answer_keys(obj.answer, obj.alt_answers, 250)
+                ])
+
+    for model, source, target, max_length in [
+        (QuestionResponse, 'response', 'normalized_response', 150),
+        (FinalAnswer, 'answer', 'normalized_answer', 200),
+    ]:
+        for chunk in chunks(model.objects.filter(**{f'{source}__regex': NUMBER}).only('id', source)):
+            for obj in chunk:
+                setattr(obj, target, normalize(getattr(obj, source), max_length))
+            with transaction.atomic():
+                model.objects.bulk_update(chunk, [target])
+
+
+class Migration(migrations.Migration):
+    # Each chunk commits on its own, as in 0006
+    atomic = False
+
+    dependencies = [
+        ('trivia', '0011_verdict'),
+    ]
+
+    operations = [
+        migrations.RunPython(renormalize, migrations.RunPython.noop),
+    ]
@@ -1,47 +1,58 @@
 from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import connection, models, transaction
 from django.db.models import Sum
+from django.db.models.signals import m2m_changed
 from django.urls import reverse
 
+from .answers import normalize
+
 # Create your models here.
 
 class Game(models.Model):
+    PHASE_CHOICES = [
+        ('0', 'Not Started'),
+        ('1', 'Rounds'),
+        ('2', 'Final Round'),
+        ('3', 'Finished'),
+    ]
     player = models.ManyToManyField(settings.AUTH_USER_MODEL)
     game_title = models.CharField(max_length=100)
     pub_date = models.DateTimeField('date published')
     completed = models.BooleanField(default=False)
+    # Kept in step with the round statuses by trivia.transitions.update_phase
+    phase = models.CharField(max_length=1, choices=PHASE_CHOICES, default='0', editable=False)
 
     class Meta:
-        ordering = ('-pub_date',)
+        # id breaks ties so the game list can page with a (pub_date, id) cursor
+        ordering = ('-pub_date', '-id')
+        indexes = [
+            models.Index(fields=['-pub_date', '-id'], name='game_recent_idx'),
+            models.Index(fields=['completed', '-pub_date', '-id'], name='game_completed_idx'),
+        ]
 
     def __str__(self):
         return self.game_title
 
-    def round_status_sum(self):
-        return sum([int(x.status) for x in self.round_set.all()])
-    
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        from .scoreboard import bump
+        bump(self.id)
+
     def score_rounds(self):
         # score the rounds (separated out for final wager clarity)
-        dict = {}
-        for player in self.player.all():
-            dict[player] = {}
-            for round in self.round_set.all():
-                score = round.score_round()
-                dict[player].update(score[player])
-            dict[player].update({'total': sum(dict[player].values())})
-        return dict
+        from .scoring import score_rounds
+        return score_rounds(self)
 
     def score_game(self):
         # total game score
-        dict = self.score_rounds()
-        for player in self.player.all():
-            # delete the old total score for each player from score_rounds()
-            del dict[player]['total']
-            for round in self.finalround_set.all():
-                dict[player].update(round.score_finalround()[player])
-            dict[player].update({'total': sum(dict[player].values())})
-        return dict
+        from .scoring import score_game
+        return score_game(self)
+
+    def score_table(self):
+        # same as score_game, read from the maintained Score table
+        from .scoring import score_table
+        return score_table(self)
 
 
 class Round(models.Model):
@@ -61,19 +72,40 @@ class Round(models.Model):
     def get_absolute_url(self):
         return reverse('trivia:game_detail', kwargs={'pk': self.game_id})
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_status = dict(zip(field_names, values)).get('status')
+        return instance
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        from .scoreboard import bump
+        bump(self.game_id)
+        if getattr(self, '_loaded_status', None) != self.status:
+            from .live import publish
+            from .transitions import update_phase
+            publish(
+                self.game_id, 'status', kind='round', id=self.id,
+                status=str(self.status), label=self.get_status_display(),
+            )
+            update_phase(self.game_id)
+        self._loaded_status = self.status
+
+    def delete(self, *args, **kwargs):
+        from .scoreboard import bump
+        from .transitions import update_phase
+        bump(self.game_id)
+        deleted = super().delete(*args, **kwargs)
+        update_phase(self.game_id)
+        return deleted
+
     def score_round(self):
-        dict = {}
-        for player in self.game.player.all():
-            correct = QuestionResponse.objects.filter(player=player, question__round=self, correct=True)
-            score = correct.aggregate(Sum('question__points'))['question__points__sum'] or 0
-            try:
-                double_round = DoubleRound.objects.get(round=self, player=player)
-                if self == double_round.round:
-                    score *= double_round.multiplier
-            except DoubleRound.DoesNotExist:
-                pass
-            dict[player] = {self: score}
-        return dict
+        from .scoring import score_rounds
+        return {
+            player: {self: scores[self]}
+            for player, scores in score_rounds(self.game, rounds=[self]).items()
+        }
 
 
 class FinalRound(models.Model):
@@ -98,24 +130,46 @@ class FinalRound(models.Model):
     def __str__(self):
         return self.category
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        loaded = dict(zip(field_names, values))
+        instance._loaded_status = loaded.get('status')
+        instance._loaded_answers = (loaded.get('answer'), loaded.get('alt_answers'))
+        return instance
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        if getattr(self, '_loaded_answers', None) != (self.answer, self.alt_answers):
+            AcceptedAnswer.set_for(finalround=self)
+            self._loaded_answers = (self.answer, self.alt_answers)
+        from .scoreboard import bump
+        bump(self.game_id)
+        loaded_status = getattr(self, '_loaded_status', None)
+        if loaded_status != self.status:
+            from .live import publish
+            from .transitions import update_phase
+            publish(
+                self.game_id, 'status', kind='final', id=self.id,
+                status=self.status, label=self.get_status_display(),
+            )
+            update_phase(self.game_id)
+        if (loaded_status == '4') != (self.status == '4'):
+            # wagers only count once the final round is closed
+            from .scoring import count_final_wagers
+            count_final_wagers(self.game_id, self.status == '4')
+        self._loaded_status = self.status
+
     def get_absolute_url(self):
         return reverse('trivia:game_detail', kwargs={'pk': self.game_id})
 
     def score_finalround(self):
-        dict = {}
-        for player in self.game.player.all():
-            if self.status != '4':
-                dict[player] = {self: 0}
-            else:
-                try:
-                    final_answer = FinalAnswer.objects.get(player=player, finalround__game=self.game)   
-                    if final_answer.correct:
-                        dict[player] = {self: final_answer.wager}
-                    else:
-                        dict[player] = {self: -final_answer.wager}
-                except FinalAnswer.DoesNotExist:
-                    dict[player] = {self: 0}
-        return dict
+        from .scoring import final_score, final_wagers
+        wagers = final_wagers(self.game) if self.status == '4' else {}
+        return {
+            player: {self: final_score(self, wagers.get(player.id))}
+            for player in self.game.player.all()
+        }
 
 
 class Question(models.Model):
@@ -128,6 +182,45 @@ class Question(models.Model):
     def __str__(self):
         return self.question
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        loaded = dict(zip(field_names, values))
+        instance._loaded_points = loaded.get('points')
+        instance._loaded_answers = (loaded.get('answer'), loaded.get('alt_answers'))
+        return instance
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        if getattr(self, '_loaded_answers', None) != (self.answer, self.alt_answers):
+            AcceptedAnswer.set_for(question=self)
+            self._loaded_answers = (self.answer, self.alt_answers)
+        from .scoreboard import changed
+        changed(self.round.game_id)
+        loaded_points = getattr(self, '_loaded_points', None)
+        if loaded_points is not None and loaded_points != self.points:
+            # re-score everyone who already got this question right
+            from .scoring import record_points
+            players = self.questionresponse_set.filter(correct=True).values_list('player_id', flat=True)
+            record_points(self.round.game_id, {
+                (player_id, self.round_id): self.points - loaded_points for player_id in players
+            })
+        self._loaded_points = self.points
+
+    def delete(self, *args, **kwargs):
+        from .scoreboard import changed
+        from .scoring import record_points
+        game_id = self.round.game_id
+        with transaction.atomic():
+            # take the question's points back off everyone who got it right
+            record_points(game_id, {
+                (player_id, self.round_id): -points
+                for player_id, points in self.questionresponse_set.filter(correct=True)
+                .values_list('player_id').annotate(points=Sum('question__points')).order_by()
+            })
+            changed(game_id)
+            return super().delete(*args, **kwargs)
+
     def answer_set(self):
         if self.alt_answers == None:
             return [self.answer.strip()]
@@ -135,9 +228,44 @@ class Question(models.Model):
             return [self.answer.strip()] + [x.strip() for x in self.alt_answers.split(',')]
 
 
+class AcceptedAnswer(models.Model):
+    '''
+    Normalized form of one accepted answer to a question or final round, so
+    responses can be checked against it with an indexed join.
+    '''
+    question = models.ForeignKey(Question, on_delete=models.CASCADE, null=True)
+    finalround = models.ForeignKey(FinalRound, on_delete=models.CASCADE, null=True)
+    normalized = models.CharField(max_length=250)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['question', 'normalized'], name='accepted_question_idx'),
+            models.Index(fields=['finalround', 'normalized'], name='accepted_finalround_idx'),
+        ]
+
+    def __str__(self):
+        return self.normalized
+
+    @classmethod
+    def build(cls, **owner):
+        '''Unsaved rows for the answers of the question=... or finalround=... given.'''
+        from .answers import answer_keys
+        obj, = owner.values()
+        max_length = cls._meta.get_field('normalized').max_length
+        return [cls(normalized=key, **owner) for key in answer_keys(obj.answer, obj.alt_answers, max_length)]
+
+    @classmethod
+    def set_for(cls, **owner):
+        cls.objects.filter(**owner).delete()
+        cls.objects.bulk_create(cls.build(**owner))
+
+
 class QuestionResponse(models.Model):
     correct = models.BooleanField(default=False)
     response = models.CharField(max_length=150)
+    normalized_response = models.CharField(max_length=150, default='', editable=False)
+    # How close the auto check thought the response was, from 0 to 1
+    confidence = models.FloatField(null=True, blank=True)
     question = models.ForeignKey(Question, on_delete=models.CASCADE)
     player = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
 
@@ -145,6 +273,9 @@ class QuestionResponse(models.Model):
         constraints = [
             models.UniqueConstraint(fields=['player', 'question'], name='unique_answer')
         ]
+        indexes = [
+            models.Index(fields=['question', 'normalized_response'], name='response_normalized_idx'),
+        ]
 
     def __str__(self):
         return self.response
@@ -152,12 +283,69 @@ class QuestionResponse(models.Model):
     def get_absolute_url(self):
         return reverse('trivia:round_detail', kwargs={'pk': self.question.round_id})
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_correct = dict(zip(field_names, values)).get('correct')
+        return instance
+
+    def save(self, *args, **kwargs):
+        self.normalized_response = normalize(self.response, 150)
+        super().save(*args, **kwargs)
+        if self.correct != bool(getattr(self, '_loaded_correct', False)):
+            self._score_change(1 if self.correct else -1)
+        else:
+            self._score_change(0)
+        self._loaded_correct = self.correct
+
+    def delete(self, *args, **kwargs):
+        self._score_change(-1 if getattr(self, '_loaded_correct', False) else 0)
+        return super().delete(*args, **kwargs)
+
+    @classmethod
+    def upsert(cls, game_id, player_id, responses):
+        '''
+        Save a player's {question id: response} in one statement, inserting
+        new responses and updating existing ones through the unique_answer
+        constraint. Only the response changes, so nothing needs re-scoring.
+        '''
+        if not responses:
+            return
+        quote = connection.ops.quote_name
+        rows = [
+            (response, normalize(response, 150), False, question_id, player_id)
+            for question_id, response in responses.items()
+        ]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {quote(cls._meta.db_table)} ({quote("response")}, '
+                f'{quote("normalized_response")}, {quote("correct")}, {quote("question_id")}, '
+                f'{quote("player_id")}) VALUES {", ".join(["(%s, %s, %s, %s, %s)"] * len(rows))} '
+                f'ON CONFLICT ({quote("player_id")}, {quote("question_id")}) DO UPDATE SET '
+                f'{quote("response")} = excluded.{quote("response")}, '
+                f'{quote("normalized_response")} = excluded.{quote("normalized_response")}',
+                [value for row in rows for value in row],
+            )
+        from .scoreboard import changed
+        changed(game_id)
+
+    def _score_change(self, sign):
+        # sign 0 when only the response changed; the game's data did either way
+        from .scoreboard import changed
+        from .scoring import record_points
+        points, round_id, game_id = Question.objects.values_list(
+            'points', 'round_id', 'round__game_id'
+        ).get(id=self.question_id)
+        changed(game_id)
+        record_points(game_id, {(self.player_id, round_id): sign * points})
+
 
 class FinalAnswer(models.Model):
     finalround = models.ForeignKey(FinalRound, on_delete=models.CASCADE)
     player = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     wager = models.IntegerField(default=0)
     answer = models.CharField(max_length=200, null=True)
+    normalized_answer = models.CharField(max_length=200, default='', editable=False)
     correct = models.BooleanField(default=False)
 
     def get_absolute_url(self):
@@ -165,25 +353,44 @@ class FinalAnswer(models.Model):
 
     def clean(self):
         max_wager = self.finalround.max_wager
-        game = self.finalround.game
-        score = game.score_rounds()[self.player]['total']
-        if max_wager > 0 and self.wager > max_wager:
-            raise ValidationError(f'Above max wager. Max wager is {max_wager}.')
-        elif max_wager == 0 and self.wager > score:
+        if max_wager > 0:
+            if self.wager > max_wager:
+                raise ValidationError(f'Above max wager. Max wager is {max_wager}.')
+            return
+        # One aggregate over this player's Score rows, so it costs the same however big the game is
+        from .scoring import pre_final_total
+        score = pre_final_total(self.finalround.game_id, self.player_id)
+        if self.wager > score:
             raise ValidationError(f'Your max wager is your score. You have {score}.')
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        loaded = dict(zip(field_names, values))
+        instance._loaded_wager = (loaded.get('wager'), loaded.get('correct'))
+        return instance
+
     def save(self, *args, **kwargs):
         '''
         if self.finalround.status != ('1' or '2'):
             return PermissionDenied("The round status doesn't allow that.")
         else:
         '''
+        self.normalized_answer = normalize(self.answer, 200)
         super().save(*args, **kwargs)
+        from .scoreboard import changed
+        from .scoring import record_final_wager
+        changed(self.finalround.game_id)
+        record_final_wager(self, getattr(self, '_loaded_wager', (0, False)))
+        self._loaded_wager = (self.wager, self.correct)
 
     class Meta:
         constraints = [
             models.UniqueConstraint(fields=['finalround', 'player'], name='one_final_answer')
         ]
+        indexes = [
+            models.Index(fields=['finalround', 'normalized_answer'], name='final_normalized_idx'),
+        ]
 
 class DoubleRound(models.Model):
     player = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
@@ -201,4 +408,126 @@ class DoubleRound(models.Model):
 
     def get_absolute_url(self):
         return reverse('trivia:game_detail', kwargs={'pk': self.game_id})
-        
\ No newline at end of file
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_round = dict(zip(field_names, values)).get('round_id')
+        return instance
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        from .scoring import move_double_round
+        move_double_round(
+            self.game_id, self.player_id, getattr(self, '_loaded_round', None),
+            self.round_id, self.multiplier,
+        )
+        self._loaded_round = self.round_id
+
+    def delete(self, *args, **kwargs):
+        from .scoring import move_double_round
+        move_double_round(self.game_id, self.player_id, self.round_id, None, 1)
+        return super().delete(*args, **kwargs)
+
+
+class Score(models.Model):
+    '''
+    Running score for one player in one round, kept up to date as answers are
+    graded. The final round is stored with no round; its points are the signed
+    wager and its multiplier stays 0 until the final round is closed.
+    '''
+    game = models.ForeignKey(Game, on_delete=models.CASCADE)
+    player = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    round = models.ForeignKey(Round, on_delete=models.CASCADE, null=True)
+    points = models.IntegerField(default=0)
+    multiplier = models.IntegerField(default=1)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['game', 'player', 'round'], name='unique_score'),
+            models.UniqueConstraint(
+                fields=['game', 'player'], condition=models.Q(round__isnull=True),
+                name='unique_final_score',
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.player}: {self.round or "Final"}, {self.points * self.multiplier}'
+        
+
+
+class Job(models.Model):
+    '''
+    Grading or a score refresh run in the background by trivia.jobs. Only one
+    job per key can be queued or running at a time, so repeated clicks share
+    it.
+    '''
+    KIND_CHOICES = [
+        ('grade', 'Auto check'),
+        ('scores', 'Score refresh'),
+    ]
+    STATUS_CHOICES = [
+        ('0', 'Queued'),
+        ('1', 'Running'),
+        ('2', 'Done'),
+        ('3', 'Failed'),
+    ]
+    ACTIVE = ('0', '1')
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    key = models.CharField(max_length=50)
+    game = models.ForeignKey(Game, on_delete=models.CASCADE)
+    round = models.ForeignKey(Round, on_delete=models.CASCADE, null=True, blank=True)
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES, default='0')
+    message = models.CharField(max_length=200, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['key'], condition=models.Q(status__in=['0', '1']), name='one_active_job',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'id'], name='job_queue_idx'),
+            models.Index(fields=['game', '-id'], name='job_game_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.get_kind_display()}: {self.round or self.game}'
+
+
+class Verdict(models.Model):
+    '''
+    A checked response remembered across games: whether a normalized response
+    is right for a question whose normalized accepted answers hash to
+    answer_key. See trivia.memo.
+    '''
+    answer_key = models.CharField(max_length=64)
+    response = models.CharField(max_length=150)
+    correct = models.BooleanField()
+    updated = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['answer_key', 'response'], name='unique_verdict'),
+        ]
+
+    def __str__(self):
+        return f'{self.response}: {"right" if self.correct else "wrong"}'
+
+
+def players_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    '''Players joining or leaving a game changes its scoreboard.'''
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    from .scoreboard import bump
+    if not reverse:
+        bump(instance.id)
+    else:
+        for game_id in pk_set or ():
+            bump(game_id)
+
+
+m2m_changed.connect(players_changed, sender=Game.player.through)
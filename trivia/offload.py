@@ -0,0 +1,89 @@
+'''
+The hot paths under ASGI without a worker thread per waiting request.
+
+Django 3.0 has no async views (they came in 3.1, and the async ORM later),
+so its ASGI handler runs each request start to finish on the event loop's
+default thread pool, which Python sizes at the CPU count plus four. With
+WriteLockMiddleware, every answer sheet, wager or final answer in a burst
+holds one of those few threads while it waits for its turn to write. Players
+reloading the game and round pages then queue behind them for a thread.
+
+router() sits in front of Django in mysite/asgi.py and changes two things:
+
+- Django gets a pool of TRIVIA_ASGI_THREADS threads, sized for requests that
+  spend their time in SQLite rather than in Python.
+- With TRIVIA_SQLITE_WRITE_LOCK on, a request that can write waits for its
+  turn in a coroutine, on an asyncio lock, and only takes a thread once it
+  has the turn. Waiting writers cost a coroutine each, reads always find a
+  thread, and WriteLockMiddleware lets these requests straight through. The
+  body is read before the turn is taken, and the turn is given up as soon
+  as the response starts, so a player on bad wifi only holds it while Django
+  works on their request, not while their phone sends or receives.
+
+See the stress_asgi command for the numbers.
+'''
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from . import sqlite
+
+THREADS = getattr(settings, 'TRIVIA_ASGI_THREADS', 32)
+
+
+async def _read_body(receive):
+    '''Every message up to the end of the request body (or a disconnect).'''
+    messages = []
+    while True:
+        message = await receive()
+        messages.append(message)
+        if message['type'] != 'http.request' or not message.get('more_body'):
+            return messages
+
+
+def router(django_application, threads=THREADS, write_turns=None):
+    '''
+    Run Django on a pool of `threads` threads. With write_turns (by default
+    TRIVIA_SQLITE_WRITE_LOCK) writing requests wait for their turn here.
+    '''
+    state = {}
+
+    def start(loop):
+        # Django's sync_to_async runs requests on the loop's default executor
+        loop.set_default_executor(ThreadPoolExecutor(threads, thread_name_prefix='trivia-asgi'))
+        state['loop'] = loop
+        state['turn'] = asyncio.Lock()
+
+    async def application(scope, receive, send):
+        loop = asyncio.get_running_loop()
+        if state.get('loop') is not loop:
+            start(loop)
+        turns = sqlite.WRITE_LOCK if write_turns is None else write_turns
+        if not turns or scope['type'] != 'http' or scope['method'] in sqlite.SAFE_METHODS:
+            return await django_application(scope, receive, send)
+        messages = await _read_body(receive)
+
+        async def replay():
+            return messages.pop(0) if messages else await receive()
+
+        turn = state['turn']
+        await turn.acquire()
+        held = True
+
+        def give_up_turn():
+            nonlocal held
+            if held:
+                held = False
+                turn.release()
+
+        async def send_after_turn(message):
+            # Django only sends once the handler is done with the database
+            give_up_turn()
+            await send(message)
+
+        try:
+            return await django_application({**scope, sqlite.WRITE_TURN: True}, replay, send_after_turn)
+        finally:
+            give_up_turn()
+    return application
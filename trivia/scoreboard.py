@@ -0,0 +1,176 @@
+'''
+Cached scoreboard fragments for game_detail.html.
+
+Every game has a version number in the cache. Anything that can change the
+board bumps it (after the transaction commits), and rendered fragments are
+stored under the version they were built from, so a stale fragment is never
+looked up again and simply ages out. Reads between bumps are served straight
+from the cache without touching the database.
+
+A second, data version moves whenever anything trivia.state loads changes,
+including things the board doesn't show like response text. Every board bump
+moves it too.
+
+Staff with background jobs on also get the game's job list, cached with
+their board; trivia.jobs bumps the version whenever a job changes.
+
+Live pages (trivia.live) are sent every new version, so they can tell when
+they missed a change.
+
+Inside batched() the bumps are collected instead, and each game's are
+scheduled once at the end, so a change touching many rounds invalidates
+everything once.
+'''
+import threading
+import time
+from contextlib import contextmanager
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from . import live
+
+CACHE_ALIAS = getattr(settings, 'TRIVIA_SCOREBOARD_CACHE', 'default')
+TIMEOUT = getattr(settings, 'TRIVIA_SCOREBOARD_TIMEOUT', 60 * 60 * 6)
+
+HITS_KEY = 'trivia:scoreboard:hits'
+MISSES_KEY = 'trivia:scoreboard:misses'
+
+
+def _cache():
+    return caches[CACHE_ALIAS]
+
+
+def _version_key(game_id):
+    return f'trivia:game:{game_id}:version'
+
+
+def _data_key(game_id):
+    return f'trivia:game:{game_id}:data'
+
+
+def _incr(key, start=1):
+    cache = _cache()
+    try:
+        return cache.incr(key)
+    except ValueError:
+        cache.add(key, start, None)
+        return cache.get(key)
+
+
+def _current(key):
+    current = _cache().get(key)
+    if current is None:
+        current = _bump_now(key)
+    return current
+
+
+def version(game_id):
+    return _current(_version_key(game_id))
+
+
+def data_version(game_id):
+    return _current(_data_key(game_id))
+
+
+def _bump_now(key):
+    # If the counter was evicted, restart it from the clock so it can't land
+    # on a version we already stored something under.
+    return _incr(key, start=int(time.time() * 1000))
+
+
+def next_version(game_id):
+    '''Move a game's scoreboard version on now, and return the new one.'''
+    return _bump_now(_version_key(game_id))
+
+
+_batch = threading.local()
+
+
+def _schedule(key, action):
+    actions = getattr(_batch, 'actions', None)
+    if actions is not None:
+        actions[key] = action
+    else:
+        transaction.on_commit(action)
+
+
+@contextmanager
+def batched():
+    '''Collect bumps made inside the block and schedule each key once when it ends.'''
+    if getattr(_batch, 'actions', None) is not None:
+        # already batching further out
+        yield
+        return
+    _batch.actions = {}
+    try:
+        yield
+        actions = list(_batch.actions.values())
+    finally:
+        _batch.actions = None
+    for action in actions:
+        transaction.on_commit(action)
+
+
+def changed(game_id):
+    '''Mark a game's data as changed once the current transaction commits.'''
+    key = _data_key(game_id)
+    _schedule(key, partial(_bump_now, key))
+
+
+def bump(game_id):
+    '''
+    Mark a game's scoreboard, and so its data, as changed once the current
+    transaction commits. The new version goes out to its live pages.
+    '''
+    _schedule(_version_key(game_id), partial(live.announce, game_id))
+    changed(game_id)
+
+
+def render(request, game_id):
+    '''
+    The scoreboard fragment for a game along with the game's title, the
+    version it was built from (and for staff, its jobs), from the cache if
+    nothing has changed since it was last rendered.
+    '''
+    cache = _cache()
+    staff = request.user.is_staff
+    current = version(game_id)
+    key = f'trivia:scoreboard:{game_id}:{current}:{int(staff)}'
+    board = cache.get(key)
+    if board is None:
+        _incr(MISSES_KEY)
+        from .scoring import score_state
+        from .state import get_state
+        state = get_state(game_id, request)
+        context = {'game': state, 'scores': score_state(state)}
+        board = {
+            'title': str(state),
+            'html': render_to_string('trivia/scoreboard.html', context, request),
+            'jobs': None,
+        }
+        from . import jobs
+        if staff and jobs.ENABLED:
+            board['jobs'] = jobs.for_game(game_id)
+        cache.set(key, board, TIMEOUT)
+    else:
+        _incr(HITS_KEY)
+    return {
+        'game_id': game_id, 'game_title': board['title'], 'scoreboard': mark_safe(board['html']),
+        'jobs': board['jobs'], 'version': current,
+    }
+
+
+def stats():
+    cache = _cache()
+    hits = cache.get(HITS_KEY) or 0
+    misses = cache.get(MISSES_KEY) or 0
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': hits / (hits + misses) if hits + misses else None,
+    }
@@ -0,0 +1,290 @@
+'''
+Scoreboard math for a whole game.
+
+Everything here runs a fixed number of grouped queries per game, no matter
+how many players or rounds there are. The dicts that come back have the same
+shape game_detail.html has always iterated:
+{player: {round: score, ..., finalround: score, 'total': score}}
+
+score_game() works from the raw responses. The Score table holds the same
+numbers per (game, player, round) and is patched with deltas as answers are
+graded, so the game page reads it (score_state()) instead of recounting
+everything, and the live deltas it is sent line up with what it shows.
+'''
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+
+from . import live, scoreboard
+from .models import DoubleRound, FinalAnswer, FinalRound, QuestionResponse, Score
+
+
+def round_points(game):
+    '''Points from correct answers keyed by (player_id, round_id), before doubling.'''
+    rows = (
+        QuestionResponse.objects
+        .filter(question__round__game=game, correct=True)
+        .values_list('player_id', 'question__round_id')
+        .annotate(points=Sum('question__points'))
+        .order_by()
+    )
+    return {(player_id, round_id): points for player_id, round_id, points in rows}
+
+
+def double_rounds(game):
+    '''Multipliers keyed by (player_id, round_id).'''
+    rows = DoubleRound.objects.filter(round__game=game).values_list(
+        'player_id', 'round_id', 'multiplier'
+    )
+    return {(player_id, round_id): multiplier for player_id, round_id, multiplier in rows}
+
+
+def final_wagers(game):
+    '''(wager, correct) keyed by player_id for the game's final round.'''
+    rows = FinalAnswer.objects.filter(finalround__game=game).values_list(
+        'player_id', 'wager', 'correct'
+    )
+    return {player_id: (wager, correct) for player_id, wager, correct in rows}
+
+
+def signed_wager(wager, correct):
+    return wager if correct else -wager
+
+
+def final_score(finalround, wager):
+    # Wagers only count once the final round is closed
+    if finalround.status != '4' or wager is None:
+        return 0
+    return signed_wager(*wager)
+
+
+def score_rounds(game, rounds=None):
+    '''Per-round scores and a running total for every player in the game.'''
+    players = list(game.player.all())
+    if rounds is None:
+        rounds = list(game.round_set.all())
+    points = round_points(game)
+    doubles = double_rounds(game)
+    scores = {}
+    for player in players:
+        row = {}
+        for round in rounds:
+            key = (player.id, round.id)
+            row[round] = points.get(key, 0) * doubles.get(key, 1)
+        row['total'] = sum(row.values())
+        scores[player] = row
+    return scores
+
+
+def score_game(game):
+    '''Round scores plus the final round wager for every player in the game.'''
+    scores = score_rounds(game)
+    finalrounds = list(game.finalround_set.all())
+    wagers = final_wagers(game) if finalrounds else {}
+    for player, row in scores.items():
+        # drop the rounds-only total and add it back after the final round
+        del row['total']
+        for finalround in finalrounds:
+            row[finalround] = final_score(finalround, wagers.get(player.id))
+        row['total'] = sum(row.values())
+    return scores
+
+
+# The Score table ##########################################
+
+def _adjust(game_id, player_id, round_id, points=0, multiplier=None, new_multiplier=1):
+    '''
+    Add points to (and/or set the multiplier of) one Score row in place,
+    creating the row the first time it is touched.
+    '''
+    rows = Score.objects.filter(game_id=game_id, player_id=player_id, round_id=round_id)
+    changes = {'points': F('points') + points}
+    if multiplier is not None:
+        changes['multiplier'] = multiplier
+    if rows.update(**changes):
+        return
+    try:
+        with transaction.atomic():
+            Score.objects.create(
+                game_id=game_id, player_id=player_id, round_id=round_id, points=points,
+                multiplier=new_multiplier if multiplier is None else multiplier,
+            )
+    except IntegrityError:
+        # someone else created it first
+        rows.update(**changes)
+
+
+def record_points(game_id, deltas):
+    '''
+    Apply point deltas keyed by (player_id, round_id) to a game's Score rows,
+    in a fixed number of queries however many rows are touched.
+    '''
+    deltas = {key: points for key, points in deltas.items() if points}
+    if not deltas:
+        return
+    multipliers = {}
+    with transaction.atomic():
+        rows = {
+            (row.player_id, row.round_id): row
+            for row in Score.objects.filter(
+                game_id=game_id, player_id__in={player_id for player_id, _ in deltas}
+            ).only('id', 'player_id', 'round_id', 'multiplier')
+        }
+        changed, missing = [], []
+        for (player_id, round_id), points in deltas.items():
+            row = rows.get((player_id, round_id))
+            if row is None:
+                row = Score(
+                    game_id=game_id, player_id=player_id, round_id=round_id, points=points,
+                    multiplier=1 if round_id else _final_multiplier(game_id),
+                )
+                missing.append(row)
+            else:
+                row.points = F('points') + points
+                changed.append(row)
+            multipliers[(player_id, round_id)] = row.multiplier
+        Score.objects.bulk_update(changed, ['points'])
+        try:
+            with transaction.atomic():
+                Score.objects.bulk_create(missing)
+        except IntegrityError:
+            # someone else created some of them first
+            for row in missing:
+                _adjust(game_id, row.player_id, row.round_id, points=row.points,
+                        new_multiplier=row.multiplier)
+    scoreboard.bump(game_id)
+    # the page shows doubled points, so the deltas are doubled too
+    live.publish_scores(game_id, [
+        {'player': player_id, 'round': round_id or 'final', 'delta': points * multipliers[(player_id, round_id)]}
+        for (player_id, round_id), points in deltas.items()
+    ])
+
+
+def _final_multiplier(game_id):
+    closed = FinalRound.objects.filter(game_id=game_id, status='4').exists()
+    return 1 if closed else 0
+
+
+def move_double_round(game_id, player_id, old_round_id, round_id, multiplier):
+    '''
+    Take a player's double off old_round_id and put it on round_id with the
+    given multiplier. Either round may be None.
+    '''
+    changes = {}
+    if old_round_id is not None and old_round_id != round_id:
+        changes[old_round_id] = 1
+    if round_id is not None:
+        changes[round_id] = multiplier
+    rows = dict(
+        (row_round_id, (points, row_multiplier))
+        for row_round_id, points, row_multiplier in Score.objects.filter(
+            game_id=game_id, player_id=player_id, round_id__in=changes
+        ).values_list('round_id', 'points', 'multiplier')
+    )
+    cells = []
+    for changed_round_id, new_multiplier in changes.items():
+        _adjust(game_id, player_id, changed_round_id, multiplier=new_multiplier)
+        points, old_multiplier = rows.get(changed_round_id, (0, 1))
+        cells.append({
+            'player': player_id, 'round': changed_round_id,
+            'delta': points * (new_multiplier - old_multiplier),
+            'double': changed_round_id == round_id,
+        })
+    scoreboard.bump(game_id)
+    live.publish_scores(game_id, cells)
+
+
+def record_final_wager(final_answer, loaded):
+    '''Move a player's final round row by the change in their signed wager.'''
+    points = signed_wager(final_answer.wager, final_answer.correct) - signed_wager(*loaded)
+    if not points:
+        return
+    game_id, status = FinalRound.objects.values_list('game_id', 'status').get(
+        id=final_answer.finalround_id
+    )
+    _adjust(
+        game_id, final_answer.player_id, None, points=points,
+        new_multiplier=1 if status == '4' else 0,
+    )
+    scoreboard.bump(game_id)
+    if status == '4':
+        live.publish_scores(game_id, [
+            {'player': final_answer.player_id, 'round': 'final', 'delta': points}
+        ])
+
+
+def count_final_wagers(game_id, counted):
+    rows = Score.objects.filter(game_id=game_id, round=None)
+    wagers = list(rows.values_list('player_id', 'points'))
+    rows.update(multiplier=1 if counted else 0)
+    live.publish_scores(game_id, [
+        {'player': player_id, 'round': 'final', 'delta': points if counted else -points}
+        for player_id, points in wagers
+    ])
+
+
+def pre_final_total(game_id, player_id):
+    '''
+    A player's total before the final round, from the Score table. It's a
+    single statement, so it reads one consistent snapshot of the player's rows
+    even while other answers are being graded.
+    '''
+    total = Score.objects.filter(
+        game_id=game_id, player_id=player_id, round__isnull=False
+    ).aggregate(total=Sum(F('points') * F('multiplier')))['total']
+    return total or 0
+
+
+def _table_scores(game_id, players, rounds, finalrounds):
+    totals = {
+        (player_id, round_id): points * multiplier
+        for player_id, round_id, points, multiplier in Score.objects.filter(game_id=game_id).values_list(
+            'player_id', 'round_id', 'points', 'multiplier'
+        )
+    }
+    scores = {}
+    for player in players:
+        row = {round: totals.get((player.id, round.id), 0) for round in rounds}
+        for finalround in finalrounds:
+            row[finalround] = totals.get((player.id, None), 0)
+        row['total'] = sum(row.values())
+        scores[player] = row
+    return scores
+
+
+def score_table(game):
+    '''Same result as score_game(), read from the Score table.'''
+    return _table_scores(
+        game.id, list(game.player.all()), list(game.round_set.all()), list(game.finalround_set.all()),
+    )
+
+
+def score_state(state):
+    '''Same as score_table(), keyed by a loaded GameState's (see trivia.state) players and rounds.'''
+    return _table_scores(
+        state.id, state.players, state.rounds, [state.final_round] if state.final_round else [],
+    )
+
+
+@transaction.atomic
+def rebuild_scores(game):
+    '''Throw away a game's Score rows and recount them from the raw responses.'''
+    Score.objects.filter(game=game).delete()
+    points = round_points(game)
+    doubles = double_rounds(game)
+    rows = [
+        Score(game=game, player_id=player_id, round_id=round_id, points=score,
+              multiplier=doubles.get((player_id, round_id), 1))
+        for (player_id, round_id), score in points.items()
+    ]
+    rows += [
+        Score(game=game, player_id=player_id, round_id=round_id, multiplier=multiplier)
+        for (player_id, round_id), multiplier in doubles.items()
+        if (player_id, round_id) not in points
+    ]
+    for finalround in game.finalround_set.all():
+        rows += [
+            Score(game=game, player_id=player_id, round=None, points=signed_wager(*wager),
+                  multiplier=1 if finalround.status == '4' else 0)
+            for player_id, wager in final_wagers(game).items()
+        ]
+    Score.objects.bulk_create(rows)
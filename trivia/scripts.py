@@ -1,28 +1,252 @@
+'''
+Import games from CSV files.
+
+Every row is either a question:
+
+    round category, question, answer[, alt answers[, points]]
+
+or the game's final round:
+
+    final round, category, question, answer[, alt answers]
+
+Alt answers are comma separated, so quote that column when there is more
+than one. Rows are parsed one at a time as the file is read, and a game is
+written with bulk inserts inside a single transaction, so it either shows up
+complete or not at all. Rows that can't be used are skipped and reported
+with their line numbers.
+
+Parsing doesn't touch the database, so import_files() can spread it over
+worker processes while the main process, the only one writing, saves the
+finished games a batch at a time.
+'''
 import csv
 import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from django.db import transaction
 from django.utils import timezone
 
-from trivia.models import Game, Round, FinalRound, Question
+from trivia.models import AcceptedAnswer, FinalRound, Game, Question, Round
+from trivia.workers import setup_worker
+
+RejectedRow = namedtuple('RejectedRow', ['line', 'reason'])
+ImportReport = namedtuple('ImportReport', ['game', 'rounds', 'questions', 'final_round', 'rejected'])
+
+# A parsed file, ready to be written: rounds maps each category to its
+# questions in file order, final_round is a dict or None.
+GamePayload = namedtuple('GamePayload', ['name', 'rounds', 'final_round', 'rejected'])
+
+
+def read_rows(file_path):
+    '''(line number, row) for every non-blank row in the file.'''
+    with open(file_path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f)
+        for row in reader:
+            row = [cell.strip() for cell in row]
+            if any(row):
+                yield reader.line_num, row
+
+
+def _field_limit(model, field):
+    return model._meta.get_field(field).max_length
+
+
+def _check_lengths(model, **values):
+    for field, value in values.items():
+        if value and len(value) > _field_limit(model, field):
+            return f'{field} is longer than {_field_limit(model, field)} characters'
+    return None
+
+
+def parse_question(row):
+    '''A question dict from a CSV row, or a reason it can't be used.'''
+    if len(row) < 3:
+        return None, 'expected at least a round, question and answer'
+    if len(row) > 5:
+        return None, 'too many columns'
+    category, question, answer, alt_answers, points = (row + ['', ''])[:5]
+    if not question or not answer:
+        return None, 'missing question or answer'
+    try:
+        points = int(points) if points else Question._meta.get_field('points').default
+    except ValueError:
+        return None, f'points must be a whole number, not {points!r}'
+    error = (
+        _check_lengths(Round, category=category)
+        or _check_lengths(Question, question=question, answer=answer, alt_answers=alt_answers)
+    )
+    if error:
+        return None, error
+    return {
+        'question': question, 'answer': answer, 'alt_answers': alt_answers or None, 'points': points,
+    }, None
+
+
+def parse_final_round(row):
+    if len(row) < 4:
+        return None, 'expected final round, category, question and answer'
+    if len(row) > 5:
+        return None, 'too many columns'
+    _, category, question, answer, alt_answers = (row + [''])[:5]
+    if not category or not question or not answer:
+        return None, 'missing category, question or answer'
+    error = _check_lengths(
+        FinalRound, category=category, question=question, answer=answer, alt_answers=alt_answers
+    )
+    if error:
+        return None, error
+    return {
+        'category': category, 'question': question, 'answer': answer, 'alt_answers': alt_answers or None,
+    }, None
+
+
+def parse_game(file_path, game_name=None):
+    '''Read and check a whole file without touching the database.'''
+    rounds = {}
+    final_round = None
+    rejected = []
+    for line, row in read_rows(file_path):
+        if row[0].lower() == 'final round':
+            if final_round is not None:
+                rejected.append(RejectedRow(line, 'a game can only have one final round'))
+                continue
+            final_round, error = parse_final_round(row)
+        else:
+            question, error = parse_question(row)
+            if question:
+                rounds.setdefault(row[0], []).append(question)
+        if error:
+            rejected.append(RejectedRow(line, error))
+    return GamePayload(game_name or os.path.basename(file_path), rounds, final_round, rejected)
 
-def import_game(file_path, game_name=None):
-    if game_name:
-        name = game_name
+
+def _with_ids(model, objs, **owner):
+    '''
+    bulk_create objs and make sure they come back with their primary keys.
+    SQLite doesn't return them, so read them back in insert order.
+    '''
+    model.objects.bulk_create(objs)
+    if objs and objs[0].pk is None:
+        ids = model.objects.filter(**owner).order_by('pk').values_list('pk', flat=True)
+        for obj, pk in zip(objs, ids):
+            obj.pk = pk
+    return objs
+
+
+@transaction.atomic
+def write_game(payload):
+    '''Create a game from a parsed file with a handful of bulk inserts.'''
+    game = Game.objects.create(game_title=payload.name, pub_date=timezone.now())
+    rounds = _with_ids(Round, [Round(category=category, game=game) for category in payload.rounds], game=game)
+    questions = _with_ids(Question, [
+        Question(round=round, **question)
+        for round, round_questions in zip(rounds, payload.rounds.values())
+        for question in round_questions
+    ], round__game=game)
+    answers = [answer for question in questions for answer in AcceptedAnswer.build(question=question)]
+    if payload.final_round:
+        final_round, = _with_ids(FinalRound, [FinalRound(game=game, **payload.final_round)], game=game)
+        answers += AcceptedAnswer.build(finalround=final_round)
     else:
-        name = os.path.basename(file_path)
-    new_game = Game.objects.create(game_title=name, pub_date=timezone.now())
+        final_round = None
+    AcceptedAnswer.objects.bulk_create(answers)
+    return ImportReport(game, len(rounds), len(questions), final_round, payload.rejected)
+
+
+def _usable(payload, strict):
+    if strict and payload.rejected:
+        return False
+    return bool(payload.rounds or payload.final_round)
+
+
+def _unwritten(payload):
+    '''The report for a payload that was parsed but not written.'''
+    return ImportReport(
+        None, len(payload.rounds), sum(len(questions) for questions in payload.rounds.values()),
+        payload.final_round, payload.rejected,
+    )
+
+
+def import_game(file_path, game_name=None, strict=False, dry_run=False):
+    '''
+    Import one CSV file as a new game and report what was skipped. Nothing
+    is written with dry_run, if the file has no usable rows, or with strict
+    if any row was rejected.
+    '''
+    payload = parse_game(file_path, game_name)
+    if dry_run or not _usable(payload, strict):
+        return _unwritten(payload)
+    return write_game(payload)
+
+
+def _parse_file(file_path):
     try:
-        with open(file_path) as f:
-            csv_file = csv.reader(f)
-            round_dict = {}
-            for row in csv_file:
-                if row[0].lower() == 'final round':
-                    FinalRound.objects.create(
-                        category=row[1], game=new_game, question=row[2], answer=row[3]
-                    )
-                else:
-                    if row[0] not in round_dict.keys():
-                        r = Round.objects.create(category=row[0], game=new_game)
-                        round_dict[row[0]] = r
-                    Question.objects.create(round=round_dict[row[0]], question=row[1], answer=row[2])
-    except:
-        new_game.delete()
+        return parse_game(file_path)
+    except (OSError, UnicodeDecodeError, csv.Error) as e:
+        return GamePayload(os.path.basename(file_path), {}, None, [RejectedRow(0, str(e))])
+
+
+def parse_files(paths, workers=1):
+    '''(path, payload) for every file in order, parsed in worker processes when workers > 1.'''
+    if workers <= 1:
+        for path in paths:
+            yield path, _parse_file(path)
+        return
+    chunksize = max(1, len(paths) // (workers * 4))
+    with ProcessPoolExecutor(workers, initializer=setup_worker) as executor:
+        yield from zip(paths, executor.map(_parse_file, paths, chunksize=chunksize))
+
+
+def import_files(paths, workers=1, batch_size=20, dry_run=False, strict=False):
+    '''
+    Parse many files in parallel and write the games batch_size files per
+    transaction. Yields (path, ImportReport) as each file is done; with
+    dry_run the files are only parsed and checked.
+    '''
+    paths = list(paths)
+    batch = []
+
+    def write_batch():
+        with transaction.atomic():
+            reports = [
+                (path, write_game(payload) if _usable(payload, strict) else _unwritten(payload))
+                for path, payload in batch
+            ]
+        batch.clear()
+        return reports
+
+    for path, payload in parse_files(paths, workers):
+        if dry_run:
+            yield path, _unwritten(payload)
+            continue
+        batch.append((path, payload))
+        if len(batch) >= batch_size:
+            yield from write_batch()
+    if batch:
+        yield from write_batch()
+
+
+def benchmark_parsing(paths, worker_counts):
+    '''(workers, seconds, files per second) for parsing every file at each worker count.'''
+    paths = list(paths)
+    results = []
+    for workers in worker_counts:
+        start = time.perf_counter()
+        for _ in parse_files(paths, workers):
+            pass
+        seconds = time.perf_counter() - start
+        results.append((workers, seconds, len(paths) / seconds if seconds else float('inf')))
+    return results
+
+
+def csv_files(paths):
+    '''The given files, plus every .csv file directly inside any given directory.'''
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.lower().endswith('.csv'):
+                    yield os.path.join(path, name)
+        else:
+            yield path
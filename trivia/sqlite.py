@@ -0,0 +1,86 @@
+'''
+SQLite tuned for a room full of players submitting at once.
+
+Every new SQLite connection gets TRIVIA_SQLITE_PRAGMAS. The defaults turn on
+WAL journaling, so readers never block the writer and the writer never
+blocks readers. They relax fsyncs to once per checkpoint, which WAL keeps
+safe against crashes, enlarge the page cache and memory-map the file. They
+also make a connection wait up to 20 seconds for the write lock instead of
+failing with "database is locked".
+
+SQLite still allows one writer at a time. Even with a busy timeout, a
+transaction that reads before it writes can fail straight away if another
+write landed in between, so those call begin_writing() first. With
+TRIVIA_SQLITE_WRITE_LOCK on, WriteLockMiddleware
+lets only one writing request per process run at a time. Writers queue in
+Python instead of racing for the file lock. Other processes still wait on
+the busy timeout. Under ASGI, trivia.offload queues them before they take a
+thread.
+'''
+import threading
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+TUNED = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'busy_timeout': 20000,
+    'cache_size': -20000,
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'memory',
+}
+
+PRAGMAS = getattr(settings, 'TRIVIA_SQLITE_PRAGMAS', TUNED)
+WRITE_LOCK = getattr(settings, 'TRIVIA_SQLITE_WRITE_LOCK', False)
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS', 'TRACE')
+
+# In the ASGI scope of a request that trivia.offload already gave the write turn
+WRITE_TURN = 'trivia.write_turn'
+
+_write_lock = threading.Lock()
+
+
+def apply_pragmas(connection, pragmas=None):
+    if pragmas is None:
+        pragmas = PRAGMAS
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+
+
+def begin_writing(using=DEFAULT_DB_ALIAS):
+    '''
+    Call first thing inside transaction.atomic() when the transaction reads
+    before it writes. On SQLite it takes the write lock straight away, waiting
+    out the busy timeout if it has to, so the reads can't go stale before the
+    writes.
+    '''
+    connection = connections[using]
+    if connection.vendor == 'sqlite':
+        from .models import Game
+        with connection.cursor() as cursor:
+            # a write that touches nothing still takes the lock
+            cursor.execute(f'DELETE FROM {Game._meta.db_table} WHERE 0')
+
+
+@receiver(connection_created)
+def tune(sender, connection, **kwargs):
+    if connection.vendor == 'sqlite' and PRAGMAS:
+        apply_pragmas(connection)
+
+
+class WriteLockMiddleware:
+    '''With TRIVIA_SQLITE_WRITE_LOCK on, runs one request that can write at a time in this process.'''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not WRITE_LOCK or request.method in SAFE_METHODS or getattr(request, 'scope', {}).get(WRITE_TURN):
+            return self.get_response(request)
+        with _write_lock:
+            return self.get_response(request)
@@ -0,0 +1,263 @@
+'''
+One game's data, loaded in a single batch for every page that shows it.
+
+load() reads a game's players, rounds, questions, responses, double rounds
+and final round with one query each into small __slots__ objects, indexed by
+player, round and question, so pages look things up instead of walking ORM
+relations. get_state() memoizes it on the request, and in process across
+requests until the game's data version (see trivia.scoreboard) moves on.
+
+These are read-only snapshots: anything that writes still goes through the
+models.
+'''
+import threading
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.http import Http404
+
+from .models import DoubleRound, FinalAnswer, FinalRound, Game, Question, QuestionResponse, Round
+from .scoreboard import data_version
+
+MAX_GAMES = getattr(settings, 'TRIVIA_STATE_GAMES', 20)
+
+ROUND_STATUS = dict(Round.STATUS_CHOICES)
+FINAL_STATUS = dict(FinalRound.STATUS_CHOICES)
+
+
+class PlayerState:
+    __slots__ = ('id', 'username', 'first_name', 'double_round', 'multiplier')
+
+    def __init__(self, id, username, first_name):
+        self.id = id
+        self.username = username
+        self.first_name = first_name
+        self.double_round = None
+        self.multiplier = 1
+
+    def __str__(self):
+        return self.username
+
+    def get_username(self):
+        return self.username
+
+    def get_short_name(self):
+        return self.first_name
+
+
+class RoundState:
+    __slots__ = ('id', 'category', 'status', 'questions')
+
+    def __init__(self, id, category, status):
+        self.id = id
+        self.category = category
+        self.status = str(status)
+        self.questions = []
+
+    def __str__(self):
+        return self.category
+
+    def get_status_display(self):
+        return ROUND_STATUS.get(self.status, self.status)
+
+
+class QuestionState:
+    __slots__ = ('id', 'round_id', 'question', 'answer', 'alt_answers', 'points')
+
+    def __init__(self, id, round_id, question, answer, alt_answers, points):
+        self.id = id
+        self.round_id = round_id
+        self.question = question
+        self.answer = answer
+        self.alt_answers = alt_answers
+        self.points = points
+
+    def __str__(self):
+        return self.question
+
+
+class ResponseState:
+    __slots__ = ('id', 'question_id', 'round_id', 'player_id', 'response', 'correct', 'confidence')
+
+    def __init__(self, id, question_id, round_id, player_id, response, correct, confidence):
+        self.id = id
+        self.question_id = question_id
+        self.round_id = round_id
+        self.player_id = player_id
+        self.response = response
+        self.correct = correct
+        self.confidence = confidence
+
+    def __str__(self):
+        return self.response
+
+
+class FinalRoundState:
+    __slots__ = ('id', 'category', 'status', 'question', 'answer', 'max_wager')
+
+    def __init__(self, id, category, status, question, answer, max_wager):
+        self.id = id
+        self.category = category
+        self.status = str(status)
+        self.question = question
+        self.answer = answer
+        self.max_wager = max_wager
+
+    def __str__(self):
+        return self.category
+
+    def get_status_display(self):
+        return FINAL_STATUS.get(self.status, self.status)
+
+
+class FinalAnswerState:
+    __slots__ = ('id', 'player_id', 'wager', 'answer', 'correct')
+
+    def __init__(self, id, player_id, wager, answer, correct):
+        self.id = id
+        self.player_id = player_id
+        self.wager = wager
+        self.answer = answer
+        self.correct = correct
+
+
+class GameState:
+    __slots__ = (
+        'id', 'title', 'completed', 'phase', 'version', 'players', 'rounds', 'final_round', 'final_answers',
+        'questions', 'responses', '_players', '_rounds', '_by_player', '_by_round', '_by_question',
+        '_by_cell',
+    )
+
+    def __init__(self, id, title, completed, phase, version):
+        self.id = id
+        self.title = title
+        self.completed = completed
+        self.phase = phase
+        self.version = version
+        self.players = []
+        self.rounds = []
+        self.final_round = None
+        self.final_answers = {}
+        self.questions = {}
+        self.responses = []
+
+    def __str__(self):
+        return self.title
+
+    def index(self):
+        '''Build the lookups once everything is loaded.'''
+        self._players = {player.id: player for player in self.players}
+        self._rounds = {round.id: round for round in self.rounds}
+        self._by_player = defaultdict(list)
+        self._by_round = defaultdict(list)
+        self._by_question = defaultdict(list)
+        self._by_cell = {}
+        for response in self.responses:
+            self._by_player[response.player_id].append(response)
+            self._by_round[response.round_id].append(response)
+            self._by_question[response.question_id].append(response)
+            self._by_cell[(response.question_id, response.player_id)] = response
+
+    def player(self, player_id):
+        return self._players.get(player_id)
+
+    def round(self, round_id):
+        return self._rounds.get(round_id)
+
+    def player_responses(self, player_id):
+        return self._by_player.get(player_id, [])
+
+    def round_responses(self, round_id):
+        return self._by_round.get(round_id, [])
+
+    def question_responses(self, question_id):
+        return self._by_question.get(question_id, [])
+
+    def response(self, question_id, player_id):
+        return self._by_cell.get((question_id, player_id))
+
+
+@transaction.atomic
+def load(game_id, version=None):
+    '''Everything about a game in a fixed number of queries.'''
+    try:
+        state = GameState(*Game.objects.values_list('id', 'game_title', 'completed', 'phase').get(id=game_id), version)
+    except Game.DoesNotExist:
+        raise Http404('No game found matching the query')
+    state.players = [
+        PlayerState(*row) for row in get_user_model().objects.filter(game=game_id).order_by('id').values_list(
+            'id', 'username', 'first_name'
+        )
+    ]
+    state.rounds = [
+        RoundState(*row)
+        for row in Round.objects.filter(game=game_id).order_by('id').values_list('id', 'category', 'status')
+    ]
+    rounds = {round.id: round for round in state.rounds}
+    for row in Question.objects.filter(round__game=game_id).order_by('id').values_list(
+        'id', 'round_id', 'question', 'answer', 'alt_answers', 'points'
+    ):
+        question = QuestionState(*row)
+        state.questions[question.id] = question
+        rounds[question.round_id].questions.append(question)
+    state.responses = [
+        ResponseState(*row) for row in QuestionResponse.objects.filter(
+            question__round__game=game_id
+        ).order_by('id').values_list(
+            'id', 'question_id', 'question__round_id', 'player_id', 'response', 'correct', 'confidence'
+        )
+    ]
+    players = {player.id: player for player in state.players}
+    for player_id, round_id, multiplier in DoubleRound.objects.filter(game=game_id).values_list(
+        'player_id', 'round_id', 'multiplier'
+    ):
+        if player_id in players:
+            players[player_id].double_round = rounds.get(round_id)
+            players[player_id].multiplier = multiplier
+    final_round = FinalRound.objects.filter(game=game_id).values_list(
+        'id', 'category', 'status', 'question', 'answer', 'max_wager'
+    ).first()
+    if final_round:
+        state.final_round = FinalRoundState(*final_round)
+        state.final_answers = {
+            row[1]: FinalAnswerState(*row)
+            for row in FinalAnswer.objects.filter(finalround=state.final_round.id).values_list(
+                'id', 'player_id', 'wager', 'answer', 'correct'
+            )
+        }
+    state.index()
+    return state
+
+
+_states = OrderedDict()
+_lock = threading.Lock()
+
+
+def get_state(game_id, request=None):
+    '''
+    A game's GameState, loaded at most once per request and reused across
+    requests while the game's data version hasn't changed.
+    '''
+    if request is not None:
+        memo = request.__dict__.setdefault('_trivia_states', {})
+        if game_id in memo:
+            return memo[game_id]
+    current = data_version(game_id)
+    with _lock:
+        state = _states.get(game_id)
+        if state is not None and state.version == current:
+            _states.move_to_end(game_id)
+        else:
+            state = None
+    if state is None:
+        state = load(game_id, current)
+        with _lock:
+            _states[game_id] = state
+            _states.move_to_end(game_id)
+            while len(_states) > MAX_GAMES:
+                _states.popitem(last=False)
+    if request is not None:
+        memo[game_id] = state
+    return state
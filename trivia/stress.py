@@ -0,0 +1,346 @@
+'''
+Many players submitting at once against a file-backed SQLite database.
+
+Each player gets a thread and a test client, and they all submit their
+answer sheet together, over and over, the way a room does when a round is
+about to close. Meanwhile the trivia master keeps moving another round in
+and out of Check Answers, which auto checks it. Every run counts the
+submissions that went through and the ones that failed with "database is
+locked". Runs use the same workload under different SQLite settings, so the
+numbers compare directly. See the stress_sqlite command.
+
+asgi_run() is the same room seen through mysite/asgi.py: hundreds of
+clients on one event loop, each loading the game page and the round page and
+then submitting its answer sheet, served by Django's ASGI handler as it
+comes or behind trivia.offload. See the stress_asgi command.
+'''
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.asgi import get_asgi_application
+from django.core.signals import got_request_exception
+from django.db import OperationalError, connection
+from django.test import Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import reverse
+from django.utils.crypto import get_random_string
+
+from . import jobs, offload, sqlite
+from . import submissions as submission_queue
+from .benchmarks import forget, make_game
+
+StressResult = namedtuple('StressResult', ['mode', 'attempts', 'ok', 'locked', 'errors', 'seconds', 'p50', 'p95'])
+
+# name: (pragmas, write lock, submission queue). The first is what a bare
+# sqlite3 DATABASES entry gives you.
+MODES = {
+    'default': ({'journal_mode': 'delete', 'synchronous': 'full'}, False, False),
+    'wal': (sqlite.TUNED, False, False),
+    'wal+lock': (sqlite.TUNED, True, False),
+    'wal+queue': (sqlite.TUNED, False, True),
+}
+
+
+AsgiResult = namedtuple('AsgiResult', [
+    'mode', 'clients', 'requests', 'ok', 'locked', 'errors', 'seconds',
+    'read_p50', 'read_p95', 'write_p50', 'write_p95',
+])
+
+# name: what wraps Django's ASGI application, given the pool size. The first
+# is Django as it comes; the others are trivia.offload without and with
+# write turns.
+ASGI_MODES = {
+    'sync': lambda application, threads: application,
+    'threads': lambda application, threads: offload.router(application, threads, write_turns=False),
+    'async': lambda application, threads: offload.router(application, threads, write_turns=True),
+}
+
+
+@contextmanager
+def file_database():
+    '''A throwaway test database in a real file, so other connections can share it.'''
+    directory = tempfile.mkdtemp(prefix='trivia_stress_')
+    connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(directory, 'stress.sqlite3')
+    # failed requests are counted, so don't print a traceback for each
+    request_log = logging.getLogger('django.request')
+    request_log.disabled = True
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+        request_log.disabled = False
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+
+class Tally:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.ok = 0
+        self.locked = 0
+        self.errors = 0
+        self.latencies = []
+
+    def add(self, seconds, outcome):
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+            self.latencies.append(seconds)
+
+
+# The test client re-raises errors from any thread's requests, so each
+# thread keeps its own and the clients are told not to raise them.
+_failure = threading.local()
+
+
+def _record_failure(sender, **kwargs):
+    _failure.error = sys.exc_info()[1]
+
+
+def _attempt(tally, func):
+    _failure.error = None
+    start = time.perf_counter()
+    try:
+        func()
+        if _failure.error is not None:
+            raise _failure.error
+        outcome = 'ok'
+    except OperationalError as e:
+        outcome = 'locked' if 'locked' in str(e) else 'errors'
+    except Exception:
+        outcome = 'errors'
+    tally.add(time.perf_counter() - start, outcome)
+
+
+def _percentile(latencies, fraction):
+    latencies = sorted(latencies) or [0]
+    return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+
+def _player(user, round_id, question_ids, submissions, start, tally, seed):
+    rnd = random.Random(seed)
+    client = Client(raise_request_exception=False)
+    url = reverse('trivia:round_detail', args=[round_id])
+    try:
+        client.force_login(user)
+        start.wait()
+        for _ in range(submissions):
+            answers = {f'question_{question_id}': f'guess {rnd.randint(0, 99)}' for question_id in question_ids}
+
+            def submit():
+                client.post(url, answers, follow=True)
+            _attempt(tally, submit)
+    finally:
+        connection.close()
+
+
+def _trivia_master(user, game, round_id, start, done, tally):
+    client = Client(raise_request_exception=False)
+    url = reverse('trivia:round_statuses', args=[game.id])
+    statuses = {f'round_{round.id}': round.status for round in game.round_set.all()}
+    if game.finalround_set.exists():
+        statuses['final'] = game.finalround_set.get().status
+    try:
+        client.force_login(user)
+        start.wait()
+        while not done.is_set():
+            statuses[f'round_{round_id}'] = '2' if statuses[f'round_{round_id}'] != '2' else '1'
+
+            def move():
+                client.post(url, statuses)
+            _attempt(tally, move)
+    finally:
+        connection.close()
+
+
+def run(mode, players=40, questions=10, submissions=5, seed=0):
+    '''One stress run under MODES[mode]; the database must be a file.'''
+    pragmas, write_lock, queue = MODES[mode]
+    saved = sqlite.PRAGMAS, sqlite.WRITE_LOCK, submission_queue.ENABLED, jobs.ENABLED
+    # auto checks run in the trivia master's requests, not on a job thread
+    # that would outlive this mode and its pragmas
+    sqlite.PRAGMAS, sqlite.WRITE_LOCK, submission_queue.ENABLED, jobs.ENABLED = pragmas, write_lock, queue, False
+    got_request_exception.connect(_record_failure)
+    try:
+        sqlite.apply_pragmas(connection, pragmas)
+        game = make_game(players, 2, questions, open_round=False, seed=seed)
+        answering, checking = game.round_set.order_by('id')
+        answering.status = '1'
+        answering.save()
+        question_ids = list(answering.question_set.values_list('id', flat=True))
+        staff, _ = User.objects.get_or_create(username='stress_staff', defaults={'is_staff': True})
+        forget()
+
+        tally, master_tally = Tally(), Tally()
+        users = list(game.player.order_by('id'))
+        start = threading.Barrier(len(users) + 2)
+        done = threading.Event()
+        threads = [
+            threading.Thread(
+                target=_player, args=(user, answering.id, question_ids, submissions, start, tally, seed + i),
+            )
+            for i, user in enumerate(users)
+        ]
+        master = threading.Thread(target=_trivia_master, args=(staff, game, checking.id, start, done, master_tally))
+        for thread in threads + [master]:
+            thread.start()
+        start.wait()
+        began = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        seconds = time.perf_counter() - began
+        done.set()
+        master.join()
+        submission_queue.flush()
+    finally:
+        got_request_exception.disconnect(_record_failure)
+        sqlite.PRAGMAS, sqlite.WRITE_LOCK, submission_queue.ENABLED, jobs.ENABLED = saved
+
+    latencies = tally.latencies + master_tally.latencies
+    return StressResult(
+        mode,
+        attempts=len(latencies),
+        ok=tally.ok + master_tally.ok,
+        locked=tally.locked + master_tally.locked,
+        errors=tally.errors + master_tally.errors,
+        seconds=seconds,
+        p50=_percentile(latencies, 0.5),
+        p95=_percentile(latencies, 0.95),
+    )
+
+
+# ASGI ####################################################
+
+class _Locked:
+    '''Counts requests that failed with "database is locked", from any thread.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def __call__(self, sender, **kwargs):
+        error = sys.exc_info()[1]
+        if isinstance(error, OperationalError) and 'locked' in str(error):
+            with self._lock:
+                self.count += 1
+
+
+async def _request(application, method, path, cookie, body=b''):
+    '''One request straight into the ASGI application; returns the status.'''
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+        'method': method, 'scheme': 'http', 'path': path, 'raw_path': path.encode(),
+        'query_string': b'', 'root_path': '',
+        'headers': [
+            (b'host', b'testserver'),
+            (b'cookie', cookie.encode()),
+            (b'content-type', b'application/x-www-form-urlencoded'),
+            (b'content-length', str(len(body)).encode()),
+        ],
+        'client': ('127.0.0.1', 50000), 'server': ('testserver', 80),
+    }
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    status = []
+
+    async def receive():
+        return messages.pop() if messages else {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            status.append(message['status'])
+
+    await application(scope, receive, send)
+    return status[0]
+
+
+async def _timed(tally, request):
+    start = time.perf_counter()
+    status = await request
+    tally.add(time.perf_counter() - start, 'ok' if status < 400 else 'errors')
+
+
+async def _asgi_client(application, game_id, round_id, question_ids, cookie, token, cycles, reads, writes, seed):
+    rnd = random.Random(seed)
+    game_url = reverse('trivia:game_detail', args=[game_id])
+    round_url = reverse('trivia:round_detail', args=[round_id])
+    for _ in range(cycles):
+        await _timed(reads, _request(application, 'GET', game_url, cookie))
+        await _timed(reads, _request(application, 'GET', round_url, cookie))
+        answers = {f'question_{question_id}': f'guess {rnd.randint(0, 99)}' for question_id in question_ids}
+        body = urlencode({**answers, 'csrfmiddlewaretoken': token}).encode()
+        await _timed(writes, _request(application, 'POST', round_url, cookie, body))
+
+
+def asgi_run(mode, clients=100, players=40, questions=10, cycles=1, threads=offload.THREADS, seed=0):
+    '''
+    One run of `clients` concurrent clients under ASGI_MODES[mode], shared
+    between `players` logged in players; the database must be a file.
+    '''
+    saved = sqlite.PRAGMAS, sqlite.WRITE_LOCK
+    sqlite.PRAGMAS, sqlite.WRITE_LOCK = sqlite.TUNED, True
+    locked = _Locked()
+    got_request_exception.connect(locked)
+    try:
+        sqlite.apply_pragmas(connection)
+        game = make_game(players, 1, questions, open_round=False, seed=seed)
+        answering = game.round_set.get()
+        answering.status = '1'
+        answering.save()
+        question_ids = list(answering.question_set.values_list('id', flat=True))
+        cookies = []
+        for user in game.player.order_by('id'):
+            client = Client()
+            client.force_login(user)
+            cookies.append(client.cookies[settings.SESSION_COOKIE_NAME].value)
+        token = get_random_string(64)
+        forget()
+        connection.close()
+
+        application = ASGI_MODES[mode](get_asgi_application(), threads)
+        reads, writes = Tally(), Tally()
+
+        async def room():
+            await asyncio.gather(*[
+                _asgi_client(
+                    application, game.id, answering.id, question_ids,
+                    f'{settings.SESSION_COOKIE_NAME}={cookies[i % len(cookies)]}; '
+                    f'{settings.CSRF_COOKIE_NAME}={token}',
+                    token, cycles, reads, writes, seed + i,
+                )
+                for i in range(clients)
+            ])
+
+        began = time.perf_counter()
+        asyncio.run(room())
+        seconds = time.perf_counter() - began
+    finally:
+        got_request_exception.disconnect(locked)
+        sqlite.PRAGMAS, sqlite.WRITE_LOCK = saved
+
+    failed = reads.errors + writes.errors
+    return AsgiResult(
+        mode, clients,
+        requests=len(reads.latencies) + len(writes.latencies),
+        ok=reads.ok + writes.ok,
+        locked=min(locked.count, failed),
+        errors=failed - min(locked.count, failed),
+        seconds=seconds,
+        read_p50=_percentile(reads.latencies, 0.5),
+        read_p95=_percentile(reads.latencies, 0.95),
+        write_p50=_percentile(writes.latencies, 0.5),
+        write_p95=_percentile(writes.latencies, 0.95),
+    )
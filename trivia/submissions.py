@@ -0,0 +1,167 @@
+'''
+Answer and wager submissions queued in process and written in batches.
+
+With TRIVIA_SUBMISSION_QUEUE on, the answer and final round views validate a
+submission and queue it instead of writing it. They answer straight away. A
+flusher thread wakes when something is queued, waits
+TRIVIA_SUBMISSION_FLUSH_MS to let the burst build up, and writes the lot in
+one transaction: one upsert per player for answers, and the final answers
+through the model as usual.
+
+The queue keeps only the latest answer per (player, question) and the latest
+value of each field per final answer, so the last write wins. Grading calls
+flush() first, which writes whatever is queued in the calling thread, so a
+round is never checked without its last answers.
+
+Queued writes live in this process only. Run a single server process when
+this is on, as for live scoreboards, and expect to lose the last few
+milliseconds of submissions if the process dies.
+'''
+import atexit
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from . import scoreboard
+from .models import FinalAnswer, QuestionResponse
+from .sqlite import begin_writing
+
+ENABLED = getattr(settings, 'TRIVIA_SUBMISSION_QUEUE', False)
+FLUSH_MS = getattr(settings, 'TRIVIA_SUBMISSION_FLUSH_MS', 10)
+
+log = logging.getLogger(__name__)
+
+
+def write(answers, finals):
+    '''
+    Save answers keyed by (player_id, question_id) to (game_id, response), and
+    final answer fields keyed by final answer id, in one transaction.
+    '''
+    sheets = defaultdict(dict)
+    for (player_id, question_id), (game_id, response) in answers.items():
+        sheets[(game_id, player_id)][question_id] = response
+    with transaction.atomic(), scoreboard.batched():
+        begin_writing()
+        for (game_id, player_id), responses in sheets.items():
+            QuestionResponse.upsert(game_id, player_id, responses)
+        for final_answer in FinalAnswer.objects.select_related('finalround').filter(id__in=finals):
+            for field, value in finals[final_answer.id].items():
+                setattr(final_answer, field, value)
+            final_answer.save()
+
+
+class SubmissionQueue:
+    def __init__(self, interval=FLUSH_MS / 1000):
+        # with no interval there's no flusher thread and only flush() writes
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._flushing = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._answers = {}
+        self._finals = {}
+
+    def add_answers(self, game_id, player_id, responses):
+        with self._lock:
+            for question_id, response in responses.items():
+                self._answers[(player_id, question_id)] = (game_id, response)
+        self._queued()
+
+    def add_final(self, final_answer_id, fields):
+        with self._lock:
+            self._finals.setdefault(final_answer_id, {}).update(fields)
+        self._queued()
+
+    def pending_answers(self, player_id):
+        '''{question id: response} queued for a player but not written yet.'''
+        with self._lock:
+            return {
+                question_id: response
+                for (queued_player, question_id), (_, response) in self._answers.items()
+                if queued_player == player_id
+            }
+
+    def __len__(self):
+        with self._lock:
+            return len(self._answers) + len(self._finals)
+
+    def flush(self):
+        '''
+        Write everything queued so far, after any batch already being written,
+        and return how many. Call it outside any transaction: the flusher may
+        be waiting on the same database lock.
+        '''
+        with self._flushing:
+            with self._lock:
+                answers, self._answers = self._answers, {}
+                finals, self._finals = self._finals, {}
+            if not answers and not finals:
+                return 0
+            try:
+                write(answers, finals)
+            except Exception:
+                with self._lock:
+                    # back in the queue, under anything newer that came in meanwhile
+                    for key, value in answers.items():
+                        self._answers.setdefault(key, value)
+                    for final_answer_id, fields in finals.items():
+                        self._finals[final_answer_id] = {**fields, **self._finals.get(final_answer_id, {})}
+                raise
+            return len(answers) + len(finals)
+
+    def _queued(self):
+        if self.interval is None:
+            return
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='trivia-submissions', daemon=True)
+                    self._thread.start()
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                log.exception('Writing queued submissions failed; retrying')
+                connection.close()
+                time.sleep(self.interval)
+                self._wake.set()
+
+
+queue = SubmissionQueue()
+atexit.register(queue.flush)
+
+
+def submit_answers(game_id, player_id, responses):
+    '''Queue a player's {question id: response}, or save them now with the queue off.'''
+    if ENABLED:
+        queue.add_answers(game_id, player_id, responses)
+    else:
+        QuestionResponse.upsert(game_id, player_id, responses)
+
+
+def submit(instance, fields):
+    '''Queue the given fields of a validated QuestionResponse or FinalAnswer.'''
+    if isinstance(instance, QuestionResponse):
+        queue.add_answers(instance.question.round.game_id, instance.player_id, {
+            instance.question_id: instance.response,
+        })
+    else:
+        queue.add_final(instance.id, {field: getattr(instance, field) for field in fields})
+
+
+def pending_answers(player_id):
+    return queue.pending_answers(player_id) if ENABLED else {}
+
+
+def flush():
+    return queue.flush() if ENABLED else 0
@@ -1,3 +1,1048 @@
-from django.test import TestCase
+'''
+Query budgets for every page in trivia/urls.py, and scoring checks.
 
-# Create your tests here.
+Each route is loaded cold (nothing cached between requests) against a small
+and a large generated game. It has to run the same number of queries for
+both, so the count can't grow with players, rounds or questions, and stay
+within the budget declared for it below. Failures show the SQL that ran.
+'''
+import asyncio
+import csv
+import io
+import json
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from importlib import import_module
+from unittest import mock, skipUnless
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection
+from django.db.migrations.loader import MigrationLoader
+from django.db.models import Sum
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import urlsafe_base64_encode
+
+from .answers import answer_keys, normalize
+from .benchmarks import forget, make_game
+from . import export, fuzzy, jobs, live, memo, metrics, offload, scoreboard, scripts, sqlite, submissions, transitions
+from .forms import RoundAnswerForm
+from .grading import grade_message, grade_round
+from .models import AcceptedAnswer, DoubleRound, FinalAnswer, FinalRound, Game, Job, Question, QuestionResponse, Round, Verdict
+from .scoring import pre_final_total, score_state, score_table
+from .state import load
+from .transitions import transition
+from .urls import urlpatterns
+from .views import GameIndexView
+
+# (players, rounds, questions)
+SIZES = [(3, 2, 3), (12, 4, 8)]
+
+# name: (who asks, url kwargs from the objects below, query budget)
+ROUTES = {
+    'index': ('player', lambda o: {}, 2),
+    'games': ('player', lambda o: {}, 3),
+    'game_detail': ('player', lambda o: {'pk': o['game'].id}, 13),
+    'game_events': ('player', lambda o: {'pk': o['game'].id}, 0),
+    'round_detail': ('player', lambda o: {'pk': o['open_round'].id}, 13),
+    'round_update': ('staff', lambda o: {'pk': o['open_round'].id}, 3),
+    'new_answer': ('player', lambda o: {
+        'game': o['game'].id, 'round': o['unanswered'].round_id, 'question': o['unanswered'].id,
+    }, 6),
+    'update_answer': ('player', lambda o: {'pk': o['response'].id}, 6),
+    'final_wager': ('player', lambda o: {'game': o['game'].id}, 3),
+    'final_wager_update': ('player', lambda o: {'pk': o['final_answer'].id}, 5),
+    'final_answer': ('player', lambda o: {'game': o['game'].id}, 3),
+    'final_answer_update': ('player', lambda o: {'pk': o['final_answer'].id}, 5),
+    'check_finalanswer': ('staff', lambda o: {'game': o['game'].id}, 4),
+    'check_answers': ('staff', lambda o: {
+        'game': o['game'].id, 'round': o['open_round'].id, 'player': o['player'].id,
+    }, 13),
+    'check_round': ('player', lambda o: {'game': o['game'].id, 'round': o['open_round'].id}, 13),
+    'finalround_update': ('staff', lambda o: {'pk': o['game'].finalround_set.get().id}, 3),
+    'round_review': ('player', lambda o: {'pk': o['closed_round'].id}, 13),
+    'double_round': ('staff', lambda o: {'game': o['game'].id}, 4),
+    'double_update': ('player', lambda o: {'pk': o['double_round'].id}, 5),
+    'manage': ('staff', lambda o: {}, 2),
+    'new_round': ('staff', lambda o: {}, 3),
+    'manage_questions': ('staff', lambda o: {'round_pk': o['closed_round'].id}, 4),
+    'round_statuses': ('staff', lambda o: {'game': o['game'].id}, 12),
+    'refresh_scores': ('staff', lambda o: {'game': o['game'].id}, 2),
+    # the rows are read as the response streams, after this count
+    'export': ('staff', lambda o: {'kind': 'responses', 'fmt': 'csv'}, 2),
+    'scoreboard_stats': ('staff', lambda o: {}, 2),
+    'metrics': ('staff', lambda o: {}, 2),
+    'signup': (None, lambda o: {}, 0),
+}
+
+
+def game_objects(players, rounds, questions):
+    '''A generated game and one of everything the routes need from it.'''
+    game = make_game(players, rounds, questions)
+    final_answer = FinalAnswer.objects.filter(finalround__game=game).order_by('id').first()
+    player = final_answer.player
+    round_objs = list(game.round_set.order_by('id'))
+    double_round, _ = DoubleRound.objects.get_or_create(
+        player=player, game=game, defaults={'round': round_objs[0]}
+    )
+    unanswered = round_objs[-1].question_set.order_by('id').first()
+    for response in QuestionResponse.objects.filter(player=player, question=unanswered):
+        response.delete()
+    response = QuestionResponse.objects.filter(player=player, question__round=round_objs[-1]).first()
+    if response is None:
+        response = QuestionResponse.objects.create(
+            player=player, question=round_objs[-1].question_set.order_by('id').last(), response='something'
+        )
+    return {
+        'game': game, 'player': player, 'final_answer': final_answer, 'double_round': double_round,
+        'closed_round': round_objs[0], 'open_round': round_objs[-1], 'unanswered': unanswered,
+        'response': response,
+    }
+
+
+class QueryBudgetTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create(username='staff', is_staff=True)
+        cls.games = [game_objects(*size) for size in SIZES]
+
+    def queries(self, name, objects):
+        '''The status and the queries run loading a route cold.'''
+        who, kwargs, _ = ROUTES[name]
+        user = {'player': objects['player'], 'staff': self.staff, None: None}[who]
+        if user:
+            self.client.force_login(user)
+        else:
+            self.client.logout()
+        url = reverse(f'trivia:{name}', kwargs=kwargs(objects))
+        forget()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        return response.status_code, [query['sql'] for query in queries]
+
+    def test_every_route_has_a_budget(self):
+        names = {pattern.name for pattern in urlpatterns}
+        self.assertEqual(names - set(ROUTES), set(), 'Give new routes a query budget in ROUTES')
+
+    def test_query_budgets(self):
+        for name, (_, _, budget) in ROUTES.items():
+            with self.subTest(route=name):
+                counts = []
+                for objects, size in zip(self.games, SIZES):
+                    status, queries = self.queries(name, objects)
+                    self.assertIn(status, (200, 204, 302), f'{name} answered {status}')
+                    sql = '\n'.join(queries)
+                    self.assertLessEqual(
+                        len(queries), budget,
+                        f'{name} ran {len(queries)} queries for a {size} game, over its budget of {budget}:\n{sql}',
+                    )
+                    counts.append((len(queries), sql))
+                (small, _), (large, sql) = counts
+                self.assertEqual(
+                    small, large,
+                    f'{name} went from {small} to {large} queries as the game grew:\n{sql}',
+                )
+
+
+def scored_one_by_one(game):
+    '''The scores worked out the way the models first did, a player and a round at a time.'''
+    scores = {}
+    for player in game.player.all():
+        row = {}
+        for round in game.round_set.all():
+            points = QuestionResponse.objects.filter(
+                player=player, question__round=round, correct=True,
+            ).aggregate(points=Sum('question__points'))['points'] or 0
+            double = DoubleRound.objects.filter(round=round, player=player).first()
+            row[round] = points * double.multiplier if double else points
+        for finalround in game.finalround_set.all():
+            answer = FinalAnswer.objects.filter(player=player, finalround=finalround).first()
+            if finalround.status != '4' or answer is None:
+                row[finalround] = 0
+            else:
+                row[finalround] = answer.wager if answer.correct else -answer.wager
+        scores[player] = row
+    return scores
+
+
+class ScoreGameTests(TestCase):
+
+    def setUp(self):
+        self.game = make_game(8, 4, 5)
+
+    def assertScoredLikeBefore(self):
+        expected = scored_one_by_one(self.game)
+        rounds = {
+            player: {key: points for key, points in row.items() if isinstance(key, Round)}
+            for player, row in expected.items()
+        }
+        for row in list(expected.values()) + list(rounds.values()):
+            row['total'] = sum(row.values())
+        self.assertEqual(self.game.score_game(), expected)
+        self.assertEqual(self.game.score_rounds(), rounds)
+
+    def test_matches_scoring_one_player_and_round_at_a_time(self):
+        self.assertTrue(DoubleRound.objects.filter(game=self.game, multiplier__gt=1).exists())
+        self.assertTrue(FinalAnswer.objects.filter(finalround__game=self.game, wager__gt=0).exists())
+        self.assertScoredLikeBefore()
+
+    def test_wagers_only_count_once_the_final_round_is_closed(self):
+        finalround = self.game.finalround_set.get()
+        for status in ['3', '4']:
+            FinalRound.objects.filter(id=finalround.id).update(status=status)
+            with self.subTest(status=status):
+                self.assertScoredLikeBefore()
+                finals = {row[finalround] for row in self.game.score_game().values()}
+                self.assertEqual(finals == {0}, status != '4')
+
+    def test_queries_dont_grow_with_the_game(self):
+        bigger = make_game(16, 8, 5)
+        with CaptureQueriesContext(connection) as small:
+            Game.objects.get(id=self.game.id).score_game()
+        with CaptureQueriesContext(connection) as large:
+            Game.objects.get(id=bigger.id).score_game()
+        self.assertEqual(len(small), len(large))
+
+
+class GameListTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.player = User.objects.create(username='player')
+        now = timezone.now()
+        # five games share a date, so only the id tells them apart
+        dates = [now] * 5 + [now - timedelta(days=1), now - timedelta(days=2), now + timedelta(days=1)]
+        cls.games = [
+            Game.objects.create(game_title=f'Game {i}', pub_date=date, completed=i % 2 == 0)
+            for i, date in enumerate(dates)
+        ]
+        for game in cls.games[:4]:
+            game.player.add(cls.player)
+
+    def walk(self, query=''):
+        '''Ids of every game listed, following the next page links from the first.'''
+        url = reverse('trivia:games')
+        pages = [self.client.get(f'{url}?{query}')]
+        # a cursor that doesn't move on would page forever
+        while 'next_page' in pages[-1].context and len(pages) <= len(self.games):
+            pages.append(self.client.get(f'{url}?{pages[-1].context["next_page"]}'))
+        return [[game.id for game in page.context['game_list']] for page in pages]
+
+    def expected(self, games):
+        return [game.id for game in sorted(games, key=lambda game: (game.pub_date, game.id), reverse=True)]
+
+    def test_pages_walk_every_game_once_across_equal_dates(self):
+        with mock.patch.object(GameIndexView, 'page_size', 2):
+            pages = self.walk()
+        self.assertEqual([len(page) for page in pages], [2, 2, 2, 2])
+        self.assertEqual(sum(pages, []), self.expected(self.games))
+
+    def test_bad_cursor_is_the_first_page(self):
+        first = self.walk()[0]
+        for cursor in ['nonsense', urlsafe_base64_encode(b'yesterday|1'), urlsafe_base64_encode(b'no bar')]:
+            with self.subTest(cursor=cursor):
+                response = self.client.get(reverse('trivia:games'), {'after': cursor})
+                self.assertEqual([game.id for game in response.context['game_list']], first)
+
+    def test_filtered_pages_keep_their_filter(self):
+        self.client.force_login(self.player)
+        with mock.patch.object(GameIndexView, 'page_size', 1):
+            pages = self.walk('completed=1&mine=1')
+        self.assertEqual(sum(pages, []), self.expected(self.games[0:4:2]))
+        # mine means nothing to someone who isn't logged in
+        self.client.logout()
+        with mock.patch.object(GameIndexView, 'page_size', 3):
+            pages = self.walk('completed=0&mine=1')
+        self.assertEqual(sum(pages, []), self.expected(self.games[1::2]))
+
+
+class RoundAnswerTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.game = make_game(3, 2, 4, open_round=False)
+        cls.round = cls.game.round_set.order_by('id').first()
+        cls.questions = list(cls.round.question_set.order_by('id'))
+        cls.player = cls.game.player.order_by('id').first()
+
+    def post(self, answers):
+        self.client.force_login(self.player)
+        data = {RoundAnswerForm.field_name(question.id): answer for question, answer in zip(self.questions, answers)}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('trivia:round_detail', args=[self.round.id]), data)
+        return response, [q['sql'] for q in queries if '"trivia_' in q['sql']]
+
+    def saved(self):
+        return [
+            QuestionResponse.objects.filter(question=question, player=self.player).values_list('response', flat=True).first()
+            for question in self.questions
+        ]
+
+    def test_whole_sheet_is_saved_with_one_check_and_one_upsert(self):
+        Round.objects.filter(id=self.round.id).update(status='1')
+        QuestionResponse.objects.filter(question=self.questions[0], player=self.player).delete()
+        answers = ['Paris', 'Everest', '', '1066']
+        response, queries = self.post(answers)
+        self.assertRedirects(response, reverse('trivia:round_detail', args=[self.round.id]))
+        self.assertEqual(len(queries), 2, '\n'.join(queries))
+        self.assertTrue(queries[1].startswith('INSERT INTO "trivia_questionresponse"'))
+        # a blank answer leaves whatever was there
+        self.assertEqual([saved for saved, answer in zip(self.saved(), answers) if answer], ['Paris', 'Everest', '1066'])
+
+    def test_invalid_sheet_is_shown_again(self):
+        Round.objects.filter(id=self.round.id).update(status='1')
+        response, _ = self.post(['x' * 1000])
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['form'].errors)
+
+    def test_refused_unless_the_round_is_open(self):
+        before = self.saved()
+        for status in ['0', '2', '3']:
+            Round.objects.filter(id=self.round.id).update(status=status)
+            with self.subTest(status=status):
+                response, queries = self.post(['Paris'] * len(self.questions))
+                self.assertRedirects(response, reverse('trivia:game_detail', args=[self.game.id]))
+                self.assertEqual(len(queries), 1)
+                self.assertEqual(self.saved(), before)
+
+
+class ScoreTableTests(TestCase):
+    '''The Score table has to follow every edit that moves points.'''
+
+    def setUp(self):
+        self.game = make_game(6, 3, 4)
+        self.rounds = list(self.game.round_set.order_by('id'))
+
+    def assertInStep(self, step):
+        expected = self.game.score_game()
+        self.assertEqual(self.game.score_table(), expected, step)
+        # the game page's board, keyed by ids since it has its own player and round objects
+        page = score_state(load(self.game.id))
+        self.assertEqual(
+            {player.id: {getattr(key, 'id', key): points for key, points in row.items()} for player, row in page.items()},
+            {player.id: {getattr(key, 'id', key): points for key, points in row.items()} for player, row in expected.items()},
+            step,
+        )
+
+    def test_edits_regrades_and_deletes(self):
+        self.assertInStep('generated')
+        question = Question.objects.filter(round=self.rounds[0], questionresponse__correct=True).first()
+        question.points += 3
+        question.save()
+        self.assertInStep('question points edited')
+
+        right = QuestionResponse.objects.filter(question__round=self.rounds[1], correct=True).first()
+        wrong = QuestionResponse.objects.filter(question__round=self.rounds[1], correct=False).first()
+        right.correct, wrong.correct = False, True
+        right.save()
+        wrong.save()
+        self.assertInStep('responses regraded')
+
+        QuestionResponse.objects.filter(correct=True).exclude(id=wrong.id).first().delete()
+        self.assertInStep('correct response deleted')
+
+        Question.objects.get(id=question.id).delete()
+        self.assertInStep('graded question deleted')
+
+        double = DoubleRound.objects.filter(game=self.game).first()
+        double.round = next(r for r in self.rounds if r.id != double.round_id)
+        double.save()
+        self.assertInStep('double round moved')
+        double.multiplier = 3
+        double.save()
+        self.assertInStep('double round multiplier changed')
+        DoubleRound.objects.get(id=double.id).delete()
+        self.assertInStep('double round deleted')
+
+        final_answer = FinalAnswer.objects.filter(finalround__game=self.game).first()
+        final_answer.wager += 1
+        final_answer.correct = not final_answer.correct
+        final_answer.save()
+        self.assertInStep('final answer regraded')
+
+    def test_live_deltas_are_doubled(self):
+        double = DoubleRound.objects.filter(game=self.game).first()
+        response = QuestionResponse.objects.filter(
+            player=double.player, question__round=double.round, correct=False,
+        ).select_related('question').first()
+        response.correct = True
+        with mock.patch.object(live, 'publish_scores') as publish_scores:
+            response.save()
+        (_, cells), _ = publish_scores.call_args
+        self.assertEqual(cells, [{
+            'player': double.player_id, 'round': double.round_id,
+            'delta': response.question.points * double.multiplier,
+        }])
+
+
+class NormalizeTests(TestCase):
+
+    def test_punctuation_between_digits_is_kept(self):
+        for different in [('3.14', '314'), ('1/2', '12'), ('1,000', '1000')]:
+            with self.subTest(different=different):
+                self.assertNotEqual(*map(normalize, different))
+        self.assertEqual(normalize('The 3.14!'), normalize('3.14'))
+        self.assertEqual(normalize('U.S.A.'), normalize('usa'))
+        self.assertEqual(normalize('5.'), '5')
+
+    def test_numbers_are_graded_exactly(self):
+        game = make_game(2, 1, 1)
+        question = Question.objects.get(round__game=game)
+        question.answer, question.alt_answers = '3.14', None
+        question.save()
+        right, wrong = QuestionResponse.objects.filter(question=question).order_by('id')
+        for response, text in [(right, '3.14'), (wrong, '314')]:
+            response.response, response.correct = text, False
+            response.save()
+        grade_round(question.round_id, fuzzy_grading=False)
+        self.assertEqual(
+            list(QuestionResponse.objects.filter(question=question).order_by('id').values_list('correct', flat=True)),
+            [True, False],
+        )
+
+    def test_backfills_match_normalize(self):
+        # 0006 fills the columns with the old rules and 0012 redoes the ones
+        # with numbers in, so together they should land on normalize()
+        game = make_game(3, 1, 4)
+        texts = ['The Beatles', '3.14', 'Café-au-lait', '1,000 A.D.', 'the end', '']
+        for i, question in enumerate(Question.objects.filter(round__game=game).order_by('id')):
+            Question.objects.filter(id=question.id).update(answer=texts[i], alt_answers=f'{texts[i + 1]}, 1/2')
+        for i, response in enumerate(QuestionResponse.objects.filter(question__round__game=game).order_by('id')):
+            QuestionResponse.objects.filter(id=response.id).update(response=texts[i % len(texts)], normalized_response='x')
+        FinalRound.objects.filter(game=game).update(answer='2.5', alt_answers='Two and a half')
+        FinalAnswer.objects.filter(finalround__game=game).update(answer='U.S. 2.5', normalized_answer='x')
+        AcceptedAnswer.objects.all().update(normalized='x')
+
+        loader = MigrationLoader(connection)
+        for name, previous, step in [
+            ('0006_backfill_normalized_answers', '0005_normalized_answers', 'backfill'),
+            ('0012_renormalize_numbers', '0011_verdict', 'renormalize'),
+        ]:
+            migration = import_module(f'trivia.migrations.{name}')
+            getattr(migration, step)(loader.project_state(('trivia', previous)).apps, None)
+
+        for response, normalized in QuestionResponse.objects.values_list('response', 'normalized_response'):
+            self.assertEqual(normalized, normalize(response, 150))
+        for answer, normalized in FinalAnswer.objects.values_list('answer', 'normalized_answer'):
+            self.assertEqual(normalized, normalize(answer, 200))
+        for owner in [*Question.objects.filter(round__game=game), *FinalRound.objects.filter(game=game)]:
+            self.assertEqual(
+                sorted(owner.acceptedanswer_set.values_list('normalized', flat=True)),
+                answer_keys(owner.answer, owner.alt_answers, 250),
+            )
+
+
+class FuzzyTests(TestCase):
+
+    def test_numbers_and_typos(self):
+        for response, answer, accepted in [
+            ('1000000', '10000000', False), ('henry vii', 'henry viii', False), ('mount everst', 'mount everest', True),
+            ('mt everest', 'mount everest', True), ('apollo 11', 'apollo 13', False), ('eiffel tower', 'eifel towr', True),
+            ('constantinople', 'istanbul', False),
+        ]:
+            with self.subTest(response=response, answer=answer):
+                self.assertEqual(fuzzy.close_enough(response, answer), accepted)
+
+    @skipUnless(fuzzy.np, 'needs numpy')
+    def test_near_misses_are_left_for_review_and_nothing_is_remembered(self):
+        game = make_game(1, 1, 3)
+        rows = [('10000000', '1000000', False), ('Henry VIII', 'Henry VII', False), ('Mount Everest', 'Mount Everrest', True)]
+        questions = Question.objects.filter(round__game=game).order_by('id')
+        for question, (answer, text, _) in zip(questions, rows):
+            question.answer, question.alt_answers = answer, None
+            question.save()
+            QuestionResponse.objects.filter(question=question).update(
+                response=text, normalized_response=normalize(text), correct=False,
+            )
+        forget()
+        with mock.patch.object(memo, 'ENABLED', True):
+            report = grade_round(questions[0].round_id, fuzzy_grading=True)
+        self.assertEqual((report.accepted, report.review, report.flagged), (1, 2, 2))
+        self.assertEqual(
+            [response.correct for question in questions for response in question.questionresponse_set.all()],
+            [correct for _, _, correct in rows],
+        )
+        self.assertFalse(Verdict.objects.exists())
+
+
+class ImportTests(TestCase):
+
+    def write_game(self, directory):
+        path = os.path.join(directory, 'game.csv')
+        with open(path, 'w', newline='') as f:
+            csv.writer(f).writerows([
+                ['History', 'Who was the first president?', 'George Washington', 'Washington'],
+                ['Final Round', 'Math', 'What is pi to two places?', '3.14'],
+            ])
+        return path
+
+    def test_spawned_workers_can_parse(self):
+        # the default start method on macOS and Windows
+        with tempfile.TemporaryDirectory() as directory:
+            path = self.write_game(directory)
+            with ProcessPoolExecutor(
+                1, mp_context=multiprocessing.get_context('spawn'), initializer=scripts.setup_worker,
+            ) as executor:
+                payload = executor.submit(scripts._parse_file, path).result(timeout=60)
+        self.assertEqual(payload.name, 'game.csv')
+        self.assertEqual(list(payload.rounds), ['History'])
+        self.assertEqual(payload.rejected, [])
+
+    def test_dry_run_writes_nothing(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = self.write_game(directory)
+            for name in [[], ['--name', 'Named']]:
+                with self.subTest(name=name):
+                    call_command('import_games', path, '--dry-run', *name, stdout=io.StringIO())
+                    self.assertEqual(Game.objects.count(), 0)
+            call_command('import_games', path, '--name', 'Named', stdout=io.StringIO())
+        self.assertEqual(list(Game.objects.values_list('game_title', flat=True)), ['Named'])
+
+
+class WagerTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.game = make_game(8, 3, 4)
+
+    def test_pre_final_total_matches_score_rounds(self):
+        for player, row in self.game.score_rounds().items():
+            self.assertEqual(pre_final_total(self.game.id, player.id), row['total'], player)
+
+    def test_wager_limited_to_score_in_one_query(self):
+        final_answer = FinalAnswer.objects.select_related('finalround').filter(
+            finalround__game=self.game
+        ).first()
+        final_answer.finalround.max_wager = 0
+        score = pre_final_total(self.game.id, final_answer.player_id)
+        final_answer.wager = score
+        with self.assertNumQueries(1):
+            final_answer.clean()
+        final_answer.wager = score + 1
+        with self.assertRaises(ValidationError):
+            final_answer.clean()
+
+
+class TransitionTests(TestCase):
+
+    def test_close_one_round_and_open_the_next(self):
+        game = make_game(5, 3, 4)
+        first, second, third = game.round_set.order_by('id')
+        game.round_set.update(status='0')
+        game.finalround_set.update(status='0')
+        reports = transition(game.id, {first.id: '2', second.id: '1'})
+        self.assertEqual(set(reports), {first.id})
+        self.assertEqual(
+            dict(Round.objects.filter(game=game).values_list('id', 'status')),
+            {first.id: '2', second.id: '1', third.id: '0'},
+        )
+        game.refresh_from_db()
+        self.assertEqual(game.phase, '1')
+        transition(game.id, {first.id: '3', second.id: '3', third.id: '3'}, final_status='4')
+        game.refresh_from_db()
+        self.assertEqual(game.phase, '3')
+
+
+class SubmissionQueueTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.game = make_game(3, 1, 2)
+        cls.round = cls.game.round_set.get()
+        cls.question = cls.round.question_set.order_by('id').first()
+        cls.final_answer = FinalAnswer.objects.filter(finalround__game=cls.game).first()
+        cls.player = cls.final_answer.player
+
+    def test_last_write_wins(self):
+        queue = submissions.SubmissionQueue(interval=None)
+        queue.add_answers(self.game.id, self.player.id, {self.question.id: 'first'})
+        queue.add_answers(self.game.id, self.player.id, {self.question.id: 'second'})
+        queue.add_final(self.final_answer.id, {'wager': 1})
+        queue.add_final(self.final_answer.id, {'answer': 'final'})
+        queue.add_final(self.final_answer.id, {'wager': 0})
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(queue.flush(), 2)
+        self.assertEqual(
+            QuestionResponse.objects.get(player=self.player, question=self.question).response, 'second'
+        )
+        self.final_answer.refresh_from_db()
+        self.assertEqual((self.final_answer.wager, self.final_answer.answer), (0, 'final'))
+
+    def test_queued_answers_are_written_before_checking(self):
+        queue = submissions.SubmissionQueue(interval=None)
+        self.round.status = '1'
+        self.round.save()
+        QuestionResponse.objects.filter(player=self.player, question=self.question).delete()
+        with mock.patch.object(submissions, 'queue', queue), mock.patch.object(submissions, 'ENABLED', True):
+            submissions.submit_answers(self.game.id, self.player.id, {self.question.id: self.question.answer})
+            transition(self.game.id, {self.round.id: '2'})
+        self.assertEqual(len(queue), 0)
+        self.assertTrue(QuestionResponse.objects.get(player=self.player, question=self.question).correct)
+
+    def test_answers_queued_during_the_status_change_are_checked(self):
+        queue = submissions.SubmissionQueue(interval=None)
+        self.round.status = '1'
+        self.round.save()
+        QuestionResponse.objects.filter(player=self.player, question=self.question).delete()
+        update_phase = transitions.update_phase
+
+        def answer_meanwhile(game_id):
+            # a player who passed the status check just before it changed
+            submissions.submit_answers(self.game.id, self.player.id, {self.question.id: self.question.answer})
+            update_phase(game_id)
+        with mock.patch.object(submissions, 'queue', queue), mock.patch.object(submissions, 'ENABLED', True), \
+                mock.patch.object(transitions, 'update_phase', answer_meanwhile):
+            transition(self.game.id, {self.round.id: '2'})
+        self.assertEqual(len(queue), 0)
+        self.assertTrue(QuestionResponse.objects.get(player=self.player, question=self.question).correct)
+
+
+class CheckRoundTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.game = make_game(4, 1, 2)
+        cls.round = cls.game.round_set.get()
+        cls.question = cls.round.question_set.order_by('id').first()
+        cls.players = list(cls.game.player.order_by('id'))
+        for player, response in zip(cls.players, ['Ye Olde Answer', 'ye olde answer!', 'nope', 'Ye olde answer']):
+            QuestionResponse.objects.update_or_create(
+                player=player, question=cls.question, defaults={'response': response, 'correct': False},
+            )
+        cls.url = reverse('trivia:check_round', args=[cls.game.id, cls.round.id])
+
+    def setUp(self):
+        forget()
+
+    def group(self, response):
+        self.client.force_login(self.players[0])
+        form = self.client.get(self.url).context['form']
+        return next(group for group in form.groups[self.question.id] if group.response.lower() == response)
+
+    def test_same_answers_share_a_checkbox(self):
+        group = self.group('ye olde answer!')
+        # the checker's own answer is left out
+        self.assertEqual({response.player_id for response in group.responses}, {self.players[1].id, self.players[3].id})
+
+    def test_one_update_marks_everyone(self):
+        group = self.group('ye olde answer!')
+        before = self.game.score_table()
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(self.url, {f'group_{group.key}': 'on'})
+        updates = [q['sql'] for q in queries if q['sql'].startswith('UPDATE "trivia_questionresponse"')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(
+            set(QuestionResponse.objects.filter(question=self.question, correct=True).values_list('player_id', flat=True)),
+            {self.players[1].id, self.players[3].id},
+        )
+        after = self.game.score_table()
+        for player in (self.players[1], self.players[3]):
+            self.assertGreater(after[player]['total'], before[player]['total'])
+        self.assertEqual(after, self.game.score_game())
+
+    def test_only_while_checking(self):
+        self.round.status = '3'
+        self.round.save()
+        forget()
+        self.client.force_login(self.players[0])
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+
+class VerdictMemoTests(TestCase):
+
+    def setUp(self):
+        forget()
+
+    def test_checked_answers_carry_over_to_the_next_game(self):
+        first, second = make_game(3, 1, 1, seed=1), make_game(3, 1, 1, seed=2)
+        questions = []
+        for game in (first, second):
+            question = Question.objects.get(round__game=game)
+            question.answer, question.alt_answers = 'Mount Everest', None
+            question.save()
+            questions.append(question)
+            for player, response in zip(game.player.order_by('id'), ['Everest', 'K2', 'mt everest']):
+                # K2 starts out marked right in the first game, so unticking it is a change
+                QuestionResponse.objects.update_or_create(
+                    player=player, question=question,
+                    defaults={'response': response, 'correct': response == 'K2' and game == first},
+                )
+        staff = User.objects.create(username='staff', is_staff=True)
+        self.client.force_login(staff)
+        first_round = questions[0].round
+        form = self.client.get(reverse('trivia:check_round', args=[first.id, first_round.id])).context['form']
+        data = {
+            form.field_name(group.key): 'on'
+            for group in form.groups[questions[0].id] if group.response != 'K2'
+        }
+        url = reverse('trivia:check_round', args=[first.id, first_round.id])
+        with mock.patch.object(memo, 'ENABLED', True):
+            self.client.post(url, data)
+            # nothing changed the second time, so nothing is remembered again
+            with CaptureQueriesContext(connection) as queries:
+                self.client.post(url, data)
+            self.assertFalse([q['sql'] for q in queries if 'trivia_verdict' in q['sql']])
+            memo.memo.clear()
+            report = grade_round(questions[1].round_id)
+        self.assertEqual((report.remembered, report.memo_hits, report.memo_lookups), (2, 3, 3))
+        self.assertIn('(100%)', grade_message(report))
+        self.assertEqual(
+            set(QuestionResponse.objects.filter(question=questions[1], correct=True).values_list('response', flat=True)),
+            {'Everest', 'mt everest'},
+        )
+
+
+    def test_a_verdict_corrected_elsewhere_isnt_trusted_from_memory(self):
+        pair = (memo.answer_key(['everest']), 'k2')
+        Verdict.objects.create(answer_key=pair[0], response=pair[1], correct=True, updated=timezone.now())
+        self.assertEqual(memo.memo.lookup({pair}), {pair: True})
+        with self.assertNumQueries(0):
+            self.assertEqual(memo.memo.lookup({pair}), {pair: True})
+        # another process corrects it; its commit moves the generation
+        Verdict.objects.update(correct=False)
+        memo.next_generation()
+        self.assertEqual(memo.memo.lookup({pair}), {pair: False})
+
+
+class JobTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.game = make_game(3, 1, 2, open_round=False)
+        cls.round = cls.game.round_set.get()
+        cls.staff = User.objects.create(username='staff', is_staff=True)
+
+    def test_status_change_queues_one_grading_job(self):
+        Round.objects.filter(id=self.round.id).update(status='1')
+        QuestionResponse.objects.filter(question__round=self.round).update(correct=False)
+        self.client.force_login(self.staff)
+        url = reverse('trivia:round_update', args=[self.round.id])
+        with mock.patch.object(jobs, 'ENABLED', True):
+            self.client.post(url, {'status': '2'})
+            self.client.post(url, {'status': '2'})
+        job = Job.objects.get()
+        self.assertEqual((job.kind, job.round_id, job.status), ('grade', self.round.id, '0'))
+        self.assertFalse(QuestionResponse.objects.filter(question__round=self.round, correct=True).exists())
+
+        self.assertEqual(jobs.runner.run_pending(), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, '2')
+        self.assertTrue(job.message.startswith('Auto check accepted'))
+        self.assertTrue(QuestionResponse.objects.filter(question__round=self.round, correct=True).exists())
+        # done, so the next click gets a new job
+        self.assertNotEqual(jobs.grade(self.round.id, self.game.id).id, job.id)
+
+    def test_failed_job_is_recorded(self):
+        job = jobs.refresh_scores(self.game.id)
+        with mock.patch.dict(jobs.KINDS, scores=mock.Mock(side_effect=ValueError('boom'))):
+            with self.assertLogs('trivia.jobs', 'ERROR'):
+                jobs.runner.run_pending()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.message), ('3', 'boom'))
+
+    def test_leftover_jobs_are_picked_up(self):
+        queued = jobs.refresh_scores(self.game.id)
+        running = jobs.grade(self.round.id, self.game.id)
+        Job.objects.filter(id=running.id).update(status='1', started=timezone.now() - jobs.STALE * 2)
+        # a new process starts its worker, which runs both
+        with mock.patch.object(jobs, 'ENABLED', True), mock.patch.object(jobs.runner, 'wake') as wake:
+            jobs.start()
+        wake.assert_called_once_with()
+        self.assertEqual(jobs.runner.run_pending(), 2)
+        self.assertEqual(set(Job.objects.filter(id__in=[queued.id, running.id]).values_list('status', flat=True)), {'2'})
+
+    def test_job_list_is_cached_for_staff_only(self):
+        jobs.refresh_scores(self.game.id)
+        url = reverse('trivia:game_detail', args=[self.game.id])
+        forget()
+
+        def job_queries(user):
+            self.client.force_login(user)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            return response, [q['sql'] for q in queries if '"trivia_job"' in q['sql']]
+        with mock.patch.object(jobs, 'ENABLED', True):
+            response, queries = job_queries(self.game.player.first())
+            self.assertEqual((response.context['jobs'], queries), (None, []))
+            response, queries = job_queries(self.staff)
+            self.assertEqual((len(response.context['jobs']), len(queries)), (1, 1))
+            response, queries = job_queries(self.staff)
+            self.assertEqual((len(response.context['jobs']), len(queries)), (1, 0))
+
+
+class ExportTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create(username='staff', is_staff=True)
+        cls.game = make_game(3, 2, 3)
+        cls.other = make_game(2, 1, 2)
+
+    def setUp(self):
+        self.client.force_login(self.staff)
+
+    def get(self, kind, fmt, **query):
+        response = self.client.get(reverse('trivia:export', args=[kind, fmt]), query)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode()
+
+    def test_responses_csv_for_one_game(self):
+        with mock.patch.object(export, 'CHUNK_ROWS', 5):
+            rows = list(csv.DictReader(self.get('responses', 'csv', game=self.game.id).splitlines()))
+        responses = QuestionResponse.objects.filter(question__round__game=self.game)
+        self.assertEqual(len(rows), responses.count())
+        self.assertEqual({int(row['game_id']) for row in rows}, {self.game.id})
+        self.assertEqual(sorted(int(row['player_id']) for row in rows), sorted(r.player_id for r in responses))
+
+    def test_scores_jsonl_add_up(self):
+        lines = [json.loads(line) for line in self.get('scores', 'jsonl').splitlines()]
+        self.assertEqual({line['game_id'] for line in lines}, {self.game.id, self.other.id})
+        totals = {}
+        for line in lines:
+            if line['game_id'] == self.game.id:
+                totals[line['player']] = totals.get(line['player'], 0) + line['score']
+        self.assertEqual(totals, {player.username: row['total'] for player, row in self.game.score_game().items()})
+
+    def test_rows_come_in_game_player_round_order(self):
+        for kind, fmt in [('scores', 'csv'), ('responses', 'jsonl'), ('wagers', 'csv')]:
+            with self.subTest(kind=kind):
+                text = self.get(kind, fmt)
+                rows = list(csv.DictReader(text.splitlines())) if fmt == 'csv' else [
+                    json.loads(line) for line in text.splitlines()
+                ]
+                round_column = 'final_round_id' if kind == 'wagers' else 'round_id'
+                keys = [
+                    # the final round's scores have no round and come last
+                    (int(row['game_id']), int(row['player_id']), int(row[round_column] or 10 ** 9))
+                    for row in rows
+                ]
+                self.assertTrue(keys)
+                self.assertEqual(keys, sorted(keys))
+
+    def test_bad_filter_and_players(self):
+        self.assertEqual(self.client.get(reverse('trivia:export', args=['wagers', 'csv']), {'since': 'May'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('trivia:export', args=['wagers', 'xml'])).status_code, 404)
+        self.client.force_login(self.game.player.first())
+        self.assertEqual(self.client.get(reverse('trivia:export', args=['wagers', 'csv'])).status_code, 302)
+
+
+class MetricsTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.game = make_game(3, 2, 2)
+        cls.staff = User.objects.create(username='staff', is_staff=True)
+
+    def setUp(self):
+        metrics.registry.clear()
+        forget()
+
+    def test_requests_are_recorded_through_the_middleware(self):
+        self.client.get(reverse('trivia:game_detail', args=[self.game.id]))
+        views, slow = metrics.registry.snapshot()
+        recorded = dict(views)['trivia:game_detail']
+        self.assertEqual((recorded.requests, recorded.errors), (1, 0))
+        self.assertGreater(recorded.queries, 0)
+        self.assertEqual(sum(recorded.buckets), 1)
+        self.assertTrue(slow)
+        # each slow statement is pinned on our code, not Django's
+        self.assertTrue(all(site.startswith('trivia/') for _, _, _, site, _ in slow), slow)
+
+        self.client.force_login(self.staff)
+        text = self.client.get(reverse('trivia:metrics')).content.decode()
+        self.assertIn('trivia_requests_total{view="trivia:game_detail"} 1\n', text)
+        self.assertIn(f'trivia_db_queries_total{{view="trivia:game_detail"}} {recorded.queries}\n', text)
+        self.assertIn('trivia_slow_query_seconds{view="trivia:game_detail",site="trivia/', text)
+
+    def test_only_a_sample_is_recorded(self):
+        url = reverse('trivia:game_detail', args=[self.game.id])
+        with mock.patch.object(metrics, 'SAMPLE_RATE', 0.25):
+            for draw in [0.9, 0.1, 0.5]:
+                with mock.patch.object(metrics.random, 'random', return_value=draw):
+                    self.client.get(url)
+        views, _ = metrics.registry.snapshot()
+        self.assertEqual(dict(views)['trivia:game_detail'].requests, 1)
+
+    def test_metrics_are_for_staff_only(self):
+        url = reverse('trivia:metrics')
+        self.assertEqual(self.client.get(url).status_code, 302)
+        self.client.force_login(self.game.player.first())
+        self.assertEqual(self.client.get(url).status_code, 302)
+        self.client.force_login(self.staff)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+
+
+class LiveTests(TestCase):
+
+    def listen(self, game_id, staff):
+        '''The events a page gets while a staff only job event and a plain bump go out.'''
+        sent = []
+
+        async def run():
+            gone = asyncio.Event()
+
+            async def receive():
+                await gone.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                sent.append(message.get('body', b''))
+                # the headers, the retry line, then the two events
+                if len(sent) == 4:
+                    gone.set()
+
+            scope = {'type': 'http', 'method': 'GET', 'path': f'/games/{game_id}/events/', 'headers': []}
+            with mock.patch.object(live, 'is_staff', return_value=staff):
+                task = asyncio.ensure_future(live.router(None)(scope, receive, send))
+                while not live.broadcaster.connections(game_id):
+                    await asyncio.sleep(0.01)
+                live.announce(game_id, 'job', {'id': 1, 'message': 'boom'}, staff_only=True)
+                live.announce(game_id)
+                await asyncio.wait_for(task, 1)
+        asyncio.run(run())
+        return [
+            (event[len('event: '):], json.loads(data[len('data: '):]))
+            for event, data in (message.split('\n')[:2] for message in b''.join(sent[2:]).decode().split('\n\n') if message)
+        ]
+
+    def test_every_event_has_the_next_version_and_job_messages_are_for_staff(self):
+        game_id = make_game(2, 1, 1).id
+        start = scoreboard.version(game_id)
+        self.assertEqual(self.listen(game_id, staff=True), [
+            ('job', {'id': 1, 'message': 'boom', 'version': start + 1}), ('version', {'version': start + 2}),
+        ])
+        self.assertEqual(self.listen(game_id, staff=False), [
+            ('version', {'version': start + 3}), ('version', {'version': start + 4}),
+        ])
+
+    def test_page_knows_its_version(self):
+        game_id = make_game(2, 1, 1).id
+        forget()
+        response = self.client.get(reverse('trivia:game_detail', args=[game_id]))
+        self.assertEqual(response.context['version'], scoreboard.version(game_id))
+        self.assertContains(response, f'var version = {scoreboard.version(game_id)};')
+
+
+class ExportAsgiTests(SimpleTestCase):
+
+    def call(self, path, query=b''):
+        sent = []
+
+        async def receive():
+            await asyncio.sleep(60)
+
+        async def send(message):
+            sent.append(message)
+
+        async def django_application(scope, receive, send):
+            sent.append('django')
+
+        scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query, 'headers': []}
+        asyncio.run(export.router(django_application)(scope, receive, send))
+        return sent
+
+    def test_streams_chunks_from_a_thread(self):
+        chunks = [f'chunk {i}\n' for i in range(10)]
+        with mock.patch.object(export, '_staff', return_value=True), \
+                mock.patch.object(export, 'stream', return_value=iter(chunks)):
+            sent = self.call('/manage/export/scores.csv', b'game=1')
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertEqual([m['body'].decode() for m in sent[1:-1]], chunks)
+        self.assertFalse(sent[-1].get('more_body'))
+
+    def test_failed_export_is_aborted(self):
+        def chunks():
+            yield 'chunk 0\n'
+            raise ValueError('boom')
+        with mock.patch.object(export, '_staff', return_value=True), \
+                mock.patch.object(export, 'stream', return_value=chunks()), \
+                self.assertLogs('trivia.export', 'ERROR'), self.assertRaises(RuntimeError):
+            self.call('/manage/export/scores.csv')
+
+    def test_staff_only_and_other_paths_pass_through(self):
+        with mock.patch.object(export, '_staff', return_value=False):
+            self.assertEqual(self.call('/manage/export/scores.csv')[0]['status'], 302)
+            self.assertEqual(self.call('/manage/export/scores.xml')[0]['status'], 404)
+            self.assertEqual(self.call('/manage/'), ['django'])
+
+
+class OffloadTests(SimpleTestCase):
+
+    def test_writers_wait_their_turn_and_readers_dont(self):
+        running = {'GET': 0, 'POST': 0}
+        most = {'GET': 0, 'POST': 0}
+        turns = []
+
+        async def django_application(scope, receive, send):
+            method = scope['method']
+            turns.append(scope.get(sqlite.WRITE_TURN, False))
+            running[method] += 1
+            most[method] = max(most[method], running[method])
+            await asyncio.sleep(0.01)
+            running[method] -= 1
+
+        application = offload.router(django_application, threads=2, write_turns=True)
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def room():
+            await asyncio.gather(*[
+                application({'type': 'http', 'method': method}, receive, None)
+                for method in ['GET', 'POST'] * 5
+            ])
+        asyncio.run(room())
+        self.assertEqual(most, {'GET': 5, 'POST': 1})
+        self.assertEqual(turns.count(True), 5)
+
+    def test_slow_clients_dont_hold_the_turn(self):
+        handled = []
+
+        async def django_application(scope, receive, send):
+            body = b''
+            while True:
+                message = await receive()
+                body += message['body']
+                if not message.get('more_body'):
+                    break
+            handled.append(body)
+            await send({'type': 'http.response.start', 'status': 200})
+            await send({'type': 'http.response.body', 'body': b'ok'})
+
+        application = offload.router(django_application, threads=2, write_turns=True)
+
+        def client(body, stall_upload=False, stall_download=False):
+            chunks = [{'type': 'http.request', 'body': body[:2], 'more_body': True},
+                      {'type': 'http.request', 'body': body[2:]}]
+
+            async def receive():
+                if stall_upload and len(chunks) == 1:
+                    await asyncio.sleep(60)
+                return chunks.pop(0)
+
+            async def send(message):
+                if stall_download:
+                    await asyncio.sleep(60)
+            return application({'type': 'http', 'method': 'POST'}, receive, send)
+
+        async def room():
+            stalled = [
+                asyncio.ensure_future(client(b'uploading', stall_upload=True)),
+                asyncio.ensure_future(client(b'downloading', stall_download=True)),
+            ]
+            await asyncio.sleep(0.01)
+            await asyncio.wait_for(client(b'quick'), 1)
+            for task in stalled:
+                task.cancel()
+        asyncio.run(room())
+        self.assertEqual(handled, [b'downloading', b'quick'])
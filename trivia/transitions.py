@@ -0,0 +1,89 @@
+'''
+Game phases and moving several rounds along at once.
+
+A game's phase is stored on the game so pages can check it without looking
+at every round. It's worked out by the database from the round and final
+round statuses in one UPDATE, so it can't drift from them, and the models
+call update_phase() whenever a status changes.
+
+transition() is the trivia master's "close round 3 and open round 4": every
+round status changes in one UPDATE inside one transaction, and the
+scoreboard is invalidated once. Once that has committed, no new answers can
+get past the status check, so any still queued are written and the rounds
+moving to Check Answers are auto checked. The auto checks can be left to
+trivia.jobs instead, which queues them with the status change.
+'''
+from django.db import transaction
+from django.db.models import Case, CharField, Exists, OuterRef, Value, When
+
+from . import jobs, live, scoreboard, submissions
+from .grading import grade_round
+from .models import FinalRound, Game, Round
+from .sqlite import begin_writing
+
+
+def phase_expression():
+    '''The phase of the game in each row, from its rounds' statuses.'''
+    rounds = Round.objects.filter(game=OuterRef('pk'))
+    final_rounds = FinalRound.objects.filter(game=OuterRef('pk'))
+    return Case(
+        When(Exists(final_rounds.filter(status='4')), then=Value('3')),
+        When(Exists(final_rounds.exclude(status='0')), then=Value('2')),
+        When(Exists(rounds.exclude(status='0')), then=Value('1')),
+        default=Value('0'),
+        output_field=CharField(),
+    )
+
+
+def update_phase(game_id):
+    Game.objects.filter(id=game_id).update(phase=phase_expression())
+
+
+def transition(game_id, rounds=None, final_status=None, background=False):
+    '''
+    Move a game's rounds to new statuses, given as {round_id: status}, and
+    optionally its final round too. Rounds already there, or not in the game,
+    are left alone. Returns the GradeReport of each round that moved to Check
+    Answers, keyed by round id, or with background set, the Job checking it.
+    '''
+    rounds = {round_id: str(status) for round_id, status in (rounds or {}).items()}
+    reports = {}
+    with transaction.atomic(), scoreboard.batched():
+        begin_writing()
+        current = dict(
+            Round.objects.select_for_update().filter(game_id=game_id, id__in=rounds).values_list('id', 'status')
+        )
+        changes = {
+            round_id: status for round_id, status in rounds.items()
+            if round_id in current and str(current[round_id]) != status
+        }
+        if changes:
+            Round.objects.filter(id__in=changes).update(status=Case(
+                *[When(id=round_id, then=Value(status)) for round_id, status in changes.items()],
+                output_field=CharField(),
+            ))
+        checking = [round_id for round_id, status in changes.items() if status == '2']
+        if background:
+            # the job writes queued answers when it runs, after this commits
+            reports = {round_id: jobs.grade(round_id, game_id) for round_id in checking}
+
+        final_round = None
+        if final_status is not None:
+            final_round = FinalRound.objects.filter(game_id=game_id).first()
+        if final_round and final_round.status != str(final_status):
+            # one row with its own wager bookkeeping, so it goes through the model (phase included)
+            final_round.status = str(final_status)
+            final_round.save()
+        elif changes:
+            update_phase(game_id)
+
+        labels = dict(Round.STATUS_CHOICES)
+        for round_id, status in changes.items():
+            live.publish(game_id, 'status', kind='round', id=round_id, status=status, label=labels[status])
+        scoreboard.bump(game_id)
+    if checking and not background:
+        # answers accepted before the status change committed have to be in
+        # before anything is checked
+        submissions.flush()
+        reports = {round_id: grade_round(round_id) for round_id in checking}
+    return reports
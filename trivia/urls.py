@@ -8,6 +8,7 @@ urlpatterns = [
     path('', views.IndexView.as_view(), name='index'),
     path('games/', views.GameIndexView.as_view(), name='games'),
     path('games/<int:pk>/', views.GameDetailView.as_view(), name='game_detail'),
+    path('games/<int:pk>/events/', views.game_events, name='game_events'),
     path('games/round/<int:pk>/', views.RoundDetailView.as_view(), name='round_detail'),
     path('games/round/<int:pk>/status/', views.RoundStatusUpdate.as_view(), name='round_update'),
     path('games/<int:game>/answer/<int:round>/<int:question>/', views.QuestionResponseCreate.as_view(), name='new_answer'),
@@ -17,6 +18,7 @@ urlpatterns = [
     path('games/<int:game>/final/', views.finalanswer, name='final_answer'),
     path('games/final/<int:pk>/update/', views.FinalAnswerUpdate.as_view(), name='final_answer_update'),
     path('games/<int:game>/final/check/', views.manage_finalanswers, name='check_finalanswer'),
+    path('games/<int:game>/check/<int:round>/', views.check_round, name='check_round'),
     path('games/<int:game>/check/<int:round>/<int:player>/', views.check_answers, name='check_answers'),
     path('games/finalroundstatus/<int:pk>/', views.FinalRoundStatusUpdate.as_view(), name='finalround_update'),
     path('games/review/<int:pk>/', views.RoundReviewDetail.as_view(), name='round_review'),
@@ -25,5 +27,10 @@ urlpatterns = [
     path('manage/', views.ManageView.as_view(), name='manage'),
     path('manage/round/new/', views.RoundCreate.as_view(), name='new_round'),
     path('manage/round/<int:round_pk>/', views.manage_questions, name='manage_questions'),
+    path('manage/game/<int:game>/rounds/', views.round_statuses, name='round_statuses'),
+    path('manage/game/<int:game>/scores/', views.refresh_scores, name='refresh_scores'),
+    path('manage/export/<slug:kind>.<slug:fmt>', views.export_results, name='export'),
+    path('manage/scoreboard/', views.scoreboard_stats, name='scoreboard_stats'),
+    path('manage/metrics/', views.metrics_view, name='metrics'),
     path('signup/', views.signup, name='signup'),
 ]
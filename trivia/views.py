@@ -1,15 +1,20 @@
+from datetime import datetime
+from urllib.parse import urlencode
+
 from django.contrib import messages
 from django.contrib.auth import login, authenticate
 from django.contrib.auth.decorators import user_passes_test, login_required
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
-from django.contrib.auth.models import User
 from django.contrib.messages.views import SuccessMessageMixin
 from django.core.exceptions import PermissionDenied
 from django.forms import modelformset_factory, inlineformset_factory
-from django.http import HttpResponseRedirect, Http404
+from django.http import (
+    HttpResponse, HttpResponseBadRequest, HttpResponseRedirect, Http404, JsonResponse, StreamingHttpResponse
+)
 from django.shortcuts import render, redirect
 from django.urls import reverse
+from django.utils.http import urlsafe_base64_decode, urlsafe_base64_encode
 from django.views import generic
 from django.views.generic.edit import CreateView, UpdateView
 
@@ -17,7 +22,11 @@ from .models import (
     FinalAnswer, Game, Round, Question,
     QuestionResponse, DoubleRound, FinalRound
 )
-from .forms import FinalAnswerForm
+from . import export, jobs, memo, metrics, scoreboard, submissions
+from .forms import FinalAnswerForm, RoundAnswerForm, RoundCheckForm, RoundStatusForm
+from .grading import flagged_first, grade_message, grade_round, mark_groups, response_groups
+from .state import get_state
+from .transitions import transition
 
 # Create your views here.
 
@@ -27,18 +36,23 @@ def staff_check(user):
     return user.is_staff
 
 def check_answers_func(pk):
-    query = QuestionResponse.objects.filter(question__round_id=pk)
-    QRFormSet = modelformset_factory(
-        QuestionResponse, fields=('response', 'correct',), extra=0
-    )
-    formset = QRFormSet(queryset=query)
-    instances = formset.save(commit=False)
-    for instance in instances:
-        for answer in instance.question.answer_set():
-            # I need to move the strip method someplace else
-            if instance.response.lower().strip() == answer.lower():
-                instance.correct = True
-                instance.save()
+    # Auto check a round, with any queued answers written first; see trivia.grading
+    submissions.flush()
+    return grade_round(pk)
+
+def encode_cursor(game):
+    return urlsafe_base64_encode(f'{game.pub_date.isoformat()}|{game.id}'.encode())
+
+
+def decode_cursor(cursor):
+    '''(pub_date, id) from a game list cursor, or None if it isn't one.'''
+    if not cursor:
+        return None
+    try:
+        pub_date, game_id = urlsafe_base64_decode(cursor).decode().split('|')
+        return datetime.fromisoformat(pub_date), int(game_id)
+    except ValueError:
+        return None
 
 # Begin game management views #############################
 
@@ -47,21 +61,128 @@ class IndexView(generic.TemplateView):
 
 
 class GameIndexView(generic.ListView): # pylint: disable=too-many-ancestors
-    '''List of games for the players to get into'''
+    '''
+    List of games for the players to get into, newest first. Pages are keyed
+    by the (pub_date, id) of the last game shown rather than an offset, so
+    every page is a short walk down an index however many games there are.
+    '''
     model = Game
+    page_size = 25
+
+    def filters(self):
+        '''The completed and mine filters from the query string.'''
+        filters = {}
+        if self.request.GET.get('completed') in ('0', '1'):
+            filters['completed'] = self.request.GET['completed']
+        if self.request.GET.get('mine') == '1' and self.request.user.is_authenticated:
+            filters['mine'] = '1'
+        return filters
+
+    def get_queryset(self):
+        games = Game.objects.only('id', 'game_title', 'pub_date')
+        filters = self.filters()
+        if 'completed' in filters:
+            games = games.filter(completed=filters['completed'] == '1')
+        if 'mine' in filters:
+            games = games.filter(player=self.request.user)
+        cursor = decode_cursor(self.request.GET.get('after'))
+        if cursor:
+            pub_date, game_id = cursor
+            games = games.filter(pub_date__lte=pub_date).exclude(pub_date=pub_date, id__gte=game_id)
+        # one extra to know whether there is another page
+        return games[:self.page_size + 1]
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        games = list(context['object_list'])
+        filters = self.filters()
+        context['game_list'] = games[:self.page_size]
+        context['filters'] = filters
+        context['first_page'] = urlencode(filters)
+        if len(games) > self.page_size:
+            context['next_page'] = urlencode({**filters, 'after': encode_cursor(games[self.page_size - 1])})
+        return context
 
 
-class GameDetailView(generic.DetailView):
+class GameDetailView(generic.TemplateView):
     '''Main landing page and public scoreboard for a game'''
-    model = Game
+    template_name = 'trivia/game_detail.html'
     title = 'Game Detail'
 
+    def get_context_data(self, **kwargs):
+        # The scoreboard (and the staff's job list) comes out of the cache until something changes it
+        context = super().get_context_data(**kwargs)
+        context.update(scoreboard.render(self.request, self.kwargs['pk']))
+        return context
+
+
+def game_events(request, pk):
+    '''
+    Live scoreboard events are streamed by trivia.live under ASGI before the
+    request ever gets here. Anything that does reach Django is being served
+    without it, and 204 tells the browser to stop reconnecting.
+    '''
+    return HttpResponse(status=204)
+
 
 class RoundDetailView(LoginRequiredMixin, generic.DetailView):
+    '''The round's answer sheet: every question in one form, saved in one POST'''
     model = Round
 
+    def get_form(self):
+        state = get_state(self.object.game_id, self.request)
+        questions = state.round(self.object.id).questions
+        responses = {}
+        for question in questions:
+            response = state.response(question.id, self.request.user.id)
+            if response:
+                responses[question.id] = response.response
+        # answers still in the submission queue are newer than the saved ones
+        responses.update(submissions.pending_answers(self.request.user.id))
+        return RoundAnswerForm(questions, responses, disabled=self.object.status != '1')
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['game'] = get_state(self.object.game_id, self.request)
+        context.setdefault('form', self.get_form())
+        return context
+
+    def post(self, request, *args, **kwargs):
+        # the status, game and questions in one query, then one upsert; the
+        # whole game is only loaded to show the form again if it's invalid
+        rows = list(
+            Round.objects.filter(id=kwargs['pk'])
+            .values_list('status', 'game_id', 'question__id', 'question__question')
+            .order_by('question__id')
+        )
+        if not rows:
+            raise Http404('No such round')
+        status, game_id = rows[0][:2]
+        if status != '1':
+            messages.error(request, "The round status doesn't allow that.")
+            return HttpResponseRedirect(reverse('trivia:game_detail', kwargs={'pk': game_id}))
+        questions = [Question(id=question_id, question=text) for _, _, question_id, text in rows if question_id]
+        form = RoundAnswerForm(questions, data=request.POST)
+        if not form.is_valid():
+            self.object = self.get_object()
+            return self.render_to_response(self.get_context_data(form=form))
+        submissions.submit_answers(game_id, request.user.id, form.responses())
+        messages.success(request, 'Your answers have been saved.')
+        return HttpResponseRedirect(reverse('trivia:round_detail', kwargs={'pk': kwargs['pk']}))
+
 
-class QuestionResponseCreate(LoginRequiredMixin, CreateView):
+class QueuedSaveMixin:
+    '''With the submission queue on, queue a valid form's changes instead of saving them'''
+
+    def form_valid(self, form):
+        if not submissions.ENABLED:
+            return super().form_valid(form)
+        self.object = form.instance
+        submissions.submit(form.instance, list(form.fields))
+        return HttpResponseRedirect(self.get_success_url())
+
+
+class QuestionResponseCreate(LoginRequiredMixin, QueuedSaveMixin, CreateView):
     model = QuestionResponse
     fields = ['response']
     template_name = 'trivia/questionresponse_form.html'
@@ -101,7 +222,7 @@ class QuestionResponseCreate(LoginRequiredMixin, CreateView):
         return super().post(request, *args, **kwargs)
     '''
 
-class QuestionResponseUpdate(LoginRequiredMixin, UpdateView):
+class QuestionResponseUpdate(LoginRequiredMixin, QueuedSaveMixin, UpdateView):
     model = QuestionResponse
     template_name = 'trivia/questionresponse_form.html'
     fields = ['response']
@@ -118,21 +239,29 @@ class QuestionResponseUpdate(LoginRequiredMixin, UpdateView):
 
 class RoundStatusUpdate(UserPassesTestMixin, UpdateView):
     model = Round
+    queryset = Round.objects.select_related('game')
     template_name = 'trivia/round_form.html'
     fields = ['status']
 
     def test_func(self):
         return self.request.user.is_staff
 
-    def post(self, request, *args, **kwargs):
-        # If status is changed to check answers, run auto check
-        if request.POST.get('status') == '2':
-            check_answers_func(kwargs['pk'])
-        return super().post(request, *args, **kwargs)
+    def form_valid(self, form):
+        response = super().form_valid(form)
+        # If status is changed to check answers, run auto check. The status is
+        # saved first, so no answer can be queued after the check's flush.
+        if self.object.status == '2' and jobs.ENABLED:
+            # graded in the background; the game page shows how it's going
+            jobs.grade(self.object.id, self.object.game_id)
+            messages.info(self.request, 'Auto check has started. Its progress is shown on the game page.')
+        elif self.object.status == '2':
+            messages.info(self.request, grade_message(check_answers_func(self.object.id)))
+        return response
 
 
 class FinalRoundStatusUpdate(UserPassesTestMixin, UpdateView):
     model = FinalRound
+    queryset = FinalRound.objects.select_related('game')
     template_name = 'trivia/finalround_form.html'
     fields = ['status']
 
@@ -140,7 +269,7 @@ class FinalRoundStatusUpdate(UserPassesTestMixin, UpdateView):
         return self.request.user.is_staff
 
 
-class FinalRoundWagerUpdate(UpdateView):
+class FinalRoundWagerUpdate(QueuedSaveMixin, UpdateView):
     model = FinalAnswer
     fields = ['wager']
     template_name = 'trivia/wager_form.html'
@@ -170,7 +299,7 @@ def finalwager(request, **kwargs):
     return HttpResponseRedirect(reverse('trivia:final_wager_update', kwargs={'pk': obj.id}))
 
 
-class FinalAnswerUpdate(UpdateView):
+class FinalAnswerUpdate(QueuedSaveMixin, UpdateView):
     model = FinalAnswer
     fields = ['answer']
     template_name = 'trivia/final_answer.html'
@@ -192,11 +321,17 @@ def check_answers(request, **kwargs):
     Done only during the 'check answers' round status.
     Trivia master has access at all times.
     '''
-    round_obj = Round.objects.get(id=kwargs['round'])
-    if round_obj.status != '2' and not request.user.is_staff:
+    state = get_state(kwargs['game'], request)
+    round_state = state.round(kwargs['round'])
+    player = state.player(kwargs['player'])
+    if round_state is None or player is None:
+        raise Http404('No such round or player in this game')
+    if round_state.status != '2' and not request.user.is_staff:
         raise PermissionDenied("It's not time to check the round!")
+    if player.id == request.user.id and not request.user.is_staff:
+        raise Http404("Do you think I'm going to let you check your own answers?")
     params = {'player__id': kwargs['player'], 'question__round__id': kwargs['round']}
-    q_set = QuestionResponse.objects.filter(**params)
+    q_set = flagged_first(QuestionResponse.objects.filter(**params))
     QuestionResponseFormSet = modelformset_factory(
         QuestionResponse, fields=('correct',), extra=0,
     )
@@ -206,37 +341,73 @@ def check_answers(request, **kwargs):
         )
         if formset.is_valid():
             formset.save()
+            memo.remember_responses(
+                (form.instance.question_id, form.instance.normalized_response, form.instance.correct)
+                for form in formset if form.has_changed()
+            )
             return HttpResponseRedirect(
                 reverse('trivia:game_detail', kwargs={'pk': kwargs['game']})
             )
     else:
         formset = QuestionResponseFormSet(queryset=q_set)
     kwargs['formset'] = formset
-    kwargs['responses'] = q_set
-    kwargs['player'] = User.objects.get(id=kwargs['player'])
-    if kwargs['player'] == request.user and not request.user.is_staff:
-        raise Http404("Do you think I'm going to let you check your own answers?")
+    kwargs['rows'] = [
+        (form, form.instance, state.questions[form.instance.question_id]) for form in formset
+    ]
+    kwargs['game'] = state
+    kwargs['round'] = round_state
+    kwargs['player'] = player
     return render(request, 'trivia/check_answers.html', kwargs)
 
 
+@login_required
+def check_round(request, **kwargs):
+    '''
+    Check a whole round at once. Everyone who gave the same answer to a
+    question shares one checkbox, so the work goes with the number of
+    distinct answers. Same rules as check_answers: only while the round is
+    in Check Answers, and never your own answers, unless you're staff.
+    '''
+    state = get_state(kwargs['game'], request)
+    round_state = state.round(kwargs['round'])
+    if round_state is None:
+        raise Http404('No such round in this game')
+    if round_state.status != '2' and not request.user.is_staff:
+        raise PermissionDenied("It's not time to check the round!")
+    exclude_player = None if request.user.is_staff else request.user.id
+    form = RoundCheckForm(response_groups(round_state.id, exclude_player), request.POST or None)
+    if request.method == "POST" and form.is_valid():
+        marked = mark_groups(round_state.id, form.verdicts(), exclude_player)
+        memo.remember_responses(form.entries())
+        messages.success(request, f'{marked} answers updated.')
+        return HttpResponseRedirect(reverse('trivia:game_detail', kwargs={'pk': state.id}))
+    return render(request, 'trivia/check_round.html', {
+        'game': state, 'round': round_state, 'form': form, 'rows': form.rows(round_state.questions),
+    })
+
+
 @login_required
 def manage_finalanswers(request, **kwargs):
+    final_round = FinalRound.objects.select_related('game').get(game_id=kwargs['game'])
     FinalFormSet = inlineformset_factory(
         FinalRound, FinalAnswer, fields=('correct',), can_delete=False, extra=0
     )
+    # Players come along with their answers so the rows don't look them up one by one
+    q_set = FinalAnswer.objects.select_related('player')
     if request.method == "POST":
-        formset = FinalFormSet(
-            request.POST, request.FILES, instance=FinalRound.objects.get(game_id=kwargs['game']),
-        )
+        formset = FinalFormSet(request.POST, request.FILES, instance=final_round, queryset=q_set)
         if formset.is_valid():
             formset.save()
+            memo.remember_final(final_round.id, [
+                (form.instance.answer, form.instance.correct) for form in formset if form.has_changed()
+            ])
             return HttpResponseRedirect(
                 reverse('trivia:game_detail', kwargs={'pk': kwargs['game']})
             )
     else:
-        formset = FinalFormSet(instance=FinalRound.objects.get(game_id=kwargs['game']))
+        formset = FinalFormSet(instance=final_round, queryset=q_set)
     kwargs['formset'] = formset
-    kwargs['final_answers'] = FinalAnswer.objects.filter(finalround__game_id=kwargs['game'])
+    kwargs['final_round'] = final_round
     return render(request, 'trivia/finalanswer_check.html', kwargs)
 
 
@@ -245,12 +416,30 @@ class RoundReviewDetail(UserPassesTestMixin, generic.DetailView):
     model = Round
     template_name = 'trivia/round_review.html'
 
+    def get_object(self, queryset=None):
+        # test_func needs the round first, so only fetch it once
+        if not hasattr(self, '_round'):
+            self._round = super().get_object(queryset)
+        return self._round
+
     def test_func(self):
         # Gives trivia master access at all times, everyone else only after the round is over.
-        if Round.objects.get(id=self.kwargs['pk']).status == '3':
+        if self.get_object().status == '3':
             return self.request.user.is_authenticated
         return self.request.user.is_staff
 
+    def get_context_data(self, **kwargs):
+        # The whole question x player grid out of the GameState, ready to render
+        context = super().get_context_data(**kwargs)
+        state = get_state(self.object.game_id, self.request)
+        context['game'] = state
+        context['players'] = state.players
+        context['rows'] = [
+            (question, [state.response(question.id, player.id) for player in state.players])
+            for question in state.round(self.object.id).questions
+        ]
+        return context
+
 
 # Double round success message:
 DR_MSG = 'Your double round is: %(round)s'
@@ -306,18 +495,77 @@ class ManageView(UserPassesTestMixin, generic.TemplateView):
     template_name = 'trivia/manage.html'
 
     def test_func(self):
-        return user.is_staff
+        return self.request.user.is_staff
 
 
 class RoundCreate(UserPassesTestMixin, CreateView):
     model = Round
-    fields = ['category_text', 'game']
+    fields = ['category', 'game']
 
     def get_success_url(self):
         return reverse('trivia:manage_questions', kwargs={'round_pk': self.object.pk})
 
     def test_func(self):
-        return user.is_staff
+        return self.request.user.is_staff
+
+
+@user_passes_test(staff_check)
+def round_statuses(request, game):
+    '''Move any number of a game's rounds along in one go, e.g. close one and open the next'''
+    state = get_state(game, request)
+    form = RoundStatusForm(state.rounds, state.final_round, request.POST or None)
+    if request.method == "POST" and form.is_valid():
+        reports = transition(game, form.statuses(), form.final_status(), background=jobs.ENABLED)
+        for round_id, report in reports.items():
+            if jobs.ENABLED:
+                messages.info(request, f'{state.round(round_id)}: auto check has started.')
+            else:
+                messages.info(request, f'{state.round(round_id)}: {grade_message(report)}')
+        return HttpResponseRedirect(reverse('trivia:game_detail', kwargs={'pk': game}))
+    return render(request, 'trivia/round_statuses.html', {'game': state, 'form': form})
+
+
+@user_passes_test(staff_check)
+def refresh_scores(request, game):
+    '''Rebuild a game's scores from its answers in the background'''
+    if request.method == 'POST':
+        jobs.refresh_scores(game)
+        messages.info(request, 'Score refresh has started.')
+    return HttpResponseRedirect(reverse('trivia:game_detail', kwargs={'pk': game}))
+
+
+@user_passes_test(staff_check)
+def scoreboard_stats(request):
+    '''Scoreboard cache hit/miss counts for keeping an eye on the hit rate'''
+    return JsonResponse(scoreboard.stats())
+
+
+@user_passes_test(staff_check)
+def metrics_view(request):
+    '''Per-view request metrics and scoreboard cache counts for Prometheus'''
+    cache = scoreboard.stats()
+    text = metrics.render(extra=[
+        ('trivia_scoreboard_cache_hits_total', 'counter', 'Scoreboards served from the cache.', cache['hits']),
+        ('trivia_scoreboard_cache_misses_total', 'counter', 'Scoreboards rendered.', cache['misses']),
+    ])
+    return HttpResponse(text, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@user_passes_test(staff_check)
+def export_results(request, kind, fmt):
+    '''
+    Scores, responses or wagers as CSV or JSON lines, streamed; see
+    trivia.export, which serves this URL itself under ASGI.
+    '''
+    if kind not in export.KINDS or fmt not in export.FORMATS:
+        raise Http404('No such export')
+    try:
+        games = export.games_from_query(dict(request.GET.lists()))
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    response = StreamingHttpResponse(export.stream(kind, fmt, games), content_type=export.FORMATS[fmt])
+    response['Content-Disposition'] = f'attachment; filename="{export.filename(kind, fmt)}"'
+    return response
 
 
 @user_passes_test(staff_check)
@@ -327,7 +575,7 @@ def manage_questions(request, round_pk):
         Round, Question, fields=('question', 'answer', 'alt_answers',), extra=10
     )
     if request.method == "POST":
-        formset = QuestionInlineFormSet(request.POST, request.FILES, instance=round)
+        formset = QuestionInlineFormSet(request.POST, request.FILES, instance=round_obj)
         if formset.is_valid():
             formset.save()
             return HttpResponseRedirect(reverse('trivia:manage'))
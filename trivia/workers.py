@@ -0,0 +1,15 @@
+'''
+Set up for worker processes, kept free of Django imports.
+
+Under the spawn start method (the default on macOS and Windows) a worker
+imports its initializer's module before anything else runs. Importing a
+module that pulls in trivia.models at that point fails, because the app
+registry isn't ready yet, so the initializer lives here and sets Django up
+before any task is unpickled.
+'''
+import django
+
+
+def setup_worker():
+    # Worker processes that weren't forked from a set up Django need to do it themselves
+    django.setup()